@@ -0,0 +1,739 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+"""
+redem.bench - benchmarks for redem
+
+::
+
+    python -m redem.bench -n 1000 to_dict
+    python -m redem.bench -n 10 imports
+    python -m redem.bench --sizes 10000,100000,1000000 -o bench.json pipeline
+    python -m redem.bench -n 100000 --generate data/synthetic.data.json
+    python -m redem.bench -n 10000 --latency 0.05 fetch batch
+
+"""
+import json
+import logging
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from html import escape as html_escape
+
+from redem import redem
+
+log = logging.getLogger('redem.bench')
+
+SUBREDDITS = ('Python', 'programming', 'learnpython', 'linux', 'science')
+
+
+def make_comment_data(i, username='example'):
+    """
+    the ``data`` of a synthetic listing comment (``t1``), as returned
+    by the API (with HTML-escaped ``body_html``)
+    """
+    subreddit = SUBREDDITS[i % len(SUBREDDITS)]
+    link_id = 't3_s%d' % (i // 10)
+    body = u'comment %d, see http://example.org/%d' % (i, i % 97)
+    return OrderedDict((
+        ('link_id', link_id),
+        ('link_title', u'submission %d' % (i // 10)),
+        ('id', 'c%d' % i),
+        ('author', username),
+        ('body', body),
+        ('body_html', (
+            u'&lt;div class="md"&gt;&lt;p&gt;comment %d, see '
+            u'&lt;a href="http://example.org/%d"&gt;'
+            u'http://example.org/%d&lt;/a&gt;&lt;/p&gt;&lt;/div&gt;' % (
+                i, i % 97, i % 97))),
+        ('created', 1380000000.0 - i * 600 - 28800),
+        ('created_utc', 1380000000.0 - i * 600),
+        ('edited', (1380000000.0 - i * 600 + 60) if not i % 7 else False),
+        ('score', i % 13),
+        ('ups', i % 13),
+        ('downs', 0),
+        ('subreddit', subreddit),
+        ('subreddit_id', 't5_%s' % subreddit.lower()),
+        ('name', 't1_c%d' % i),
+    ))
+
+
+def make_submission_data(i, username='example'):
+    """
+    the ``data`` of a synthetic listing submission (``t3``)
+    """
+    subreddit = SUBREDDITS[i % len(SUBREDDITS)]
+    is_self = not i % 3
+    _id = 's%d' % i
+    permalink = u'/r/%s/comments/%s/submission_%d/' % (subreddit, _id, i)
+    return OrderedDict((
+        ('id', _id),
+        ('author', username),
+        ('num_comments', i % 31),
+        ('selftext', u'selftext %d' % i if is_self else u''),
+        ('selftext_html', (
+            u'&lt;div class="md"&gt;&lt;p&gt;selftext %d&lt;/p&gt;'
+            u'&lt;/div&gt;' % i) if is_self else None),
+        ('subreddit_id', 't5_%s' % subreddit.lower()),
+        ('title', u'submission %d' % i),
+        ('url', (u'http://www.reddit.com' + permalink) if is_self else (
+            u'http://example.com/%d' % i)),
+        ('domain', u'self.%s' % subreddit if is_self else u'example.com'),
+        ('created', 1380000000.0 - i * 3600 - 28800),
+        ('created_utc', 1380000000.0 - i * 3600),
+        ('ups', i % 17),
+        ('downs', 0),
+        ('score', i % 17),
+        ('permalink', permalink),
+        ('subreddit', subreddit),
+        ('name', 't3_' + _id),
+    ))
+
+
+def timeit(func, *args, **kwargs):
+    """
+    :returns: (seconds, return value) of the fastest of ``repeat`` calls
+    """
+    repeat = kwargs.pop('repeat', 3)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        value = func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, value
+
+
+def praw_like_object(data):
+    """
+    an object with the attributes of a praw 3 ``Comment`` or
+    ``Submission`` that :py:func:`redem.comment_to_dict` and
+    :py:func:`redem.submission_to_dict` read (``praw.objects`` is gone
+    in praw 4+)
+    """
+    from types import SimpleNamespace
+    thing = SimpleNamespace(**data)
+    thing.author = SimpleNamespace(name=data['author'])
+    thing.subreddit = SimpleNamespace(display_name=data['subreddit'])
+    if 'title' in data:
+        # praw permalinks are absolute, listing JSON permalinks are not
+        thing.permalink = redem.REDDIT_URL + data['permalink']
+    return thing
+
+
+def bench_to_dict(n=1000, repeat=3):
+    """
+    compare :py:func:`redem.comment_to_dict` (praw objects) with
+    :py:func:`redem.raw_comment_to_dict` (listing JSON)
+
+    Without praw 3, the praw path converts :py:func:`praw_like_object`
+    objects (``"emulated": true``).
+    """
+    try:
+        import praw
+        import praw.objects
+    except ImportError:
+        log.warning("praw.objects is not available: using praw-like objects")
+        make_comment = make_submission = praw_like_object
+    else:
+        reddit = praw.Reddit(user_agent=redem.__USER_AGENT__)
+        reddit.config.decode_html_entities = True
+
+        def make_comment(data):
+            return praw.objects.Comment.from_api_response(reddit, data)
+
+        def make_submission(data):
+            return praw.objects.Submission.from_api_response(reddit, data)
+    # (both engines convert responses decoded by request_json)
+    comments = [redem.decode_html_entities(make_comment_data(i))
+                for i in range(n)]
+    submissions = [redem.decode_html_entities(make_submission_data(i))
+                   for i in range(n)]
+
+    def praw_path():
+        return (
+            [redem.comment_to_dict(make_comment(dict(x)))
+             for x in comments],
+            [redem.submission_to_dict(make_submission(dict(x)))
+             for x in submissions])
+
+    def raw_path():
+        return (
+            [redem.raw_comment_to_dict(redem.RawThing(x))
+             for x in comments],
+            [redem.raw_submission_to_dict(redem.RawThing(x))
+             for x in submissions])
+
+    results = OrderedDict()
+    outputs = {}
+    for name, func in (('praw', praw_path), ('raw', raw_path)):
+        seconds, outputs[name] = timeit(func, repeat=repeat)
+        results[name] = {
+            'seconds': seconds,
+            'items_per_second': 2 * n / seconds if seconds else None}
+    results['praw']['emulated'] = make_comment is praw_like_object
+    results['identical'] = (
+        json.dumps(outputs['praw']) == json.dumps(outputs['raw']))
+    return results
+
+
+def bench_uris(n=1000, repeat=3):
+    """
+    compare the ``redem.URI_EXTRACTORS`` HTML backends (and the process
+    pool batch mode) with :py:func:`redem.iter_uris_bs4`
+    """
+    texts = [redem.decode_html_entities(make_comment_data(i)['body_html'])
+             for i in range(n)]
+    texts.extend(
+        redem.decode_html_entities(
+            make_submission_data(i)['selftext_html'] or '')
+        for i in range(n))
+    expected = None
+    results = OrderedDict()
+    for name in ('bs4', 'htmlparser', 'lxml'):
+        extractor = redem.URI_EXTRACTORS[name]
+        try:
+            seconds, uris = timeit(
+                lambda: [list(extractor(text)) if text else []
+                         for text in texts],
+                repeat=repeat)
+        except ImportError as e:
+            results[name] = {'error': str(e)}
+            continue
+        if expected is None:
+            expected = uris
+        results[name] = {
+            'seconds': seconds,
+            'docs_per_second': len(texts) / seconds if seconds else None,
+            'identical': uris == expected}
+    seconds, uris = timeit(
+        redem.extract_uris_batch, texts, extractor='htmlparser',
+        repeat=repeat)
+    results['htmlparser_batch'] = {
+        'seconds': seconds,
+        'docs_per_second': len(texts) / seconds if seconds else None,
+        'identical': uris == expected}
+    return results
+
+
+NETLOCS = (
+    'en.wikipedia.org', 'en.m.wikipedia.org', 'github.com',
+    'westurner.github.com', 'docs.python.org', 'pip.rtfd.org',
+    'pip.readthedocs.org', 'www.reddit.com', 'example.org')
+
+
+def make_uris(n, distinct=None):
+    """
+    a synthetic corpus of ``n`` URIs with ``distinct`` (default ``n/10``)
+    distinct values, as found in an archive (permalinks and popular links
+    recur)
+    """
+    distinct = distinct or max(n // 10, 1)
+    uris = []
+    for i in range(n):
+        j = (i * 7919) % distinct
+        netloc = NETLOCS[j % len(NETLOCS)]
+        if not j % 11:
+            uris.append(u'/r/%s/comments/s%d/' % (SUBREDDITS[j % 5], j))
+        else:
+            uris.append(u'http://%s/path/%d?q=%d' % (netloc, j, j % 3))
+    return uris
+
+
+def bench_canonicalize(n=1000, repeat=3):
+    """
+    compare :py:func:`redem.canonicalize_uri` (memoized, compiled netloc
+    rules) with :py:func:`redem.canonicalize_uri_uncached`
+    """
+    uris = make_uris(n * 100)
+    results = OrderedDict()
+    seconds, expected = timeit(
+        lambda: [redem.canonicalize_uri_uncached(uri) for uri in uris],
+        repeat=repeat)
+    results['uncached'] = {
+        'seconds': seconds,
+        'uris_per_second': len(uris) / seconds if seconds else None}
+
+    def cached():
+        redem.reset_canonicalize_cache()
+        return [redem.canonicalize_uri(uri) for uri in uris]
+    seconds, canonical = timeit(cached, repeat=repeat)
+    results['cached'] = {
+        'seconds': seconds,
+        'uris_per_second': len(uris) / seconds if seconds else None,
+        'identical': canonical == expected}
+
+    def batch():
+        redem.reset_canonicalize_cache()
+        return redem.canonicalize_uris(uris)
+    seconds, canonical = timeit(batch, repeat=repeat)
+    results['batch'] = {
+        'seconds': seconds,
+        'uris_per_second': len(uris) / seconds if seconds else None,
+        'identical': [canonical[uri] for uri in uris] == expected}
+    return results
+
+
+def make_archive_text(n):
+    """
+    the JSON text of an archive of ``n`` comments and ``n`` submissions
+    """
+    return json.dumps({
+        '_meta': {'username': 'example'},
+        'comments': [
+            redem.raw_comment_to_dict(redem.RawThing(make_comment_data(i)))
+            for i in range(n)],
+        'submissions': [
+            redem.raw_submission_to_dict(
+                redem.RawThing(make_submission_data(i)))
+            for i in range(n)]})
+
+
+def measure_memory(func, *args):
+    """
+    :returns: (bytes allocated by the return value, peak bytes, value)
+    """
+    tracemalloc.start()
+    try:
+        value = func(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current, peak, value
+
+
+def bench_records(n=1000, repeat=3):
+    """
+    compare loading an archive as dicts with loading it as
+    :py:class:`redem.Record` (memory retained, load and dump speed)
+    """
+    text = make_archive_text(n)
+    results = OrderedDict()
+    for name, hook in (('dict', dict),
+                       ('record', redem.record_pairs_hook)):
+        load = lambda: json.loads(text, object_pairs_hook=hook)
+        current, peak, data = measure_memory(load)
+        seconds, data = timeit(load, repeat=repeat)
+        dump_seconds, output = timeit(redem.dumps, data, repeat=repeat)
+        results[name] = {
+            'bytes': current,
+            'bytes_per_item': current / (2 * n),
+            'peak_bytes': peak,
+            'load_seconds': seconds,
+            'dump_seconds': dump_seconds,
+            'identical': json.loads(output) == json.loads(text)}
+    return results
+
+
+def make_body(i, edit=0):
+    """
+    a synthetic comment body with zero to three links, as markdown
+    (``body``) and escaped HTML (``body_html``)
+
+    :param edit: revision number (0: as first posted)
+    """
+    links = [u'http://%s/path/%d' % (NETLOCS[(i + n) % len(NETLOCS)], i % 997)
+             for n in range(i % 4)]
+    text = u'comment %d' % i + (u' (edit %d)' % edit if edit else u'')
+    body = u'\n\n'.join([text] + [u'* %s' % link for link in links])
+    body_html = u'<div class="md"><p>%s</p>%s</div>' % (
+        text,
+        u'<ul>%s</ul>' % u''.join(
+            u'<li><a href="%s">%s</a></li>' % (link, link)
+            for link in links) if links else u'')
+    return body, html_escape(body_html, quote=False)
+
+
+def make_archive(n, start=0, edit=0, username='example'):
+    """
+    a synthetic archive (as written by :py:func:`redem.redem`) of
+    comments ``start`` to ``start + n`` and one submission per ten
+    comments, newest first
+
+    :param edit: snapshot number; every seventh item is edited in each
+        later snapshot (later ``edited`` timestamp and new text)
+    """
+    comments = []
+    for i in range(start, start + n):
+        data = make_comment_data(i, username=username)
+        _edit = edit if not i % 7 else 0
+        data['body'], data['body_html'] = make_body(i, _edit)
+        if _edit:
+            data['edited'] = data['created_utc'] + 60 * (_edit + 1)
+        comments.append(redem.raw_comment_to_dict(redem.RawThing(data)))
+    submissions = []
+    for i in range(start // 10, (start + n + 9) // 10):
+        data = make_submission_data(i, username=username)
+        if edit and data['selftext'] and not i % 7:
+            data['selftext'] += u' (edit %d)' % edit
+            data['edited'] = data['created_utc'] + 60 * (edit + 1)
+        submissions.append(
+            redem.raw_submission_to_dict(redem.RawThing(data)))
+    return OrderedDict((
+        ('_meta', OrderedDict((
+            ('username', username),
+            ('date_utc', '2013-09-%02dT05:20:00' % (24 + edit)),
+            ('synthetic', {'n': n, 'start': start, 'edit': edit})))),
+        ('comments', comments),
+        ('submissions', submissions)))
+
+
+def make_snapshots(n, count=3, overlap=0.5):
+    """
+    ``count`` overlapping synthetic backups of ``n`` comments each
+    (oldest first); consecutive backups share ``overlap`` of their items,
+    and later backups include edits (see :py:func:`make_archive`)
+    """
+    step = max(int(n * (1 - overlap)), 1)
+    return [make_archive(n, start=(count - 1 - k) * step, edit=k)
+            for k in range(count)]
+
+
+# trace the peak memory of each stage (one more, much slower, call)
+MEASURE_MEMORY = True
+
+
+def measure(func, *args, **kwargs):
+    """
+    :returns: dict of the best time of ``repeat`` calls and the peak
+        memory allocated during one (traced) call, and the return value
+    """
+    repeat = kwargs.pop('repeat', 3)
+    seconds, value = timeit(func, *args, repeat=repeat, **kwargs)
+    if not MEASURE_MEMORY:
+        return OrderedDict((('seconds', seconds), ('peak_bytes', None))), value
+    del value
+    tracemalloc.start()
+    try:
+        value = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return OrderedDict((('seconds', seconds), ('peak_bytes', peak))), value
+
+
+def bench_pipeline(n=1000, repeat=3):
+    """
+    time and memory of the offline stages over a synthetic archive of
+    ``n`` comments (and three overlapping backups for merging)
+    """
+    results = OrderedDict()
+
+    def record(name, count, func, *args, **kwargs):
+        result, value = measure(func, *args, repeat=repeat, **kwargs)
+        result['items'] = count
+        result['items_per_second'] = (
+            count / result['seconds'] if result['seconds'] else None)
+        results[name] = result
+        log.info("%-20s: %.3fs" % (name, result['seconds']))
+        return value
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshots = make_snapshots(n)
+        filenames = []
+        for k, snapshot in enumerate(snapshots):
+            filenames.append(os.path.join(tmpdir, 'snapshot%d.json' % k))
+            redem.dump(snapshot, filenames[-1])
+        data = snapshots[-1]
+        del snapshots
+        count = len(data['comments']) + len(data['submissions'])
+        filename = os.path.join(tmpdir, 'data.json')
+
+        record('dump', count, redem.dump, data, filename)
+        data = record('load', count, redem.load, filename=filename)
+        record('dump_ndjson', count, redem.dump,
+               data, os.path.join(tmpdir, 'data.ndjson'))
+        record('load_ndjson', count, redem.load,
+               filename=os.path.join(tmpdir, 'data.ndjson'))
+        archive = os.path.join(tmpdir, 'data.ndjson.gz')
+        record('dump_archive', count, redem.dump, data, archive)
+        record('load_archive', count, redem.load, filename=archive)
+        ids = [x['id'] for x in data['comments'][::max(count // 100, 1)]]
+        record('load_archive_ids', len(ids), redem.load,
+               filename=archive, ids=ids)
+        results['bytes'] = OrderedDict(
+            (os.path.basename(x), os.path.getsize(x)) for x in (
+                filename, os.path.join(tmpdir, 'data.ndjson'), archive,
+                archive + redem.ARCHIVE_INDEX_SUFFIX))
+        merged = record(
+            'merge_json_files', count * len(filenames),
+            redem.merge_json_files, filenames)
+        results['merge_json_files']['merged_items'] = sum(
+            len(merged[section]) for section in redem.SECTIONS)
+        del merged
+
+        uris = record(
+            'iter_all_uris', count,
+            lambda: [x.uri for x in redem.iter_all_uris(data)])
+
+        def canonicalize():
+            redem.reset_canonicalize_cache()
+            return [redem.canonicalize_uri(uri) for uri in uris]
+        record('canonicalize_uri', len(uris), canonicalize)
+        counts = record('process_urls', count, redem.process_urls, data)
+        record('prepare_context_data', count,
+               redem.prepare_context_data, data, uris=counts)
+        record('redem_summary', count,
+               redem.redem_summary, data, uris=counts)
+        record('write_redem_summary', count,
+               redem.write_redem_summary, data,
+               os.path.join(tmpdir, 'index.html'), uris=counts)
+    return results
+
+
+# imported on first use by redem.redem (not at startup)
+LAZY_MODULES = ('praw', 'bs4', 'rfc3987', 'urlobject', 'jinja2', 'lxml')
+
+
+def parse_importtime(output):
+    """
+    :param output: stderr of ``python -X importtime``
+    :returns: OrderedDict of module -> (self, cumulative) microseconds
+    """
+    modules = OrderedDict()
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _self, cumulative, module = line[len('import time:'):].split('|')
+        modules[module.strip()] = (int(_self), int(cumulative))
+    return modules
+
+
+def bench_imports(n=10, repeat=3, module='redem.redem'):
+    """
+    time ``import <module>`` in a new interpreter (``-X importtime``)
+
+    :param n: number of slowest modules (by self time) to report
+    """
+    code = (
+        'import sys, %s; '
+        'print(" ".join(x for x in %r if x in sys.modules))' % (
+            module, LAZY_MODULES))
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        elapsed = time.time() - start
+        modules = parse_importtime(process.stderr)
+        if best is None or modules[module][1] < best[1][module][1]:
+            best = (elapsed, modules, process.stdout.split())
+    elapsed, modules, imported = best
+    return OrderedDict((
+        ('module', module),
+        ('cumulative_us', modules[module][1]),
+        ('self_us', modules[module][0]),
+        ('wall_seconds', elapsed),
+        ('lazy_modules_imported', imported),
+        ('slowest', sorted(
+            ((name, us) for name, (us, _) in modules.items()),
+            key=lambda x: -x[1])[:n]),
+    ))
+
+
+# seconds the stand-in API waits before each response (see bench_fetch)
+FETCH_LATENCY = 0
+
+
+def bench_fetch(n=1000, repeat=3, latency=None):
+    """
+    back up ``n`` comments and ``n / 10`` submissions from a
+    :py:class:`redem.standin.StandinServer` (``raw`` engine, cold
+    metadata cache, no rate limit)
+
+    :param latency: seconds per response (default: ``FETCH_LATENCY``)
+    """
+    from redem import standin
+    if latency is None:
+        latency = FETCH_LATENCY
+    fixtures = standin.Fixtures.synthetic(comments=n, submissions=n // 10)
+    metadata = redem.METADATA
+    best = None
+    try:
+        for _ in range(repeat):
+            redem.METADATA = redem.MetadataCache()
+            server = standin.StandinServer(
+                fixtures=fixtures, latency=latency).start()
+            try:
+                start = time.time()
+                data = redem.redem('example', engine='raw', rate=None,
+                                   api_url=server.url)
+                elapsed = time.time() - start
+            finally:
+                server.stop()
+            if best is None or elapsed < best[0]:
+                best = (elapsed, dict(server.stats))
+    finally:
+        redem.METADATA = metadata
+    elapsed, stats = best
+    items = len(data['comments']) + len(data['submissions'])
+    per_1000 = 1000.0 / items if items else 0
+    return OrderedDict((
+        ('items', items),
+        ('latency', latency),
+        ('seconds', elapsed),
+        ('requests', stats.get('requests', 0)),
+        ('bytes', stats.get('bytes', 0)),
+        ('requests_per_1000', stats.get('requests', 0) * per_1000),
+        ('bytes_per_1000', stats.get('bytes', 0) * per_1000),
+        ('seconds_per_1000', elapsed * per_1000),
+    ))
+
+
+def bench_batch(n=1000, repeat=3, users=8, latency=None):
+    """
+    back up ``users`` users of ``n / users`` comments each from a
+    :py:class:`redem.standin.StandinServer`, one :py:func:`redem.redem`
+    call after another vs. one :py:func:`redem.redem_batch`
+
+    :param latency: seconds per response (default: ``FETCH_LATENCY``)
+    """
+    from redem import standin
+    if latency is None:
+        latency = FETCH_LATENCY
+    usernames = ['user%d' % k for k in range(users)]
+    fixtures = standin.Fixtures()
+    for username in usernames:
+        fixtures.add_synthetic(
+            username, comments=n // users, submissions=n // users // 10)
+    server = standin.StandinServer(fixtures=fixtures, latency=latency)
+    server.start()
+    metadata = redem.METADATA
+
+    def serial():
+        for username in usernames:
+            redem.METADATA = redem.MetadataCache()
+            redem.redem(username, engine='raw', rate=None,
+                        api_url=server.url)
+
+    def batch(tmpdir):
+        redem.METADATA = redem.MetadataCache()
+        return redem.redem_batch(
+            usernames, os.path.join(tmpdir, '{username}.data.json'),
+            rate=None, engine='raw', api_url=server.url)
+
+    results = OrderedDict((('users', users), ('latency', latency)))
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, func, args in (('serial', serial, ()),
+                                     ('batch', batch, (tmpdir,))):
+                server.stats.clear()
+                seconds, _ = timeit(func, *args, repeat=repeat)
+                results[name] = OrderedDict((
+                    ('seconds', seconds),
+                    ('requests', server.stats['requests'] // repeat)))
+                log.info("%-20s: %.3fs" % (name, seconds))
+    finally:
+        redem.METADATA = metadata
+        server.stop()
+    return results
+
+
+BENCHMARKS = OrderedDict((
+    ('to_dict', bench_to_dict),
+    ('uris', bench_uris),
+    ('canonicalize', bench_canonicalize),
+    ('records', bench_records),
+    ('imports', bench_imports),
+    ('pipeline', bench_pipeline),
+    ('fetch', bench_fetch),
+    ('batch', bench_batch),
+))
+
+
+def main(*args):
+    import optparse
+    import sys
+
+    prs = optparse.OptionParser(
+        usage=("%prog [-n <items> | --sizes <n,...>] [-o <results.json>]"
+               " [<benchmark> ...]\n"
+               "       %prog -n <items> --generate <archive.json>"))
+    prs.add_option(
+        '-n', '--items',
+        dest='items',
+        type='int',
+        action='store',
+        default=1000)
+    prs.add_option(
+        '-r', '--repeat',
+        dest='repeat',
+        type='int',
+        action='store',
+        default=3)
+    prs.add_option(
+        '-s', '--sizes',
+        dest='sizes',
+        action='store',
+        help='comma-separated numbers of items (instead of -n)')
+    prs.add_option(
+        '-o', '--output',
+        dest='output_filename',
+        action='store',
+        default=None)
+    prs.add_option(
+        '--no-memory',
+        dest='measure_memory',
+        action='store_false',
+        default=True,
+        help='do not trace peak memory (faster for large sizes)')
+    prs.add_option(
+        '--latency',
+        dest='latency',
+        type='float',
+        action='store',
+        default=0,
+        help='seconds per stand-in API response (fetch)')
+    prs.add_option(
+        '-g', '--generate',
+        dest='generate_filename',
+        action='store',
+        help='write a synthetic archive of -n comments')
+    prs.add_option(
+        '-v', '--verbose',
+        dest='verbose',
+        action='store_true')
+
+    args = args and list(args) or sys.argv[1:]
+    (opts, args) = prs.parse_args(args)
+    logging.basicConfig()
+    if opts.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    global MEASURE_MEMORY, FETCH_LATENCY
+    MEASURE_MEMORY = opts.measure_memory
+    FETCH_LATENCY = opts.latency
+
+    if opts.generate_filename:
+        redem.dump(make_archive(opts.items), opts.generate_filename)
+        return 0
+
+    sizes = None
+    if opts.sizes:
+        sizes = [int(x) for x in opts.sizes.split(',')]
+    results = OrderedDict()
+    for name in args or BENCHMARKS:
+        if sizes is None:
+            results[name] = BENCHMARKS[name](n=opts.items, repeat=opts.repeat)
+            continue
+        results[name] = OrderedDict()
+        for size in sizes:
+            log.info("%s: %d" % (name, size))
+            results[name][str(size)] = BENCHMARKS[name](
+                n=size, repeat=opts.repeat)
+    output = json.dumps(results, indent=2)
+    if opts.output_filename:
+        with open(opts.output_filename, 'w') as fp:
+            fp.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
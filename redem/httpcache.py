@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+"""
+redem.httpcache - listing-aware HTTP cache for reddit API sessions
+
+::
+
+    cache = HTTPCache('data/http_cache.sqlite').install(reddit.http)
+    ...
+    cache.report()
+    cache.close()
+
+Responses are cached by URL with a policy per endpoint (see
+``CACHE_POLICIES``): the first page of a user listing is where new items
+appear, so it is cached briefly and then revalidated (``If-None-Match``
+/ ``If-Modified-Since``); pages after it (``after=``) and ``/api/info``
+and ``/r/<name>/about`` metadata rarely change and are kept for days.
+The cache is capped at ``max_bytes`` (least recently used entries are
+evicted first) and the SQLite file is compacted (``VACUUM``) on close
+once enough of it is free pages.
+"""
+import json
+import logging
+import os.path
+import sqlite3
+import threading
+import time
+import unittest
+from collections import Counter, OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+from redem import redem
+
+log = logging.getLogger('redem.httpcache')
+
+HTTP_CACHE_FILE = os.path.join(redem.DATADIR, 'http_cache.sqlite')
+
+DAY = 60 * 60 * 24
+
+# policy: (seconds an entry is fresh (0: do not cache), revalidate
+# stale entries instead of refetching them)
+CACHE_POLICIES = OrderedDict((
+    ('listing_head', (5 * 60, True)),
+    ('listing_page', (7 * DAY, False)),
+    ('info', (30 * DAY, False)),
+    ('about', (30 * DAY, False)),
+    ('default', (60 * 60, True)),
+))
+
+MAX_BYTES = 256 * 1024 * 1024
+COMPACT_RATIO = 0.25  # VACUUM when this fraction of the file is free pages
+
+# not replayed from the cache (see redem.RateLimiter.hook)
+UNCACHED_HEADERS = ('x-ratelimit-used', 'x-ratelimit-remaining',
+                    'x-ratelimit-reset', 'set-cookie', 'content-encoding',
+                    'transfer-encoding', 'content-length')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    policy TEXT,
+    status INTEGER,
+    headers TEXT,
+    body BLOB,
+    size INTEGER,
+    created REAL,
+    accessed REAL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+def cache_policy(url):
+    """
+    :returns: the ``CACHE_POLICIES`` name for a request URL
+    """
+    endpoint = redem.RequestCounter.endpoint(url)
+    listings = ['/user/*/%s' % x for x in redem.LISTING_PATHS.values()]
+    if endpoint in listings:
+        if parse_qs(urlparse(url).query).get('after'):
+            return 'listing_page'
+        return 'listing_head'
+    # (endpoint keeps the fullnames of /by_id/<fullnames>)
+    if endpoint == '/api/info' or endpoint.startswith('/by_id/'):
+        return 'info'
+    if endpoint.startswith('/r/') and endpoint.endswith('/about'):
+        return 'about'
+    return 'default'
+
+
+class HTTPCache(object):
+    """
+    SQLite cache for the ``GET`` requests of a ``requests.Session``
+    (see :py:meth:`install`)
+
+    :param filename: SQLite file (``:memory:`` for a per-process cache)
+    :param policies: ``CACHE_POLICIES``
+    :param max_bytes: maximum size of the cached bodies
+    """
+    def __init__(self, filename=HTTP_CACHE_FILE, policies=CACHE_POLICIES,
+                 max_bytes=MAX_BYTES):
+        if filename != ':memory:':
+            filename = redem.expand_path(filename)
+        self.filename = filename
+        self.policies = policies
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        (size,) = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        self.size = size
+
+    def get(self, url):
+        """
+        :returns: (policy, status, headers, body, created) or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT policy, status, headers, body, created'
+                ' FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE responses SET accessed = ? WHERE url = ?',
+                    (time.time(), url))
+        policy, status, headers, body, created = row
+        return policy, status, json.loads(headers), body, created
+
+    def put(self, url, policy, response):
+        headers = dict(
+            (key, value) for key, value in response.headers.items()
+            if key.lower() not in UNCACHED_HEADERS)
+        body = response.content
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute(
+                'SELECT size FROM responses WHERE url = ?',
+                (url,)).fetchone()
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO responses (url, policy, status,'
+                    ' headers, body, size, created, accessed)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, policy, response.status_code, json.dumps(headers),
+                     body, len(body), now, now))
+            self.size += len(body) - (old[0] if old else 0)
+            self.stats['stored'] += 1
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def touch(self, url):
+        """
+        mark a (revalidated) entry as fresh again
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE responses SET created = ?, accessed = ? WHERE url = ?',
+                (now, now, url))
+
+    def evict(self, target=None):
+        """
+        delete least recently used entries until the cache is below
+        ``target`` bytes (default: 90% of ``max_bytes``)
+        """
+        if target is None:
+            target = self.max_bytes * 0.9
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT url, size FROM responses ORDER BY accessed')
+            evicted = []
+            size = self.size
+            for url, _size in rows:
+                if size <= target:
+                    break
+                evicted.append((url,))
+                size -= _size
+            rows.close()
+            with self.conn:
+                self.conn.executemany(
+                    'DELETE FROM responses WHERE url = ?', evicted)
+            self.size = size
+            self.stats['evicted'] += len(evicted)
+        return len(evicted)
+
+    def expire(self):
+        """
+        delete stale entries which cannot be revalidated
+
+        :returns: number of entries deleted
+        """
+        now = time.time()
+        count = 0
+        with self.lock, self.conn:
+            for policy, (ttl, revalidate) in self.policies.items():
+                if revalidate:
+                    continue
+                cursor = self.conn.execute(
+                    'DELETE FROM responses WHERE policy = ? AND created < ?',
+                    (policy, now - ttl))
+                count += cursor.rowcount
+            (self.size,) = self.conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        self.stats['expired'] += count
+        return count
+
+    def compact(self, ratio=COMPACT_RATIO):
+        """
+        ``VACUUM`` the SQLite file if more than ``ratio`` of its pages
+        are free
+
+        :returns: True if the file was compacted
+        """
+        with self.lock:
+            (pages,) = self.conn.execute('PRAGMA page_count').fetchone()
+            (free,) = self.conn.execute('PRAGMA freelist_count').fetchone()
+            if not pages or free / float(pages) <= ratio:
+                return False
+            log.info("compacting: %s (%d of %d pages free)" % (
+                self.filename, free, pages))
+            self.conn.execute('VACUUM')
+            self.stats['compacted'] += 1
+            return True
+
+    def close(self):
+        self.expire()
+        self.compact()
+        self.conn.close()
+
+    def cached_response(self, request, status, headers, body):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response.from_cache = True
+        return response
+
+    def send(self, send, request, **kwargs):
+        """
+        serve a request from the cache, revalidate it, or send it
+        (through ``send``) and cache the response
+        """
+        import requests
+        if request.method != 'GET':
+            return send(request, **kwargs)
+        url = request.url
+        policy = cache_policy(url)
+        ttl, revalidate = self.policies[policy]
+        if not ttl:
+            return send(request, **kwargs)
+        entry = self.get(url)
+        if entry is not None:
+            _, status, headers, body, created = entry
+            if time.time() - created < ttl:
+                self.stats['hits'] += 1
+                self.stats['bytes_saved'] += len(body)
+                response = self.cached_response(
+                    request, status, headers, body)
+                return requests.hooks.dispatch_hook(
+                    'response', request.hooks, response, **kwargs)
+            validators = dict(
+                (key.lower(), value) for key, value in headers.items())
+            if revalidate and (
+                    'etag' in validators or 'last-modified' in validators):
+                if 'etag' in validators:
+                    request.headers['If-None-Match'] = validators['etag']
+                if 'last-modified' in validators:
+                    request.headers['If-Modified-Since'] = (
+                        validators['last-modified'])
+                response = send(request, **kwargs)
+                if response.status_code == 304:
+                    self.touch(url)
+                    self.stats['revalidated'] += 1
+                    self.stats['bytes_saved'] += len(body)
+                    response._content = body
+                    response.status_code = status
+                    response.headers.update(headers)
+                    response.from_cache = True
+                    return response
+                self.stats['misses'] += 1
+                if response.status_code == 200:
+                    self.put(url, policy, response)
+                return response
+        self.stats['misses'] += 1
+        response = send(request, **kwargs)
+        if response.status_code == 200:
+            self.put(url, policy, response)
+        return response
+
+    def install(self, session):
+        """
+        cache the ``GET`` requests of a ``requests.Session`` (install
+        after :py:class:`redem.RateLimiter`, so that hits are not
+        rate limited)
+        """
+        send = session.send
+
+        def _send(request, **kwargs):
+            return self.send(send, request, **kwargs)
+        session.send = _send
+        return self
+
+    def report(self):
+        for key in ('hits', 'revalidated', 'misses', 'bytes_saved',
+                    'stored', 'evicted', 'expired', 'compacted'):
+            log.info("cache: %-20s %d" % (key, self.stats[key]))
+        log.info("cache: %-20s %d" % ('bytes', self.size))
+
+
+class Test_httpcache(unittest.TestCase):
+    def test_cache_policy(self):
+        url = 'https://www.reddit.com'
+        self.assertEqual(
+            cache_policy(url + '/user/example/comments.json?limit=100'),
+            'listing_head')
+        self.assertEqual(
+            cache_policy(url + '/user/example/submitted.json?after=t3_s1'),
+            'listing_page')
+        self.assertEqual(
+            cache_policy(url + '/api/info.json?id=t3_s1'), 'info')
+        self.assertEqual(
+            cache_policy(url + '/by_id/t3_s1,t3_s2.json'), 'info')
+        self.assertEqual(cache_policy(url + '/r/Python/about.json'), 'about')
+        self.assertEqual(cache_policy(url + '/user/example/about.json'),
+                         'default')
+
+    def test_http_cache(self):
+        import requests
+        from redem import standin
+        server = standin.StandinServer(
+            fixtures=standin.Fixtures.synthetic(comments=30, submissions=1))
+        server.start()
+        session = requests.Session()
+        requests_ = redem.RequestCounter().install(session)
+        policies = OrderedDict(CACHE_POLICIES)
+        cache = HTTPCache(':memory:', policies=policies).install(session)
+        head = server.url + '/user/example/comments.json?limit=10'
+        page = head + '&after=t1_c9'
+        try:
+            first = session.get(head).json()
+            self.assertEqual(session.get(head).json(), first)
+            session.get(page)
+            session.get(page)
+            self.assertEqual(cache.stats['hits'], 2)
+            self.assertEqual(cache.stats['misses'], 2)
+            self.assertEqual(server.stats['requests'], 2)
+            self.assertEqual(requests_['from_cache'], 2)
+
+            # stale first pages are revalidated (the stand-in sends ETags)
+            policies['listing_head'] = (-1, True)
+            response = session.get(head)
+            self.assertTrue(response.from_cache)
+            self.assertEqual(response.json(), first)
+            self.assertEqual(cache.stats['revalidated'], 1)
+            self.assertEqual(server.stats['not_modified'], 1)
+
+            size = cache.size
+            self.assertEqual(cache.evict(target=size - 1), 1)
+            self.assertLess(cache.size, size)
+            # the least recently used entry was the deep page
+            self.assertIsNone(cache.get(page))
+            self.assertIsNotNone(cache.get(head))
+            policies['info'] = (-1, False)
+            session.get(server.url + '/api/info.json?id=t3_s0')
+            self.assertEqual(cache.expire(), 1)
+        finally:
+            server.stop()
+            cache.close()
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+"""
+redem.linkcheck - check the status of the URIs in an archive
+
+::
+
+    redem --html --check-links -j data/merged_json.json -o index.html
+    python -m redem.linkcheck -j data/merged_json.json --per-host 2
+
+Every (canonical) ``http``/``https`` URI is probed with ``HEAD``
+(``GET`` if the server does not allow ``HEAD``), following redirects.
+Hosts are checked concurrently; each host has its own pooled session,
+at most ``per_host`` requests in flight and at least ``delay`` seconds
+(or the ``Crawl-delay`` of its ``robots.txt``) between requests. URIs
+disallowed by ``robots.txt``, and reddit links (``SKIP_DOMAINS``, which
+include the archive's own permalinks) are not probed.
+
+Results (status, final URL, latency) are cached in SQLite; links are
+only probed again once their result is older than ``LINK_TTL`` (or
+``ERROR_TTL`` for errors and 4xx/5xx statuses).
+"""
+import collections
+import concurrent.futures
+import logging
+import os.path
+import sqlite3
+import threading
+import time
+import unittest
+from collections import Counter, OrderedDict
+from urllib.parse import urlsplit
+
+from redem import redem
+
+log = logging.getLogger('redem.linkcheck')
+
+LINK_CACHE_FILE = os.path.join(redem.DATADIR, 'links.sqlite')
+
+LINK_TTL = 60 * 60 * 24 * 14
+ERROR_TTL = 60 * 60 * 24
+
+MAX_WORKERS = 16  # concurrent requests (across hosts)
+PER_HOST = 2  # concurrent requests per host
+DELAY = 1.0  # minimum seconds between requests to one host
+TIMEOUT = 10
+
+# servers which do not support HEAD (retried with GET)
+HEAD_NOT_ALLOWED = (403, 405, 501)
+
+# reddit answers 200 (or 429 past its rate limit) for every permalink
+SKIP_DOMAINS = ('reddit.com',)
+
+# the error of URIs left unchecked by a failed worker (not cached)
+NOT_CHECKED = 'not checked'
+
+LinkResult = collections.namedtuple(
+    'LinkResult', ('uri', 'status', 'final_url', 'latency', 'error',
+                   'checked'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    uri TEXT PRIMARY KEY,
+    status INTEGER,
+    final_url TEXT,
+    latency REAL,
+    error TEXT,
+    checked REAL
+);
+"""
+
+
+def is_ok(result):
+    return result.status is not None and result.status < 400
+
+
+class LinkCache(object):
+    """
+    link check results, keyed by URI
+    """
+    def __init__(self, filename=LINK_CACHE_FILE, ttl=LINK_TTL,
+                 error_ttl=ERROR_TTL):
+        if filename != ':memory:':
+            filename = redem.expand_path(filename)
+        self.filename = filename
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def is_fresh(self, result, now=None):
+        ttl = self.ttl if is_ok(result) else self.error_ttl
+        return (now or time.time()) - result.checked < ttl
+
+    def get(self, uri):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT uri, status, final_url, latency, error, checked'
+                ' FROM links WHERE uri = ?', (uri,)).fetchone()
+        return LinkResult(*row) if row else None
+
+    def put(self, result):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO links (uri, status, final_url,'
+                ' latency, error, checked) VALUES (?, ?, ?, ?, ?, ?)',
+                result)
+
+
+class Host(object):
+    """
+    a pooled session, the politeness delay and the ``robots.txt`` rules
+    for one scheme and netloc
+    """
+    def __init__(self, base_url, per_host=PER_HOST, delay=DELAY,
+                 user_agent=redem.__USER_AGENT__, timeout=TIMEOUT,
+                 robots=True):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.base_url = base_url
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.delay = delay
+        self.next_at = 0
+        self.lock = threading.Lock()
+        self.robots = None
+        if robots:
+            self.robots = self.read_robots()
+            if self.robots is not None:
+                crawl_delay = self.robots.crawl_delay(user_agent)
+                if crawl_delay:
+                    self.delay = max(self.delay, float(crawl_delay))
+
+    def read_robots(self):
+        """
+        :returns: ``urllib.robotparser.RobotFileParser`` (or None)
+        """
+        from urllib.robotparser import RobotFileParser
+        self.wait()
+        try:
+            response = self.session.get(
+                self.base_url + '/robots.txt', timeout=self.timeout)
+        except Exception as e:
+            log.debug("%s/robots.txt: %r" % (self.base_url, e))
+            return None
+        if response.status_code != 200:
+            return None
+        robots = RobotFileParser()
+        robots.parse(response.text.splitlines())
+        return robots
+
+    def wait(self):
+        """
+        sleep until ``delay`` seconds after the previous request
+        """
+        with self.lock:
+            now = time.time()
+            wait = max(self.next_at - now, 0)
+            self.next_at = max(self.next_at, now) + self.delay
+        if wait:
+            time.sleep(wait)
+
+    def check(self, uri):
+        """
+        :returns: :py:class:`LinkResult`
+        """
+        if self.robots is not None and not self.robots.can_fetch(
+                self.user_agent, uri):
+            return LinkResult(uri, None, None, None, 'robots.txt', time.time())
+        self.wait()
+        start = time.time()
+        try:
+            response = self.session.head(
+                uri, allow_redirects=True, timeout=self.timeout)
+            if response.status_code in HEAD_NOT_ALLOWED:
+                self.wait()
+                start = time.time()
+                response = self.session.get(
+                    uri, allow_redirects=True, timeout=self.timeout,
+                    stream=True)
+                response.close()
+        except Exception as e:
+            return error_result(uri, e, time.time() - start)
+        return LinkResult(uri, response.status_code, response.url,
+                          time.time() - start, None, time.time())
+
+
+def error_result(uri, error, latency=None):
+    """
+    :param error: an exception (recorded by class name) or a string
+    """
+    if not isinstance(error, str):
+        error = error.__class__.__name__
+    return LinkResult(uri, None, None, latency, error, time.time())
+
+
+def is_in_domains(hostname, domains):
+    return any(hostname == x or (hostname or '').endswith('.' + x)
+               for x in domains)
+
+
+def host_url(uri):
+    parts = urlsplit(uri)
+    return '%s://%s' % (parts.scheme, parts.netloc.lower())
+
+
+def check_links(uris, cache=None, max_workers=MAX_WORKERS, per_host=PER_HOST,
+                delay=DELAY, timeout=TIMEOUT, robots=True, force=False,
+                skip_domains=SKIP_DOMAINS):
+    """
+    check every ``http``/``https`` URI which has no fresh result in
+    ``cache`` and is not in ``skip_domains``
+
+    :param uris: iterable of URIs (e.g. from :py:func:`redem.process_urls`)
+    :param cache: :py:class:`LinkCache` (default: in memory)
+    :param max_workers: concurrent requests (across hosts)
+    :param per_host: concurrent requests per host
+    :param delay: minimum seconds between requests to one host
+    :param force: check every URI (ignore cached results)
+    :param skip_domains: domains (and their subdomains) not to check
+    :returns: OrderedDict of URI -> :py:class:`LinkResult` (with the
+        error ``NOT_CHECKED`` for URIs a failed worker did not check)
+    """
+    if cache is None:
+        cache = LinkCache(':memory:')
+    results = OrderedDict()
+    hosts = OrderedDict()
+    stats = Counter()
+    now = time.time()
+    for uri in uris:
+        if uri in results:
+            continue
+        try:
+            parts = urlsplit(uri)
+            if parts.scheme not in ('http', 'https'):
+                continue
+            if is_in_domains(parts.hostname, skip_domains):
+                stats['skipped'] += 1
+                continue
+            base_url = host_url(uri)
+        except ValueError as e:  # (e.g. a malformed IPv6 netloc)
+            results[uri] = error_result(uri, e)
+            continue
+        result = None if force else cache.get(uri)
+        if result is not None and cache.is_fresh(result, now):
+            results[uri] = result
+            stats['cached'] += 1
+            continue
+        results[uri] = None
+        hosts.setdefault(base_url, collections.deque()).append(uri)
+
+    def get_host(base_url):
+        with locks[base_url]:
+            # robots.txt is read once, by the first worker for the host
+            host = sessions.get(base_url)
+            if host is None:
+                host = sessions[base_url] = Host(
+                    base_url, per_host=per_host, delay=delay,
+                    timeout=timeout, robots=robots)
+            return host
+
+    def check_queue(base_url, queue):
+        # errors are results (of one URI, or of every URI of a host
+        # without a session), so that one host cannot abort the run
+        try:
+            host, error = get_host(base_url), None
+        except Exception as e:
+            log.warning("%s: %r" % (base_url, e))
+            host, error = None, e
+        while True:
+            try:
+                uri = queue.popleft()
+            except IndexError:
+                return
+            if host is None:
+                result = error_result(uri, error)
+            else:
+                try:
+                    result = host.check(uri)
+                except Exception as e:
+                    log.warning("%s: %r" % (uri, e))
+                    result = error_result(uri, e)
+            log.debug("%s %s" % (result.status or result.error, uri))
+            results[uri] = result
+            cache.put(result)
+
+    # at most per_host workers for each host, submitted round robin so
+    # that every host is started before any host gets a second worker
+    queues = list(hosts.items())
+    sessions = {}
+    locks = dict((base_url, threading.Lock()) for base_url in hosts)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as pool:
+        futures = [pool.submit(check_queue, base_url, queue)
+                   for n in range(per_host)
+                   for base_url, queue in queues if n < len(queue)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                log.error("links: %r" % e)
+    for host in sessions.values():
+        host.session.close()
+    for uri, result in results.items():
+        if result is None:  # (e.g. after a cache error)
+            results[uri] = error_result(uri, NOT_CHECKED)
+    for result in results.values():
+        if result.checked >= now:
+            stats['checked'] += 1
+            stats[str(result.status or result.error)] += 1
+    log.info("links: %d hosts, %s" % (len(hosts), ', '.join(
+        '%s: %d' % x for x in sorted(stats.items()))))
+    return results
+
+
+def main(*args):
+    import optparse
+    import sys
+
+    prs = optparse.OptionParser(
+        usage=("%prog -j <data.json> [--per-host <n>] [--delay <seconds>]"
+               " [--check-reddit]"))
+    prs.add_option(
+        '-j', '--json',
+        dest='json_filename',
+        action='store')
+    prs.add_option(
+        '--link-cache',
+        dest='link_cache',
+        action='store',
+        default=LINK_CACHE_FILE)
+    prs.add_option(
+        '-w', '--workers',
+        dest='workers',
+        type='int',
+        action='store',
+        default=MAX_WORKERS)
+    prs.add_option(
+        '--per-host',
+        dest='per_host',
+        type='int',
+        action='store',
+        default=PER_HOST)
+    prs.add_option(
+        '--delay',
+        dest='delay',
+        type='float',
+        action='store',
+        default=DELAY)
+    prs.add_option(
+        '--force',
+        dest='force',
+        action='store_true')
+    prs.add_option(
+        '--check-reddit',
+        dest='check_reddit',
+        action='store_true')
+    prs.add_option(
+        '-v', '--verbose',
+        dest='verbose',
+        action='store_true')
+
+    args = args and list(args) or sys.argv[1:]
+    (opts, args) = prs.parse_args(args)
+    logging.basicConfig()
+    logging.getLogger().setLevel(
+        logging.DEBUG if opts.verbose else logging.INFO)
+    if not opts.json_filename:
+        prs.error("-j/--json is required")
+
+    uris = redem.process_urls(redem.load(filename=opts.json_filename))
+    cache = LinkCache(opts.link_cache)
+    results = check_links(
+        [uri for uri, _ in uris], cache=cache, max_workers=opts.workers,
+        per_host=opts.per_host, delay=opts.delay, force=opts.force,
+        skip_domains=() if opts.check_reddit else SKIP_DOMAINS)
+    cache.close()
+    not_checked = 0
+    for uri, result in results.items():
+        if result.error == NOT_CHECKED:
+            not_checked += 1
+        if not is_ok(result):
+            print(u'%s\t%s' % (result.status or result.error, uri))
+    if not_checked:
+        log.error("%d links were not checked" % not_checked)
+        return 1
+    return 0
+
+
+class Test_linkcheck(unittest.TestCase):
+    def setUp(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            requests = Counter()
+            connections = set()
+            active = Counter()
+            max_active = Counter()
+            lock = threading.Lock()
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                with self.lock:
+                    self.requests[self.path] += 1
+                    self.connections.add(self.client_address)
+                    self.active['all'] += 1
+                    self.max_active['all'] = max(
+                        self.max_active['all'], self.active['all'])
+                try:
+                    time.sleep(0.02)
+                    status, headers, content = 200, [], b'ok'
+                    if self.path == '/robots.txt':
+                        content = b'User-agent: *\nDisallow: /private\n'
+                    elif self.path.startswith('/missing'):
+                        status = 404
+                    elif self.path == '/moved':
+                        status, headers = 301, [('Location', '/page/0')]
+                    elif self.path == '/no-head' and not body:
+                        status = 405
+                    self.send_response(status)
+                    for header in headers:
+                        self.send_header(*header)
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    if body:
+                        self.wfile.write(content)
+                finally:
+                    with self.lock:
+                        self.active['all'] -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        self.handler = Handler
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_check_links(self):
+        uris = ([self.url + '/page/%d' % n for n in range(10)] +
+                [self.url + x for x in (
+                    '/missing', '/moved', '/no-head', '/private/1')] +
+                ['mailto:someone@example.org',
+                 redem.REDDIT_URL + '/r/Python/comments/s1/_/c1',
+                 'https://old.reddit.com/r/Python/'])
+        cache = LinkCache(':memory:')
+        results = check_links(uris, cache=cache, per_host=2, delay=0)
+        self.assertEqual(list(results), uris[:14])
+        self.assertEqual(results[self.url + '/page/3'].status, 200)
+        self.assertEqual(results[self.url + '/missing'].status, 404)
+        moved = results[self.url + '/moved']
+        self.assertEqual((moved.status, moved.final_url),
+                         (200, self.url + '/page/0'))
+        self.assertEqual(results[self.url + '/no-head'].status, 200)
+        self.assertEqual(results[self.url + '/private/1'].error, 'robots.txt')
+        self.assertNotIn('/private/1', self.handler.requests)
+        self.assertLessEqual(self.handler.max_active['all'], 2)
+        self.assertLessEqual(len(self.handler.connections), 2)
+
+        # fresh results are not checked again; errors expire sooner
+        self.handler.requests.clear()
+        results = check_links(uris, cache=cache, delay=0)
+        self.assertEqual(sum(self.handler.requests.values()), 0)
+        self.assertEqual(results[self.url + '/page/3'].status, 200)
+        cache.error_ttl = 0
+        check_links(uris, cache=cache, delay=0)
+        self.assertEqual(
+            sorted(self.handler.requests),
+            ['/missing', '/robots.txt'])
+
+    def test_uri_table(self):
+        import shutil
+        import tempfile
+        data = {'_meta': {'username': 'example'}, 'submissions': [
+            {'id': 's1', 'created_utc': 1388534400, 'edited': False,
+             'title': 'title', 'url': self.url + '/missing',
+             'subreddit': 'Python', 'permalink': self.url + '/s1'}],
+            'comments': [
+            {'id': 'c1', 'created_utc': 1388534400, 'edited': False,
+             'link_title': 'title', 'subreddit': 'Python',
+             'body': self.url + '/moved',
+             'body_html': '<p><a href="%s/moved">moved</a></p>' % self.url,
+             'permalink': self.url + '/c1'}]}
+        uris = redem.process_urls(data, processes=1)
+        links = check_links([uri for uri, _ in uris], delay=0)
+        output = redem.redem_summary(data, uris=uris, links=links)
+        self.assertIn('>404</td>', output)
+        self.assertIn('&rarr; <a href="%s/page/0">' % self.url, output)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filenames = redem.redem_shards(
+            data, tmpdir, processes=1, uris=uris, links=links)
+        self.assertEqual(os.path.basename(filenames[0]), redem.SHARD_INDEX)
+        # the index is only rendered again when a status changes
+        links = check_links([uri for uri, _ in uris], delay=0)
+        self.assertEqual(redem.redem_shards(
+            data, tmpdir, processes=1, uris=uris, links=links), [])
+        links[self.url + '/missing'] = links[self.url + '/missing']._replace(
+            status=200)
+        self.assertEqual(
+            [os.path.basename(x) for x in redem.redem_shards(
+                data, tmpdir, processes=1, uris=uris, links=links)],
+            [redem.SHARD_INDEX])
+
+    def test_errors(self):
+        from unittest import mock
+        read_robots = Host.read_robots
+
+        def fail_localhost(host):
+            if 'localhost' in host.base_url:
+                raise RuntimeError('robots.txt')
+            return read_robots(host)
+        other = self.url.replace('127.0.0.1', 'localhost')
+        uris = [self.url + '/page/1', other + '/page/1', other + '/page/2',
+                'http://[::1/page']
+        cache = LinkCache(':memory:')
+        with mock.patch.object(Host, 'read_robots', fail_localhost):
+            results = check_links(uris, cache=cache, delay=0)
+        self.assertEqual(results[self.url + '/page/1'].status, 200)
+        self.assertEqual(
+            [results[x].error for x in uris[1:]],
+            ['RuntimeError', 'RuntimeError', 'ValueError'])
+        self.assertEqual(cache.get(self.url + '/page/1').status, 200)
+        self.assertEqual(cache.get(other + '/page/2').error, 'RuntimeError')
+
+        # a failed worker leaves the rest of its queue unchecked
+        def fail_put(result):
+            raise sqlite3.OperationalError('database is locked')
+        uris = [self.url + '/queue/%d' % n for n in range(3)]
+        with mock.patch.object(cache, 'put', fail_put):
+            results = check_links(uris, cache=cache, per_host=1, delay=0)
+        self.assertEqual([x.error for x in results.values()],
+                         [None, NOT_CHECKED, NOT_CHECKED])
+
+    def test_delay(self):
+        uris = [self.url + '/page/%d' % n for n in range(4)]
+        start = time.time()
+        check_links(uris, per_host=4, delay=0.1, robots=False)
+        # 4 requests at least 0.1s apart
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
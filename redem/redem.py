@@ -11,28 +11,41 @@ https://github.com/reddit/reddit/wiki/API
 """
 import codecs
 import collections
+import collections.abc
+import concurrent.futures
 import datetime
+import functools
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
 import os.path
+import re
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from urllib.parse import urlparse
+from html.entities import name2codepoint
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
 from collections import Counter, OrderedDict
 from operator import attrgetter, itemgetter
 
-import bs4
-import praw
-import rfc3987
-import urlobject
-from jinja2 import Markup, Environment, PackageLoader
+# praw, bs4, rfc3987, urlobject and jinja2 are imported where they are
+# used, so that e.g. ``--merge`` does not pay for them at startup
+# (see ``python -m redem.bench imports``)
 
 __APPNAME__ = "redem"
 __VERSION__ = "0.1.2"
 __USER_AGENT__ = '%s (praw)\%s' % (__APPNAME__, __VERSION__)
 
-uri_rgx = rfc3987.get_compiled_pattern('URI')  # URI_reference
 log = logging.getLogger('%s.cli' % __APPNAME__)
 
+DATADIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+
 SUBMISSION_ATTRS = (
     'id',
     #'author',
@@ -67,44 +80,432 @@ COMMENT_ATTRS = (
     #'permalink', # really slow
     )
 
-_SUBREDDIT_URLS = {}
+
+class MetadataCache(OrderedDict):
+    """
+    persistent subreddit (``t5_``) and submission (``t3_``) metadata,
+    keyed by fullname
+
+    Entries older than ``ttl`` seconds are treated as misses; when there
+    are more than ``maxsize`` entries, the least recently used are evicted.
+    Misses are resolved in bulk through ``/api/info``
+    (see :py:meth:`resolve`).
+
+    ::
+
+        {"t5_2qh0y": {"_ts": 1380000000.0,
+                      "display_name": "Python", "url": "/r/Python/"}}
+
+    """
+    TTL = 60 * 60 * 24 * 30
+    MAXSIZE = 100000
+
+    def __init__(self, filename=None, ttl=TTL, maxsize=MAXSIZE):
+        super(MetadataCache, self).__init__()
+        self.filename = filename
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def load(self, filename=None):
+        filename = filename or self.filename
+        if filename and os.path.exists(filename):
+            try:
+                with codecs.open(filename, 'r', encoding='utf-8') as fp:
+                    self.update(json.load(fp, object_pairs_hook=OrderedDict))
+            except ValueError as e:
+                log.warning("%s: %s (ignored)" % (filename, e))
+            self.expire()
+        return self
+
+    def save(self, filename=None):
+        """
+        write the cache to ``filename + '.tmp'`` and rename it, creating
+        the directory if needed
+
+        Errors are logged, not raised: a cache that cannot be written must
+        not lose the data fetched with it.
+
+        :returns: True if the cache was written
+        """
+        filename = filename or self.filename
+        if filename is None:
+            return False
+        self.evict()
+        tmp_filename = filename + '.tmp'
+        try:
+            dirname = os.path.dirname(filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with self.lock:
+                with codecs.open(tmp_filename, 'w', encoding='utf-8') as fp:
+                    json.dump(self, fp)
+            os.replace(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            log.warning("%s: %s" % (filename, e))
+            return False
+        return True
+
+    def expire(self, now=None):
+        cutoff = (now or time.time()) - self.ttl
+        for key in [k for k, v in self.items() if v['_ts'] < cutoff]:
+            del self[key]
+
+    def evict(self):
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def lookup(self, fullname, field):
+        with self.lock:
+            entry = super(MetadataCache, self).get(fullname)
+            if entry is None or entry['_ts'] < time.time() - self.ttl:
+                return None
+            self.move_to_end(fullname)
+            return entry.get(field)
+
+    def store(self, fullname, **fields):
+        with self.lock:
+            entry = self.setdefault(fullname, {})
+            entry.update(fields)
+            entry['_ts'] = time.time()
+            self.move_to_end(fullname)
+            return entry
+
+    def store_thing(self, thing):
+        fullname = thing.fullname
+        if fullname.startswith('t5_'):
+            return self.store(
+                fullname, display_name=thing.display_name, url=thing.url)
+        elif fullname.startswith('t3_'):
+            # praw permalinks are absolute, listing JSON permalinks are not
+            return self.store(
+                fullname, permalink=urljoin(REDDIT_URL, thing.permalink),
+                url=thing.url)
+
+    def missing(self, fullnames, field):
+        return [f for f in OrderedDict.fromkeys(fullnames)
+                if self.lookup(f, field) is None]
+
+    def resolve(self, reddit, fullnames, field):
+        """
+        fetch every fullname without a cached ``field``
+
+        :returns: number of things fetched
+        """
+        count = 0
+        for thing in get_info(reddit, self.missing(fullnames, field)):
+            self.store_thing(thing)
+            count += 1
+        self.misses += count
+        return count
+
+
+# (not *data*.json: the Makefile merges every file matching that)
+METADATA_FILE = os.path.join(DATADIR, 'subreddit_cache.json')
+METADATA = MetadataCache(METADATA_FILE)
 
 
 def get_subreddit_url(subreddit, subreddit_id):
-    url = _SUBREDDIT_URLS.setdefault(subreddit_id, subreddit.url)
+    url = METADATA.lookup(subreddit_id, 'url')
+    if url is None:
+        url = METADATA.store(
+            subreddit_id,
+            url=u'/r/%s/' % get_subreddit_name(subreddit, subreddit_id))['url']
     return url
 
-_SUBREDDIT_NAMES = {}
-
 
 def get_subreddit_name(subreddit, subreddit_id):
-    name = _SUBREDDIT_NAMES.setdefault(subreddit_id, subreddit.display_name)
+    name = METADATA.lookup(subreddit_id, 'display_name')
+    if name is None:
+        name = METADATA.store(
+            subreddit_id, display_name=subreddit.display_name)['display_name']
     return name
 
-_SUBMISSION_URLS = {}
-
 
 def get_submission_url(submission):
-    url = _SUBMISSION_URLS.setdefault(submission.id, submission.url)
+    url = METADATA.lookup('t3_' + submission.id, 'url')
+    if url is None:
+        url = METADATA.store(
+            't3_' + submission.id, url=submission.url)['url']
     return url
 
-_SUBMISSION_PERMALINKS = {}
-
 
 def get_submission_permalink(submission):
-    url = _SUBMISSION_PERMALINKS.setdefault(
-        submission.id,
-        submission.permalink)
+    url = METADATA.lookup('t3_' + submission.id, 'permalink')
+    if url is None:
+        url = METADATA.store(
+            't3_' + submission.id,
+            permalink=submission.permalink)['permalink']
     return url
 
 
+REDDIT_URL = 'http://www.reddit.com'
+
+
+def fullname_to_id(fullname):
+    """
+    strip the type prefix from a reddit fullname (``t3_abc`` -> ``abc``)
+    """
+    return fullname.split('_', 1)[-1]
+
+
+def build_comment_permalink(link_id, subreddit, comment_id):
+    """
+    build the canonical comment permalink
+    (``/r/<subreddit>/comments/<submission id>/_/<comment id>``)
+
+    The title slug of the submission permalink is not needed (reddit
+    resolves ``_``) and is never used, so that a comment always has the
+    same permalink.
+
+    :param link_id: fullname of the parent submission (``t3_abc``)
+    :param subreddit: subreddit name
+    :param comment_id: comment id
+    """
+    return (
+        u"{0}/r/{1}/comments/{2}/_/{3}".format(
+            REDDIT_URL, subreddit, fullname_to_id(link_id), comment_id))
+
+
 def comment_permalink(comment):
-    return os.path.join(
-        get_submission_permalink(comment.submission),
+    """
+    build a comment permalink from data already in the comment listing
+
+    ``comment.submission`` is not touched (that costs a request per
+    comment); the permalink is derived from ``subreddit``, ``link_id``
+    and ``id`` (see :py:func:`build_comment_permalink`).
+    """
+    return build_comment_permalink(
+        comment.link_id,
+        get_subreddit_name(comment.subreddit, comment.subreddit_id),
         comment.id)
-    #return (
-    #u"http://reddit.com/r/{subreddit}/comments/{link_id}/{_link_title}/{id}".
-    #format(**comment))
+
+
+def iter_chunks(iterable, size=100):
+    """
+    yield lists of (at most) ``size`` items from ``iterable``
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+INFO_CHUNKSIZE = 100  # max fullnames per /api/info request
+
+
+def get_info(reddit, fullnames):
+    """
+    fetch things from ``/api/info`` (``INFO_CHUNKSIZE`` fullnames per request)
+
+    :param reddit: ``praw.Reddit`` session
+    :param fullnames: iterable of fullnames (``t3_abc``, ``t5_xyz``)
+    :returns: iterator of praw objects
+    """
+    for chunk in iter_chunks(fullnames, INFO_CHUNKSIZE):
+        things = reddit.get_info(thing_id=chunk)
+        if not isinstance(things, list):
+            things = [things]
+        for thing in things:
+            if thing is not None:
+                yield thing
+
+
+def hydrate(reddit, things):
+    """
+    bulk-load the names of the subreddits of ``things`` (comments and/or
+    submissions) which are not in the listing or in ``METADATA``
+
+    :returns: number of things fetched
+    """
+    # subreddit names are usually in the listing already
+    subreddit_ids = [t.subreddit_id for t in things if not t.subreddit]
+    return METADATA.resolve(reddit, subreddit_ids, 'display_name')
+
+
+class RequestCounter(Counter):
+    """
+    count the HTTP requests issued through a ``requests.Session``
+    (e.g. ``praw.Reddit.http``), by endpoint
+    """
+    def install(self, session):
+        self.lock = threading.Lock()
+        session.hooks.setdefault('response', []).append(self.hook)
+        return self
+
+    @staticmethod
+    def endpoint(url):
+        path = urlparse(url).path.rstrip('/')
+        if path.endswith('.json'):
+            path = path[:-5]
+        parts = path.split('/')
+        if len(parts) > 3 and parts[1] == 'user':
+            return '/user/*/%s' % parts[3]
+        if len(parts) > 2 and parts[1] == 'r':
+            return '/r/*/%s' % '/'.join(parts[3:])
+        return path
+
+    def hook(self, response, *args, **kwargs):
+        with self.lock:
+            self['total'] += 1
+            if getattr(response, 'from_cache', False):
+                self['from_cache'] += 1
+            self[self.endpoint(response.url)] += 1
+        return response
+
+    def report(self):
+        for key, count in sorted(self.items()):
+            log.info("requests: %-24s %d" % (key, count))
+
+
+API_RATE = 0.5  # requests per second (30 per minute)
+
+
+class RateLimiter(object):
+    """
+    token bucket shared by every thread issuing requests through a session
+
+    Responses with ``X-Ratelimit-Remaining: 0`` also pause every thread
+    until ``X-Ratelimit-Reset`` (requests already in flight are not
+    recalled).
+
+    :param rate: tokens (requests) added per second (None: no limit
+        other than the rate-limit headers)
+    :param burst: maximum number of tokens
+    """
+    def __init__(self, rate=API_RATE, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        take a token, sleeping until it is available
+
+        :returns: seconds waited
+        """
+        with self.lock:
+            now = time.time()
+            wait = 0
+            if self.rate:
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            wait = max(wait, self.resume_at - now)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def hook(self, response, *args, **kwargs):
+        remaining = response.headers.get('X-Ratelimit-Remaining')
+        reset = response.headers.get('X-Ratelimit-Reset')
+        if remaining is not None and reset is not None:
+            if float(remaining) < 1:
+                log.debug("rate limited: pausing %ss" % reset)
+                with self.lock:
+                    self.resume_at = max(
+                        self.resume_at, time.time() + float(reset))
+        return response
+
+    def install(self, session):
+        send = session.send
+
+        def _send(request, **kwargs):
+            self.acquire()
+            return send(request, **kwargs)
+        session.send = _send
+        session.hooks.setdefault('response', []).append(self.hook)
+        return self
+
+
+_html_entity_rgx = re.compile('&([^;]+);')
+
+
+def _decode_html_entity(match):
+    codepoint = name2codepoint.get(match.group(1))
+    return chr(codepoint) if codepoint else match.group(0)
+
+
+def decode_html_entities(value):
+    """
+    decode the named HTML entities (``&amp;``, ``&lt;``, ...) in every
+    string of a parsed API response, in place
+
+    praw (``config.decode_html_entities``) decodes them once, in the whole
+    response text, so this is done once per response as well (in
+    :py:meth:`APIClient.request_json`), not per field.
+    """
+    if isinstance(value, str):
+        if '&' in value:
+            return _html_entity_rgx.sub(_decode_html_entity, value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = decode_html_entities(item)
+    elif isinstance(value, list):
+        value[:] = [decode_html_entities(item) for item in value]
+    return value
+
+
+class APIConfig(object):
+    """
+    the ``praw.Reddit.config`` settings read by the ``raw`` engine
+    """
+    def __init__(self, api_url=REDDIT_URL):
+        self.api_url = api_url.rstrip('/')
+        self.decode_html_entities = True
+        self.api_request_delay = 0
+
+
+class APIClient(object):
+    """
+    the subset of a ``praw.Reddit`` session used by the ``raw`` engine
+    (:py:func:`iter_raw_listing` and :py:func:`hydrate`), for any
+    ``api_url`` (praw always uses https://www.reddit.com)
+
+    :param api_url: base URL (e.g. of a :py:mod:`redem.standin` server)
+    """
+    TIMEOUT = 30
+
+    def __init__(self, api_url=REDDIT_URL, user_agent=__USER_AGENT__,
+                 session=None):
+        import requests
+        self.config = APIConfig(api_url)
+        self.http = session or requests.Session()
+        self.http.headers['User-Agent'] = user_agent
+
+    def login(self, username=None):
+        """
+        listings and ``/api/info`` are public (nothing to do)
+        """
+
+    def request_json(self, url, params=None, as_objects=False):
+        response = self.http.get(url, params=params, timeout=self.TIMEOUT)
+        response.raise_for_status()
+        if self.config.decode_html_entities:
+            return decode_html_entities(response.json())
+        return response.json()
+
+    def get_info(self, thing_id):
+        """
+        :param thing_id: list of fullnames
+        :returns: list of :py:class:`RawThing`
+        """
+        page = self.request_json(
+            self.config.api_url + '/api/info.json',
+            params={'id': ','.join(thing_id)})
+        return [RawThing(child['data']) for child in page['data']['children']]
+
 
 _get_comment_attrs = attrgetter(*COMMENT_ATTRS)
 
@@ -133,28 +534,228 @@ def submission_to_dict(submission):
     return _sub
 
 
-def iter_comments(user, limit=None, pagesize=None):
-    comments = user.get_comments(limit=pagesize)
-    for i, comment in enumerate(comments):
+def iter_listing(listing, limit=None, since=None):
+    """
+    iterate over a (newest first) listing, fetching pages lazily
+
+    :param limit: stop after ``limit`` items
+    :param since: stop at the first item created before this ``created_utc``
+        (so that no further pages are requested)
+    """
+    for i, thing in enumerate(listing):
         if limit and i >= limit:
             break
-        yield comment
+        if since is not None and thing.created_utc < since:
+            log.debug("stopping at %r (created_utc < %r)" % (
+                thing.id, since))
+            break
+        yield thing
 
 
-def iter_submissions(user, limit=None, pagesize=None):
-    submissions = user.get_submitted(limit=pagesize)
-    for i, submission in enumerate(submissions):
-        if limit and i >= limit:
-            break
-        yield submission
+def listing_params(after=None):
+    """
+    :param after: fullname to continue a listing after (e.g. when resuming)
+    """
+    return {'after': after} if after else {}
 
 
-def iter_liked(user, limit=None, pagesize=None):
-    likeds = user.get_liked(limit=pagesize)
-    for i, liked in enumerate(likeds):
-        if limit and i >= limit:
+def iter_comments(user, limit=None, pagesize=None, since=None, after=None):
+    comments = user.get_comments(limit=pagesize, params=listing_params(after))
+    return iter_listing(comments, limit=limit, since=since)
+
+
+def iter_comment_dicts(reddit, comments, chunksize=INFO_CHUNKSIZE):
+    """
+    convert comments to dicts a page at a time, first hydrating the
+    subreddits of each page through ``/api/info`` (see :py:func:`hydrate`)
+
+    :returns: iterator of comment dicts
+    """
+    for chunk in iter_chunks(comments, chunksize):
+        hydrate(reddit, chunk)
+        for comment in chunk:
+            yield comment_to_dict(comment)
+
+
+def iter_submission_dicts(reddit, submissions, chunksize=INFO_CHUNKSIZE):
+    """
+    convert submissions to dicts a page at a time (see
+    :py:func:`iter_comment_dicts`)
+    """
+    for chunk in iter_chunks(submissions, chunksize):
+        hydrate(reddit, chunk)
+        for submission in chunk:
+            yield submission_to_dict(submission)
+
+
+def fetch_listing(reddit, name, things, to_dicts, pagesize=INFO_CHUNKSIZE,
+                  writer=None):
+    """
+    convert a listing to a list of dicts, logging progress every page
+
+    :param things: iterator of praw objects (e.g. :py:func:`iter_comments`)
+    :param to_dicts: e.g. :py:func:`iter_comment_dicts`
+    :param writer: :py:class:`NDJSONWriter` to stream items to
+        (and checkpoint every page) instead of returning them
+    :returns: list of dicts (empty when streaming to ``writer``)
+    """
+    start = time.time()
+    items = []
+    count = 0
+    for item in to_dicts(reddit, things):
+        count += 1
+        if writer is None:
+            items.append(item)
+        else:
+            writer.write(name, item)
+        if not count % pagesize:
+            if writer is not None:
+                writer.commit()
+            log.info("%-14s: %d (%.1fs)" % (
+                name, count, time.time() - start))
+    if writer is not None:
+        writer.done(name)
+    log.info("%-14s: %d items in %.1fs" % (
+        name, count, time.time() - start))
+    return items
+
+
+def fetch_listings(reddit, listings, max_workers=None, writer=None):
+    """
+    fetch listings concurrently
+
+    :param listings: OrderedDict of name -> (things, to_dicts)
+    :param writer: :py:class:`NDJSONWriter` (see :py:func:`fetch_listing`)
+    :returns: OrderedDict of name -> list of dicts
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(listings) or 1) as pool:
+        futures = OrderedDict(
+            (name, pool.submit(
+                fetch_listing, reddit, name, things, to_dicts,
+                writer=writer))
+            for name, (things, to_dicts) in listings.items())
+        return OrderedDict(
+            (name, future.result()) for name, future in futures.items())
+
+
+def iter_submissions(user, limit=None, pagesize=None, since=None,
+                     after=None):
+    submissions = user.get_submitted(
+        limit=pagesize, params=listing_params(after))
+    return iter_listing(submissions, limit=limit, since=since)
+
+
+def iter_liked(user, limit=None, pagesize=None, since=None, after=None):
+    likeds = user.get_liked(limit=pagesize, params=listing_params(after))
+    return iter_listing(likeds, limit=limit, since=since)
+
+
+class RawThing(dict):
+    """
+    the ``data`` of a thing from a listing page, with attribute access
+    (for :py:func:`iter_listing` and :py:func:`hydrate`)
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def fullname(self):
+        return self['name']
+
+
+LISTING_PATHS = {
+    'comments': 'comments',
+    'submissions': 'submitted',
+    'liked': 'liked',
+}
+
+
+def iter_raw_listing(reddit, username, section, pagesize=INFO_CHUNKSIZE,
+                     after=None):
+    """
+    iterate over a user listing without constructing praw objects
+
+    :param section: ``comments``, ``submissions`` or ``liked``
+    :param after: fullname to continue the listing after
+    :returns: iterator of :py:class:`RawThing` (pages are fetched lazily)
+    """
+    url = u'%s/user/%s/%s.json' % (
+        reddit.config.api_url, username, LISTING_PATHS[section])
+    params = {'limit': pagesize}
+    params.update(listing_params(after))
+    while True:
+        page = reddit.request_json(url, params=params, as_objects=False)
+        children = page['data']['children']
+        for child in children:
+            yield RawThing(child['data'])
+        after = page['data'].get('after')
+        if not (children and after):
             break
-        yield liked
+        params['after'] = after
+
+
+_get_raw_comment_items = itemgetter(*COMMENT_ATTRS)
+_get_raw_submission_items = itemgetter(*SUBMISSION_ATTRS)
+
+
+def raw_comment_to_dict(data):
+    """
+    :py:func:`comment_to_dict` for the raw ``data`` of a listing child
+    (already decoded by ``request_json``, see
+    :py:func:`decode_html_entities`)
+    """
+    _comment = dict(zip(COMMENT_ATTRS, _get_raw_comment_items(data)))
+    _comment['type'] = 'http://reddit.com/ns/comment'
+    _comment['author_name'] = data['author']
+    _comment['subreddit'] = data['subreddit']
+    _comment['permalink'] = build_comment_permalink(
+        data['link_id'], data['subreddit'], data['id'])
+    return _comment
+
+
+def raw_submission_to_dict(data):
+    """
+    :py:func:`submission_to_dict` for the raw ``data`` of a listing child
+    """
+    _sub = dict(zip(SUBMISSION_ATTRS, _get_raw_submission_items(data)))
+    _sub['permalink'] = urljoin(REDDIT_URL, _sub['permalink'])
+    _sub['_type'] = 'http://reddit.com/ns/submission'
+    _sub['author_name'] = data['author']
+    _sub['subreddit'] = data['subreddit']
+    return _sub
+
+
+def iter_raw_comment_dicts(reddit, comments, chunksize=INFO_CHUNKSIZE):
+    """
+    :py:func:`iter_comment_dicts` for :py:func:`iter_raw_listing`
+    """
+    for chunk in iter_chunks(comments, chunksize):
+        hydrate(reddit, chunk)
+        for comment in chunk:
+            yield raw_comment_to_dict(comment)
+
+
+def iter_raw_submission_dicts(reddit, submissions, chunksize=INFO_CHUNKSIZE):
+    """
+    :py:func:`iter_submission_dicts` for :py:func:`iter_raw_listing`
+    """
+    for chunk in iter_chunks(submissions, chunksize):
+        hydrate(reddit, chunk)
+        for submission in chunk:
+            yield raw_submission_to_dict(submission)
+
+
+@functools.lru_cache(maxsize=None)
+def get_uri_rgx():
+    """
+    :returns: the (compiled on first use) rfc3987 ``URI`` pattern
+    """
+    import rfc3987
+    return rfc3987.get_compiled_pattern('URI')  # URI_reference
 
 
 def iter_uris_regex(text, filterfunc=None):
@@ -166,7 +767,7 @@ def iter_uris_regex(text, filterfunc=None):
     if filterfunc is None:
         filterfunc = lambda uri: uri[:4].lower() == 'http'
 
-    for uri in uri_rgx.findall(text):
+    for uri in get_uri_rgx().findall(text):
         if filterfunc(uri):
             yield uri
         else:
@@ -174,22 +775,104 @@ def iter_uris_regex(text, filterfunc=None):
 
 
 def iter_uris_bs4(text):
+    import bs4
     bs = bs4.BeautifulSoup(text)
     links = bs.find_all('a')
     for link in links:
         yield link.get('href')  # link.text
 
-iter_uris = iter_uris_bs4
+
+class AnchorParser(HTMLParser):
+    """
+    collect the ``href`` of each ``<a>`` tag (without building a tree)
+    """
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.hrefs.append(dict(attrs).get('href'))
+
+    handle_startendtag = handle_starttag
+
+
+def iter_uris_htmlparser(text):
+    parser = AnchorParser()
+    parser.feed(text)
+    parser.close()
+    return iter(parser.hrefs)
+
+
+def iter_uris_lxml(text):
+    import lxml.html
+    if not text.strip():
+        return
+    doc = lxml.html.fragment_fromstring(text, create_parent='div')
+    for link in doc.iter('a'):
+        yield link.get('href')
+
+
+URI_EXTRACTORS = OrderedDict((
+    ('htmlparser', iter_uris_htmlparser),
+    ('lxml', iter_uris_lxml),
+    ('bs4', iter_uris_bs4),
+    ('regex', iter_uris_regex),
+))
+
+URI_EXTRACTOR = 'htmlparser'
+iter_uris = URI_EXTRACTORS[URI_EXTRACTOR]
 
 
-def iter_comment_uris(comment):
+def set_uri_extractor(name):
+    """
+    :param name: key of ``URI_EXTRACTORS``
+    """
+    global URI_EXTRACTOR, iter_uris
+    iter_uris = URI_EXTRACTORS[name]
+    URI_EXTRACTOR = name
+
+
+def _extract_uris(args):
+    name, text = args
+    return list(URI_EXTRACTORS[name](text)) if text else []
+
+
+def extract_uris_batch(texts, extractor=None, processes=None, chunksize=256):
+    """
+    extract URIs from many HTML documents across a process pool
+
+    :param texts: list of HTML strings (or None)
+    :param extractor: key of ``URI_EXTRACTORS`` (default: ``URI_EXTRACTOR``)
+    :param processes: number of worker processes (default: CPU count)
+    :returns: list of lists of URIs, one per text
+    """
+    extractor = extractor or URI_EXTRACTOR
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes) as pool:
+        return list(pool.map(
+            _extract_uris,
+            ((extractor, text) for text in texts),
+            chunksize=chunksize))
+
+
+def iter_comment_uris(comment, html_uris=None):
+    """
+    :param html_uris: URIs already extracted from ``body_html``
+        (see :py:func:`extract_uris_batch`)
+    """
     #yield '/'.join(comment['permalink'].split('/')[:-1])
     yield comment['permalink']
-    for uri in iter_uris(comment['body_html']):
+    if html_uris is None:
+        html_uris = iter_uris(comment['body_html'])
+    for uri in html_uris:
         yield uri
 
 
-def iter_submission_uris(submission):
+def iter_submission_uris(submission, html_uris=None):
+    """
+    :param html_uris: URIs already extracted from ``selftext_html``
+    """
     permalink = submission.get("permalink")
     if permalink:
         yield permalink
@@ -198,7 +881,10 @@ def iter_submission_uris(submission):
         yield url
 
     selftext = submission.get("selftext_html")
-    if selftext:
+    if html_uris is not None:
+        for uri in html_uris:
+            yield uri
+    elif selftext:
         for uri in iter_uris(selftext):
             yield uri
 
@@ -219,12 +905,12 @@ def read_https_domains(filename):
     return https_domains
 
 
-DATADIR = os.path.join(os.path.dirname(__file__), '..', 'data')
 https_domains_file = os.path.join(DATADIR, 'https_domains.txt')
-ALWAYS_HTTPS = read_https_domains(https_domains_file)
+ALWAYS_HTTPS = None  # see load_netloc_data
 
 
 def httpsify(url):
+    load_netloc_data()
     if url.netloc in ALWAYS_HTTPS:
         url = url.with_scheme('https')
     elif url.netloc.endswith('readthedocs.org'):
@@ -248,10 +934,22 @@ def read_netloc_mappings(filename):
 
 
 netloc_mappings_file = os.path.join(DATADIR, 'netloc_mappings.txt')
-NETLOC_MAPPINGS = read_netloc_mappings(netloc_mappings_file)
+NETLOC_MAPPINGS = None  # see load_netloc_data
+
+
+def load_netloc_data():
+    """
+    read ``ALWAYS_HTTPS`` and ``NETLOC_MAPPINGS`` (on first use)
+    """
+    global ALWAYS_HTTPS, NETLOC_MAPPINGS
+    if ALWAYS_HTTPS is None:
+        ALWAYS_HTTPS = read_https_domains(https_domains_file)
+    if NETLOC_MAPPINGS is None:
+        NETLOC_MAPPINGS = read_netloc_mappings(netloc_mappings_file)
 
 
 def normalize_netloc(url):
+    load_netloc_data()
     norm_netloc = NETLOC_MAPPINGS.get(url.netloc)
     if norm_netloc:
         url = url.with_netloc(norm_netloc)
@@ -266,7 +964,11 @@ def normalize_netloc(url):
     return url
 
 
-def canonicalize_uri(uri):
+def canonicalize_uri_uncached(uri):
+    """
+    reference implementation of :py:func:`canonicalize_uri`
+    """
+    import urlobject
     url = urlobject.URLObject(uri)
 
     url = normalize_netloc(url)
@@ -283,231 +985,1710 @@ def canonicalize_uri(uri):
     # TODO: no path :: trailing slash wrd.nu wrd.nu/
     return url
 
-URIThing = collections.namedtuple(
-    'URIThing',
-    ('uri', 'canonical_uri', 'source_obj'))
-
 
-def iter_all_uris(data):
+class NetlocRules(object):
     """
-    :returns: iterator of (uri, canonical_uri, source_obj)
+    :py:func:`normalize_netloc` and :py:func:`httpsify`, compiled from
+    ``NETLOC_MAPPINGS`` and ``ALWAYS_HTTPS`` into one cached lookup per
+    distinct netloc
     """
-    comments = data['comments']
-    submissions = data['submissions']
-
-    for comment in comments:
-        for uri in iter_comment_uris(comment):
-            yield URIThing(uri, canonicalize_uri(uri), comment)
+    def __init__(self, netloc_mappings, always_https):
+        self.netloc_mappings = dict(netloc_mappings)
+        self.always_https = frozenset(always_https)
+        self.rules = {}
 
-    for submission in submissions:
-        for uri in iter_submission_uris(submission):
-            yield URIThing(uri, canonicalize_uri(uri), comment)
-
-
-class URIRefCounter(collections.OrderedDict):
-    @staticmethod
-    def keyfunc(obj):
-        return obj.canonical_uri
-
-    @staticmethod
-    def valuefunc(obj):
-        return (obj.uri, obj.source_obj)  # source_obj_uri TODO
-
-    def push(self, obj, return_count=False, return_reflist=False):
+    def normalize(self, netloc):
+        """
+        :returns: normalized netloc, or None if no rule applies
+        """
+        norm_netloc = self.netloc_mappings.get(netloc)
+        if norm_netloc:
+            return norm_netloc
+        elif netloc.endswith('rtfd.org'):
+            return u'.'.join(netloc.split('.')[:-2] + ['readthedocs.org'])
+        elif netloc.endswith('github.com'):
+            components = netloc.split('.')
+            if (len(components) == 3 and components[0] not in (
+                    'help', 'status', 'gist')):
+                return u'.'.join(components[:-1] + ['io'])
+        return None
+
+    def is_https(self, netloc):
+        return (netloc in self.always_https or
+                netloc.endswith('readthedocs.org'))
+
+    def resolve(self, netloc):
         """
-        append a URI to the counter # TODO:
-        :param uri: uri(uri, canonical_uri, source)
+        :returns: (normalized netloc or None, whether to use https)
         """
-        #reflist = self.reflist = getattr(
-        #   self, 'reflist', self.get_default(self.keyfunc(obj), list)
-        #reflist.append( self.valuefunc(obj) )
+        rule = self.rules.get(netloc)
+        if rule is None:
+            norm_netloc = self.normalize(netloc)
+            rule = self.rules[netloc] = (
+                norm_netloc,
+                self.is_https(
+                    netloc if norm_netloc is None else norm_netloc))
+        return rule
 
-        key = URIRefCounter.keyfunc(obj)      # obj.canonical_uri
-        val = URIRefCounter.valuefunc(obj)    # obj.uri, obj.source_obj
 
-        l = self.setdefault(key, default=[])
-        l.append(val)
-        if return_count:
-            return len(l)
-        if return_reflist:
-            return l
+NETLOC_RULES = None  # see get_netloc_rules
+CANONICALIZE_CACHE_SIZE = 2 ** 16
 
-    def counts(self):
-        for key, refs in self.items():
-            yield (key, len(refs), refs)
 
-    def print(self, counts=None):
-        for key, count, refs in counts or self.counts():
-            print(key, count, refs)
+def get_netloc_rules():
+    """
+    :returns: ``NETLOC_RULES`` (compiled on first use)
+    """
+    global NETLOC_RULES
+    if NETLOC_RULES is None:
+        load_netloc_data()
+        NETLOC_RULES = NetlocRules(NETLOC_MAPPINGS, ALWAYS_HTTPS)
+    return NETLOC_RULES
 
-    @classmethod
-    def group_and_count(cls, iterable, keyfunc=None, valuefunc=None):
-        self = cls()
-        if keyfunc:
-            self.keyfunc = keyfunc
-        if valuefunc:
-            self.valuefunc = valuefunc
-        for obj in iterable:
-            self.push(obj)
-        #return self.counts()
-        return self
 
-    @staticmethod
-    def site_frequencies(uri_iterable):
-        attrs = attrgetter('netloc', 'path', 'query')  # TODO: fragment
-        url_stemmer = lambda x: attrs(urlparse.urlparse(x))
-        url_counts = Counter(url_stemmer(uri) for uri in uri_iterable).items()
-        by_freq = sorted(url_counts, key=lambda x: x[1], reverse=True)
-        by_site = sorted(url_counts, key=lambda x: x[0])
-        return {'by_freq': by_freq,
-                'by_site': by_site}
+@functools.lru_cache(maxsize=CANONICALIZE_CACHE_SIZE)
+def canonicalize_uri(uri):
+    import urlobject
+    url = urlobject.URLObject(uri)
 
+    norm_netloc, https = get_netloc_rules().resolve(url.netloc)
+    if norm_netloc is not None:
+        url = url.with_netloc(norm_netloc)
 
-def redem(username, output_filename='data.json', limit=None):
-    """
-    fetch reddit comments and submissions, extract URIs,
-    serialize to JSON.
+    if url.scheme:
+        if not url.startswith(url.scheme):
+            url = url.with_scheme(url.scheme)
+        if https:
+            url = url.with_scheme('https')
+    else:
+        if url.netloc == '':
+            if url.path.startswith('/r/') or url.path.startswith('/u/'):
+                url = url.with_netloc('www.reddit.com').with_scheme('http')
+    # TODO: no path :: trailing slash wrd.nu wrd.nu/
+    return url
 
-    :param username: reddit username
-    :type username: str
-    :param output_filename: filename to write JSON data to
-    :type output_filename: str path (may contain '~')
 
-    :return: dict of comments and submissions
-    :rtype: dict
+def reset_canonicalize_cache():
     """
+    recompile ``NETLOC_RULES`` (after changing ``NETLOC_MAPPINGS`` or
+    ``ALWAYS_HTTPS``) and clear the :py:func:`canonicalize_uri` cache
+    """
+    global NETLOC_RULES
+    NETLOC_RULES = None
+    canonicalize_uri.cache_clear()
 
-    r = praw.Reddit(user_agent=__USER_AGENT__)
-    r.config.decode_html_entities = True  # XXX
-    r.login(username)
-    user = r.get_redditor(username)
-    comments = iter_comments(user, limit=limit)
-    submissions = iter_submissions(user, limit=limit)
-    data = {
-        '_meta': {
-            'date_utc': str(datetime.datetime.utcnow()),
-            'username': username,
-        },
-        'comments': [comment_to_dict(c) for c in comments],
-        'submissions': [submission_to_dict(s) for s in submissions],
-        #'liked': [liked_to_dict(l) for l in liked]
-    }
-    return data
 
+def canonicalize_uris(uris):
+    """
+    canonicalize each distinct URI once
 
-def process_urls(data):
-    uri_iter = list(iter_all_uris(data))
-    uris = sorted(uri_iter, key=lambda x: x.canonical_uri)
-    uri_refs = URIRefCounter.group_and_count(uris)
-    return sorted(
-        ((x[0], x[1]) for x in uri_refs.counts()),
-        key=itemgetter(0))
+    :param uris: iterable of URIs (e.g. every URI in an archive)
+    :returns: OrderedDict of uri -> canonical uri
+    """
+    canonical = OrderedDict()
+    for uri in uris:
+        if uri not in canonical:
+            canonical[uri] = canonicalize_uri(uri)
+    return canonical
 
 
-def expand_path(filename):
+URIThing = collections.namedtuple(
+    'URIThing',
+    ('uri', 'canonical_uri', 'source_obj'))
+
+
+def iter_item_uris(data, processes=None):
+    """
+    :param processes: extract URIs from HTML in a process pool
+        (see :py:func:`extract_uris_batch`)
+    :returns: iterator of (section, item, iterator of uris)
+    """
+    comments = data['comments']
+    submissions = data['submissions']
+
+    comment_uris = [None] * len(comments)
+    submission_uris = [None] * len(submissions)
+    if processes:
+        texts = ([c['body_html'] for c in comments] +
+                 [s.get('selftext_html') for s in submissions])
+        html_uris = extract_uris_batch(texts, processes=processes)
+        comment_uris = html_uris[:len(comments)]
+        submission_uris = html_uris[len(comments):]
+
+    for comment, html_uris in zip(comments, comment_uris):
+        yield 'comments', comment, iter_comment_uris(comment, html_uris)
+
+    for submission, html_uris in zip(submissions, submission_uris):
+        yield ('submissions', submission,
+               iter_submission_uris(submission, html_uris))
+
+
+def iter_all_uris(data, processes=None):
+    """
+    :param processes: extract URIs from HTML in a process pool
+        (see :py:func:`extract_uris_batch`)
+    :returns: iterator of (uri, canonical_uri, source_obj)
+    """
+    for section, item, uris in iter_item_uris(data, processes=processes):
+        for uri in uris:
+            yield URIThing(uri, canonicalize_uri(uri), item)
+
+
+URIRef = collections.namedtuple('URIRef', ('uri', 'section', 'id'))
+
+
+class URIIndex(object):
+    """
+    canonical URI -> references (:py:class:`URIRef`: the URI as written
+    and the section and id of the item it is in)
+
+    The index is updated in place: only new or edited items are
+    (re)scanned (see :py:meth:`update`), and it can be saved between runs.
+    """
+    def __init__(self):
+        self.items = {}  # "section/id" -> (edited, [(uri, canonical), ...])
+        self.refs = {}   # canonical -> [URIRef, ...]
+
+    def add(self, section, item, uris):
+        key = '%s/%s' % (section, item['id'])
+        self.remove(key)
+        pairs = [(uri, canonicalize_uri(uri)) for uri in uris]
+        self.items[key] = (item.get('edited'), pairs)
+        for uri, canonical in pairs:
+            self.refs.setdefault(canonical, []).append(
+                URIRef(uri, section, item['id']))
+
+    def remove(self, key):
+        edited, pairs = self.items.pop(key, (None, ()))
+        section, _id = key.split('/', 1)
+        for uri, canonical in pairs:
+            refs = self.refs[canonical]
+            refs.remove(URIRef(uri, section, _id))
+            if not refs:
+                del self.refs[canonical]
+
+    def update(self, data, processes=None, prune=True):
+        """
+        scan the items of ``data`` which are new or have been edited
+        since they were last indexed
+
+        :param prune: remove items which are no longer in ``data``
+        :returns: number of items scanned
+        """
+        changed = dict((section, []) for section in SECTIONS)
+        keys = set()
+        for section in SECTIONS:
+            for item in data.get(section, []):
+                key = '%s/%s' % (section, item['id'])
+                keys.add(key)
+                indexed = self.items.get(key)
+                if indexed is None or indexed[0] != item.get('edited'):
+                    changed[section].append(item)
+        if prune:
+            for key in set(self.items) - keys:
+                self.remove(key)
+        for section, item, uris in iter_item_uris(
+                changed, processes=processes):
+            self.add(section, item, uris)
+        return sum(len(items) for items in changed.values())
+
+    def counts(self):
+        """
+        :returns: sorted list of (canonical uri, number of references)
+        """
+        return sorted(
+            ((uri, len(refs)) for uri, refs in self.refs.items()),
+            key=itemgetter(0))
+
+    def sources(self, canonical_uri):
+        """
+        :returns: list of :py:class:`URIRef` for a canonical URI
+        """
+        return list(self.refs.get(canonical_uri, ()))
+
+    def domains(self):
+        """
+        :returns: list of (netloc, number of references, number of URIs),
+            most referenced first
+        """
+        refs, uris = Counter(), Counter()
+        for uri, _refs in self.refs.items():
+            netloc = urlparse(uri).netloc
+            refs[netloc] += len(_refs)
+            uris[netloc] += 1
+        return sorted(
+            ((netloc, count, uris[netloc]) for netloc, count in refs.items()),
+            key=lambda x: (-x[1], x[0]))
+
+    def save(self, filename):
+        with codecs.open(filename, 'w', encoding='utf-8') as fp:
+            json.dump(self.items, fp)
+
+    @classmethod
+    def load(cls, filename):
+        self = cls()
+        if os.path.exists(filename):
+            with codecs.open(filename, 'r', encoding='utf-8') as fp:
+                items = json.load(fp)
+            for key, (edited, pairs) in items.items():
+                section, _id = key.split('/', 1)
+                self.items[key] = (edited, [tuple(x) for x in pairs])
+                for uri, canonical in pairs:
+                    self.refs.setdefault(canonical, []).append(
+                        URIRef(uri, section, _id))
+        return self
+
+
+def open_session(engine='praw', api_url=None, rate=API_RATE,
+                 pool_size=None, cache=None):
+    """
+    create a reddit session whose requests (from any number of threads)
+    share one :py:class:`RateLimiter` and are counted by endpoint
+
+    :param api_url: use an :py:class:`APIClient` for this base URL
+        (``raw`` engine only)
+    :param pool_size: HTTP connections kept open per host
+        (requests' default is 10)
+    :param cache: :py:class:`redem.httpcache.HTTPCache` (cache hits are
+        not rate limited)
+    :returns: (session, :py:class:`RequestCounter`)
+    """
+    if api_url is not None:
+        if engine != 'raw':
+            raise ValueError("api_url requires engine='raw'")
+        r = APIClient(api_url)
+    else:
+        import praw
+        r = praw.Reddit(user_agent=__USER_AGENT__)
+        r.config.decode_html_entities = True  # XXX
+        r.config.api_request_delay = 0  # see RateLimiter
+    if pool_size:
+        from requests.adapters import HTTPAdapter
+        for prefix in ('http://', 'https://'):
+            r.http.mount(prefix, HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size))
+    RateLimiter(rate).install(r.http)
+    if cache is not None:
+        cache.install(r.http)
+    return r, RequestCounter().install(r.http)
+
+
+def fetch_user(reddit, username, limit=None, since=None, liked=False,
+               engine='praw', writer=None):
+    """
+    fetch the listings of one user through an open session
+    (see :py:func:`open_session` and :py:func:`redem`)
+
+    :returns: dict of ``_meta`` and a list of dicts per section
+    """
+    since = since or {}
+    sections = ['comments', 'submissions'] + (['liked'] if liked else [])
+    after = {}
+    limits = dict.fromkeys(sections, limit)
+    if writer is not None:
+        for section in list(sections):
+            if writer.is_done(section):
+                log.info("%-14s: already done" % section)
+                sections.remove(section)
+            elif limit and writer.get_count(section) >= limit:
+                log.info("%-14s: limit reached" % section)
+                writer.done(section)
+                sections.remove(section)
+            else:
+                after[section] = writer.get_after(section)
+                if limit:
+                    limits[section] = limit - writer.get_count(section)
+    listings = OrderedDict()
+    if engine == 'raw':
+        to_dicts = {
+            'comments': iter_raw_comment_dicts,
+            'submissions': iter_raw_submission_dicts,
+            'liked': iter_raw_submission_dicts}
+        for section in sections:
+            listings[section] = (
+                iter_listing(
+                    iter_raw_listing(
+                        reddit, username, section,
+                        after=after.get(section)),
+                    limit=limits[section],
+                    since=since.get(section)),
+                to_dicts[section])
+    else:
+        user = reddit.get_redditor(username)
+        iter_things = {
+            'comments': (iter_comments, iter_comment_dicts),
+            'submissions': (iter_submissions, iter_submission_dicts),
+            'liked': (iter_liked, iter_submission_dicts)}
+        for section in sections:
+            iter_section, to_dicts = iter_things[section]
+            listings[section] = (
+                iter_section(
+                    user, limit=limits[section], since=since.get(section),
+                    after=after.get(section)),
+                to_dicts)
+    data = {
+        '_meta': {
+            'date_utc': str(datetime.datetime.utcnow()),
+            'username': username,
+        },
+    }
+    data.update(fetch_listings(reddit, listings, writer=writer))
+    return data
+
+
+def redem(username, output_filename='data.json', limit=None, since=None,
+          liked=False, rate=API_RATE, engine='praw', writer=None,
+          api_url=None, cache=None):
+    """
+    fetch reddit comments and submissions, extract URIs,
+    serialize to JSON.
+
+    :param username: reddit username
+    :type username: str
+    :param output_filename: filename to write JSON data to
+    :type output_filename: str path (may contain '~')
+    :param since: ``created_utc`` per section to stop fetching at
+        (see :py:func:`get_incremental_since`)
+    :type since: dict
+    :param liked: also fetch liked submissions
+    :type liked: bool
+    :param rate: requests per second shared by all listings
+    :type rate: float
+    :param engine: ``praw`` (praw objects) or ``raw`` (listing JSON,
+        see :py:func:`iter_raw_listing`)
+    :type engine: str
+    :param writer: stream items to an NDJSON file (resuming from its
+        checkpoint) instead of returning them
+    :type writer: :py:class:`NDJSONWriter`
+    :param api_url: fetch from this base URL through an
+        :py:class:`APIClient` (``raw`` engine only)
+    :type api_url: str
+    :param cache: HTTP cache for the session (see :py:func:`open_session`)
+    :type cache: :py:class:`redem.httpcache.HTTPCache`
+
+    :return: dict of comments and submissions
+    :rtype: dict
+    """
+    r, requests = open_session(
+        engine=engine, api_url=api_url, rate=rate, cache=cache)
+    METADATA.load()
+    r.login(username)
+    data = fetch_user(r, username, limit=limit, since=since, liked=liked,
+                      engine=engine, writer=writer)
+    METADATA.save()
+    log.info("metadata lookups: %d" % METADATA.misses)
+    requests.report()
+    data['_meta']['requests'] = dict(requests)
+    if writer is not None:
+        writer.write_meta(data['_meta'])
+        writer.close()
+    return data
+
+
+def get_incremental_since(data, refresh_days=0):
+    """
+    determine where to stop fetching each section of an incremental backup
+
+    :param data: existing archive (e.g. ``merged_json.json``)
+    :param refresh_days: also refetch items from the last N days before
+        the newest archived item (to pick up edits and score changes)
+    :returns: dict of section -> ``created_utc`` (or None to fetch all)
+    """
+    since = {}
+    for section in ('comments', 'submissions'):
+        items = data.get(section)
+        if not items:
+            since[section] = None
+            continue
+        newest = max(items, key=itemgetter('created_utc'))
+        log.info("%-14s: newest archived: %s %s" % (
+            section, newest['id'], newest['created_utc']))
+        since[section] = newest['created_utc'] - refresh_days * 60 * 60 * 24
+    return since
+
+
+def update_data(data, delta):
+    """
+    merge a (newer) incremental backup into an existing archive
+
+    Items in ``delta`` replace archived items with the same id unless the
+    archived item has a more recent ``edited`` timestamp; the older text
+    and score are kept as revisions (see :py:func:`merge_revisions`).
+
+    :returns: the updated archive (``data``)
+    """
+    seen = data.get('_meta', {}).get('date_utc')
+    delta_seen = delta.get('_meta', {}).get('date_utc')
+    for section in ('comments', 'submissions'):
+        items = OrderedDict((x['id'], x) for x in data.get(section, []))
+        count = len(items)
+        for item in delta.get(section, []):
+            existing = items.get(item['id'])
+            if existing is not None:
+                item = merge_revisions(
+                    [(item, delta_seen), (existing, seen)])
+            items[item['id']] = item
+        log.info("%-14s: %d new, %d refreshed" % (
+            section, len(items) - count,
+            len(delta.get(section, [])) - (len(items) - count)))
+        data[section] = sorted(
+            items.values(),
+            key=itemgetter('created_utc'),
+            reverse=True)
+    data.setdefault('_meta', {}).update(delta.get('_meta', {}))
+    return data
+
+
+BATCH_OUTPUT = os.path.join(DATADIR, '{username}.data.json')
+BATCH_WORKERS = 8
+
+
+def read_usernames(filename):
+    """
+    :param filename: one username per line (``#`` starts a comment)
+    :returns: list of usernames
+    """
+    usernames = []
+    with codecs.open(filename, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                usernames.append(line)
+    return usernames
+
+
+def backup_user(reddit, username, filename, limit=None, incremental=False,
+                refresh_days=0, resume=False, engine='praw'):
+    """
+    back up one user to a JSON file (updated in place when
+    ``incremental``) or an NDJSON file (see :py:class:`NDJSONWriter`)
+
+    :returns: ``filename``
+    """
+    archive = since = writer = None
+    if incremental and os.path.exists(filename):
+        archive = load(filename=filename)
+        since = get_incremental_since(archive, refresh_days)
+    elif is_ndjson(filename):
+        writer = NDJSONWriter(filename, resume=resume)
+    data = fetch_user(reddit, username, limit=limit, since=since,
+                      engine=engine, writer=writer)
+    if writer is not None:
+        writer.write_meta(data['_meta'])
+        writer.close()
+    else:
+        if archive is not None:
+            data = update_data(archive, data)
+        dump(data, filename=filename)
+    return filename
+
+
+def redem_batch(usernames, output_filename=BATCH_OUTPUT, limit=None,
+                incremental=False, refresh_days=0, resume=False,
+                rate=API_RATE, engine='praw', api_url=None,
+                max_workers=BATCH_WORKERS, cache=None):
+    """
+    back up several users concurrently through one session: one pool of
+    HTTP connections, one rate limit (``rate`` requests per second for
+    the whole batch) and one ``METADATA`` cache
+
+    Nothing is fetched as a logged-in user, so liked submissions (which
+    need each user's login) are not backed up.
+
+    :param output_filename: per-user filename (with ``{username}``)
+    :param max_workers: users fetched at a time
+    :param cache: HTTP cache for the session (see :py:func:`open_session`)
+    :returns: OrderedDict of username -> filename written (or the
+        exception raised for that user)
+    """
+    if '{username}' not in output_filename:
+        raise ValueError(
+            "output_filename must contain {username}: %r" % output_filename)
+    # one connection per concurrent listing (see fetch_listings)
+    r, requests = open_session(
+        engine=engine, api_url=api_url, rate=rate, pool_size=max_workers * 2,
+        cache=cache)
+    METADATA.load()
+
+    def backup(username):
+        return backup_user(
+            r, username, output_filename.format(username=username),
+            limit=limit, incremental=incremental, refresh_days=refresh_days,
+            resume=resume, engine=engine)
+
+    results = OrderedDict()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as pool:
+        futures = OrderedDict(
+            (username, pool.submit(backup, username))
+            for username in usernames)
+        for username, future in futures.items():
+            try:
+                results[username] = future.result()
+                log.info("%-14s: %s" % (username, results[username]))
+            except Exception as e:
+                log.error("%-14s: %r" % (username, e))
+                results[username] = e
+    METADATA.save()
+    log.info("metadata lookups: %d" % METADATA.misses)
+    requests.report()
+    return results
+
+
+def process_urls(data, processes=None, uri_index=None):
+    """
+    :param uri_index: :py:class:`URIIndex` to update (instead of
+        scanning every item)
+    :returns: sorted list of (canonical uri, number of references)
+    """
+    if uri_index is None:
+        uri_index = URIIndex()
+    uri_index.update(data, processes=processes)
+    return uri_index.counts()
+
+
+# string values repeated across items, shared between records
+# (see :py:class:`Record`)
+INTERN_KEYS = frozenset((
+    'type', 'author', 'author_name', 'subreddit', 'subreddit_id',
+    'link_id', 'link_title', 'link_author', 'domain'))
+
+
+class RecordShape(object):
+    """
+    the (ordered) keys of a :py:class:`Record`, shared by every record
+    with the same keys (see :py:func:`get_record_shape`)
+    """
+    __slots__ = ('keys', 'index', 'transitions')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((key, n) for n, key in enumerate(keys))
+        self.transitions = {}
+
+    def add(self, key):
+        """
+        :returns: the shape with ``key`` appended
+        """
+        shape = self.transitions.get(key)
+        if shape is None:
+            shape = self.transitions[key] = get_record_shape(
+                self.keys + (key,))
+        return shape
+
+
+RECORD_SHAPES = {}
+
+
+def get_record_shape(keys):
+    keys = tuple(keys)
+    shape = RECORD_SHAPES.get(keys)
+    if shape is None:
+        shape = RECORD_SHAPES[keys] = RecordShape(
+            tuple(sys.intern(key) for key in keys))
+    return shape
+
+
+class Record(collections.abc.MutableMapping):
+    """
+    compact comment or submission
+
+    Values are kept in a list; the keys are kept once per distinct set of
+    keys in a shared :py:class:`RecordShape`, and the values of
+    ``INTERN_KEYS`` are interned. Records behave like (ordered) dicts and
+    are serialized as JSON objects with :py:func:`record_to_json`.
+    """
+    __slots__ = ('_shape', '_values')
+
+    def __init__(self, items=(), **kwargs):
+        items = OrderedDict(items)
+        items.update(kwargs)
+        self._shape = get_record_shape(items.keys())
+        self._values = [
+            intern_value(key, value) for key, value in items.items()]
+
+    @classmethod
+    def from_pairs(cls, pairs, shape=None):
+        """
+        :param pairs: list of (key, value) with unique keys
+            (as passed to ``object_pairs_hook``)
+        :param shape: the :py:class:`RecordShape` of ``pairs`` (if known)
+        """
+        self = cls.__new__(cls)
+        self._shape = shape or get_record_shape(key for key, _ in pairs)
+        self._values = [
+            sys.intern(value)
+            if key in INTERN_KEYS and type(value) is str else value
+            for key, value in pairs]
+        return self
+
+    def __getitem__(self, key):
+        n = self._shape.index.get(key)
+        if n is None:
+            raise KeyError(key)
+        return self._values[n]
+
+    def get(self, key, default=None):
+        n = self._shape.index.get(key)
+        return default if n is None else self._values[n]
+
+    def __contains__(self, key):
+        return key in self._shape.index
+
+    def __setitem__(self, key, value):
+        n = self._shape.index.get(key)
+        if n is None:
+            self._shape = self._shape.add(key)
+            self._values.append(value)
+        else:
+            self._values[n] = value
+
+    def __delitem__(self, key):
+        n = self._shape.index.get(key)
+        if n is None:
+            raise KeyError(key)
+        keys = list(self._shape.keys)
+        del keys[n]
+        del self._values[n]
+        self._shape = get_record_shape(keys)
+
+    def __iter__(self):
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self.items()),))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+    def items(self):
+        return zip(self._shape.keys, self._values)
+
+    def copy(self):
+        other = self.__class__.__new__(self.__class__)
+        other._shape = self._shape
+        other._values = list(self._values)
+        return other
+
+    def to_dict(self):
+        return dict(zip(self._shape.keys, self._values))
+
+
+def intern_value(key, value):
+    if key in INTERN_KEYS and type(value) is str:
+        return sys.intern(value)
+    return value
+
+
+def record_pairs_hook(pairs):
+    """
+    ``object_pairs_hook`` that reads comments and submissions (objects
+    with ``id`` and ``created_utc``) as :py:class:`Record`
+    """
+    keys = tuple([key for key, _ in pairs])
+    shape = RECORD_SHAPES.get(keys)
+    if shape is None:
+        if 'id' not in keys or 'created_utc' not in keys:
+            return OrderedDict(pairs)
+        shape = get_record_shape(keys)
+    return Record.from_pairs(pairs, shape)
+
+
+def record_to_json(obj):
+    """
+    ``default`` for ``json.dump``: serialize records as objects
+    """
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def dumps(obj):
+    """
+    ``json.dumps`` for items (see :py:func:`record_to_json`)
+    """
+    return json.dumps(obj, default=record_to_json)
+
+
+def expand_path(filename):
     return os.path.abspath(os.path.expanduser(filename))
 
 
+def is_ndjson(filename):
+    """
+    whether ``filename`` is newline-delimited JSON (``.ndjson``, ``.jsonl``)
+    """
+    return filename.endswith(('.ndjson', '.jsonl'))
+
+
 def dump(data, filename=None):
     output_filename = expand_path(filename)
+    if is_archive(output_filename):
+        return dump_archive(data, output_filename)
+    if is_ndjson(output_filename):
+        return dump_ndjson(data, output_filename)
     with codecs.open(output_filename, 'w+', encoding='utf-8') as fp:
-        return json.dump(data, fp)
+        return json.dump(data, fp, default=record_to_json)
 
 
-def load(fileobj=None, filename=None):
-    input_filename = expand_path(filename)
+def load(fileobj=None, filename=None, ids=None, since=None, until=None):
+    """
+    :param ids: only load the items with these ids
+    :param since: only load items created at or after this ``created_utc``
+    :param until: only load items created before this ``created_utc``
+
+    (archives with an index only decompress the blocks which can contain
+    the selected items; see :py:class:`Archive`)
+    """
     if fileobj:
-        return json.load(fileobj)
+        return select_items(
+            json.load(fileobj, object_pairs_hook=record_pairs_hook),
+            ids, since, until)
     elif filename:
+        input_filename = expand_path(filename)
+        if is_archive(input_filename):
+            if os.path.exists(input_filename + ARCHIVE_INDEX_SUFFIX):
+                with Archive(input_filename) as archive:
+                    return archive.select(ids, since, until)
+            return select_items(
+                records_to_data(iter_archive(input_filename)),
+                ids, since, until)
+        if is_ndjson(input_filename):
+            return select_items(
+                load_ndjson(input_filename), ids, since, until)
         with codecs.open(input_filename, 'r', encoding='utf-8') as fp:
-            return json.load(fp)
+            return select_items(
+                json.load(fp, object_pairs_hook=record_pairs_hook),
+                ids, since, until)
+
+
+SECTIONS = ('comments', 'submissions')
+FULLNAME_PREFIXES = {
+    'comments': 't1_',
+    'submissions': 't3_',
+    'liked': 't3_',
+}
 
 
-def merge_json_files(filenames, data=None):
+def iter_ndjson(filename):
     """
-    hack to merge json data files
+    read an NDJSON backup one record at a time
 
-    (would be much faster as a merge/concatenation in pandas)
+    Each line is a single-key object: ``{"_meta": {...}}`` or
+    ``{"<section>": {...item...}}``.
+
+    :returns: iterator of (section, item) tuples
     """
+    with codecs.open(filename, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                record = json.loads(
+                    line, object_pairs_hook=record_pairs_hook)
+                for section, item in record.items():
+                    yield section, item
 
-    sections = ('comments', 'submissions')
-    all_data = data if data else OrderedDict()
-    for section in sections:
-        if section not in all_data:
-            all_data[section] = OrderedDict()
-    if '_meta' not in all_data:
-        all_data['_meta'] = {}
-    if 'merged_from' not in all_data['_meta']:
-        all_data['_meta']['merged_from'] = OrderedDict()
-    for filename in filenames:
-        log.info("loading: %r" % filename)
-        data = load(filename=filename)
-        log.info(data.get('_meta'))
-        all_data['_meta']['merged_from'][filename] = data.get('_meta')
-        for subset in sections:
-            all_objects = all_data[subset]
-            objects = data[subset]
-            log.info("%-14s: %d" % (subset, len(objects)))
-            for item in objects:
-                _id = item['id']
-                if _id not in all_objects:
-                    all_objects[_id] = item
-                else:  # item exists
-                    existing = all_objects[_id]
-                    if 'edited' in item and item['edited']:
-                        if item['edited'] > existing['edited']:
-                            #log.debug("edited: %s" % item)
-                            all_objects[_id] = item
-                    else:
-                        #TODO
-                        #print("TODO")
-                        pass
+
+def iter_records(filename):
+    """
+    read a JSON or NDJSON backup
+
+    :returns: iterator of (section, item) tuples (``_meta`` first for JSON)
+    """
+    filename = expand_path(filename)
+    if is_archive(filename):
+        for record in iter_archive(filename):
+            yield record
+        return
+    if is_ndjson(filename):
+        for record in iter_ndjson(filename):
+            yield record
+        return
+    data = load(filename=filename)
+    yield '_meta', data.get('_meta', {})
+    for section, items in data.items():
+        if section != '_meta':
+            for item in items:
+                yield section, item
+
+
+def records_to_data(records):
+    """
+    :param records: iterator of (section, item) tuples
+    :returns: dict of ``_meta`` and a list of items per section
+    """
+    data = OrderedDict([('_meta', {})])
+    for section in SECTIONS:
+        data[section] = []
+    for section, item in records:
+        if section == '_meta':
+            data['_meta'].update(item)
+        else:
+            data.setdefault(section, []).append(item)
+    return data
+
+
+def load_ndjson(filename):
+    return records_to_data(iter_ndjson(filename))
+
+
+def dump_ndjson(data, filename):
+    with codecs.open(filename, 'w', encoding='utf-8') as fp:
+        fp.write(json.dumps({'_meta': data.get('_meta', {})}) + '\n')
+        for section, items in data.items():
+            if section != '_meta':
+                for item in items:
+                    fp.write(dumps({section: item}) + '\n')
+
+
+class NDJSONWriter(object):
+    """
+    append items to an NDJSON backup as they are fetched
+
+    A checkpoint (``<filename>.checkpoint``) records the file offset and
+    the last fullname written for each listing as of the last
+    :py:meth:`commit`. When resuming, the file is truncated to that offset
+    and each listing continues after its checkpointed fullname.
+    The checkpoint is removed by :py:meth:`close`.
+
+    ::
+
+        {"offset": 123456,
+         "sections": {"comments": {"after": "t1_c9tfxgd", "count": 500,
+                                   "done": false}}}
+
+    """
+    def __init__(self, filename, resume=False):
+        self.filename = expand_path(filename)
+        self.checkpoint_filename = self.filename + '.checkpoint'
+        self.lock = threading.Lock()
+        self.checkpoint = {'offset': 0, 'sections': {}}
+        self.sections = {}
+        if resume and os.path.exists(self.checkpoint_filename):
+            with codecs.open(self.checkpoint_filename, 'r',
+                             encoding='utf-8') as fp:
+                self.checkpoint = json.load(fp)
+            self.fp = open(self.filename, 'r+b')
+            self.fp.truncate(self.checkpoint['offset'])
+            self.fp.seek(0, os.SEEK_END)
+            log.info("resuming %r from %r" % (
+                self.filename, self.checkpoint))
+        else:
+            self.fp = open(self.filename, 'wb')
+        for section, state in self.checkpoint['sections'].items():
+            self.sections[section] = dict(state)
+
+    def get_after(self, section):
+        return self.sections.get(section, {}).get('after')
+
+    def get_count(self, section):
+        return self.sections.get(section, {}).get('count', 0)
+
+    def is_done(self, section):
+        return self.sections.get(section, {}).get('done', False)
+
+    def _write(self, record):
+        self.fp.write((dumps(record) + '\n').encode('utf-8'))
+
+    def write_meta(self, meta):
+        with self.lock:
+            self._write({'_meta': meta})
+
+    def write(self, section, item):
+        with self.lock:
+            self._write({section: item})
+            state = self.sections.setdefault(
+                section, {'after': None, 'count': 0, 'done': False})
+            state['after'] = FULLNAME_PREFIXES[section] + item['id']
+            state['count'] += 1
+
+    def commit(self):
+        """
+        flush the file and save the checkpoint
+        """
+        with self.lock:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.checkpoint = {
+                'offset': self.fp.tell(),
+                'sections': dict(
+                    (k, dict(v)) for k, v in self.sections.items())}
+            tmp_filename = self.checkpoint_filename + '.tmp'
+            with codecs.open(tmp_filename, 'w', encoding='utf-8') as fp:
+                json.dump(self.checkpoint, fp)
+            os.replace(tmp_filename, self.checkpoint_filename)
+
+    def done(self, section):
+        with self.lock:
+            self.sections.setdefault(
+                section, {'after': None, 'count': 0})['done'] = True
+        self.commit()
+
+    def close(self):
+        self.fp.flush()
+        self.fp.close()
+        if os.path.exists(self.checkpoint_filename):
+            os.remove(self.checkpoint_filename)
+
+
+ARCHIVE_BLOCK_SIZE = 1000  # items per compressed block
+ARCHIVE_INDEX_SUFFIX = '.idx'
+ARCHIVE_CACHED_BLOCKS = 8
+
+
+def is_archive(filename):
+    """
+    whether ``filename`` is a compressed archive (``.ndjson.gz``,
+    ``.ndjson.zst``; see :py:class:`ArchiveWriter`)
+    """
+    return filename.endswith(('.ndjson.gz', '.jsonl.gz',
+                              '.ndjson.zst', '.jsonl.zst'))
+
+
+def get_archive_codec(name):
+    """
+    :param name: ``gzip`` or ``zstd`` (requires ``zstandard``)
+    :returns: (compress, decompress) functions of bytes
+    """
+    if name == 'gzip':
+        import gzip
+        return (functools.partial(gzip.compress, compresslevel=6, mtime=0),
+                gzip.decompress)
+    elif name == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd archives require zstandard"
+                             " (pip install zstandard)")
+        def decompress(data):
+            # one frame per block, but a whole archive is many frames
+            chunks = []
+            while data:
+                dobj = zstandard.ZstdDecompressor().decompressobj()
+                chunks.append(dobj.decompress(data))
+                data = dobj.unused_data
+            return b''.join(chunks)
+        return zstandard.ZstdCompressor(level=3).compress, decompress
+    raise ValueError("unsupported archive codec: %r" % name)
+
+
+def archive_codec_name(filename):
+    return 'zstd' if filename.endswith('.zst') else 'gzip'
+
+
+class ArchiveWriter(object):
+    """
+    write a compressed archive: NDJSON lines (as :py:func:`dump_ndjson`)
+    in independently compressed blocks of up to ``block_size`` items of
+    one section, and a sidecar index (``<filename>.idx``)::
+
+        {"format": "redem-archive", "version": 1, "codec": "gzip",
+         "size": 123456, "meta": {...},
+         "blocks": [{"section": "comments", "offset": 0, "length": 4567,
+                     "count": 1000, "created_utc": [min, max],
+                     "ids": ["c1", ...]}, ...]}
+
+    Concatenated gzip members (and zstd frames) are themselves a valid
+    stream, so ``zcat archive.ndjson.gz`` is an NDJSON backup.
+    """
+    def __init__(self, filename, block_size=ARCHIVE_BLOCK_SIZE, codec=None):
+        self.filename = expand_path(filename)
+        self.block_size = block_size
+        self.codec = codec or archive_codec_name(self.filename)
+        self.compress = get_archive_codec(self.codec)[0]
+        self.fp = open(self.filename + '.tmp', 'wb')
+        self.meta = OrderedDict()
+        self.blocks = []
+        self.buffers = OrderedDict()
+
+    def write_meta(self, meta):
+        self.meta.update(meta)
+
+    def write(self, section, item):
+        buffer = self.buffers.setdefault(section, [])
+        buffer.append(item)
+        if len(buffer) >= self.block_size:
+            self.flush(section)
+
+    def flush(self, section):
+        items = self.buffers.pop(section, None)
+        if not items:
+            return
+        lines = ''.join(dumps({section: item}) + '\n' for item in items)
+        block = self.compress(lines.encode('utf-8'))
+        created = [item['created_utc'] for item in items]
+        self.blocks.append(OrderedDict((
+            ('section', section),
+            ('offset', self.fp.tell()),
+            ('length', len(block)),
+            ('count', len(items)),
+            ('created_utc', [min(created), max(created)]),
+            ('ids', [item['id'] for item in items]),
+        )))
+        self.fp.write(block)
+
+    def close(self):
+        for section in list(self.buffers):
+            self.flush(section)
+        # _meta last (as merge_files), so that it can include counts
+        block = self.compress(
+            (json.dumps({'_meta': self.meta}) + '\n').encode('utf-8'))
+        self.fp.write(block)
+        size = self.fp.tell()
+        self.fp.close()
+        index = OrderedDict((
+            ('format', 'redem-archive'),
+            ('version', 1),
+            ('codec', self.codec),
+            ('size', size),
+            ('meta', self.meta),
+            ('blocks', self.blocks),
+        ))
+        index_filename = self.filename + ARCHIVE_INDEX_SUFFIX
+        with codecs.open(index_filename + '.tmp', 'w',
+                         encoding='utf-8') as fp:
+            json.dump(index, fp, separators=(',', ':'))
+        os.replace(self.filename + '.tmp', self.filename)
+        os.replace(index_filename + '.tmp', index_filename)
+
+
+def dump_archive(data, filename, block_size=ARCHIVE_BLOCK_SIZE):
+    writer = ArchiveWriter(filename, block_size=block_size)
+    writer.write_meta(data.get('_meta', {}))
+    for section, items in data.items():
+        if section != '_meta':
+            for item in items:
+                writer.write(section, item)
+    writer.close()
+
+
+def in_time_range(created_utc, since=None, until=None):
+    return ((since is None or created_utc >= since) and
+            (until is None or created_utc < until))
+
+
+class Archive(object):
+    """
+    random access to a compressed archive (see :py:class:`ArchiveWriter`)
+
+    The data file is memory-mapped and only the blocks which can contain
+    the requested ids or ``created_utc`` range are decompressed.
+    """
+    def __init__(self, filename):
+        import mmap
+        self.filename = expand_path(filename)
+        with codecs.open(self.filename + ARCHIVE_INDEX_SUFFIX, 'r',
+                         encoding='utf-8') as fp:
+            self.index = json.load(fp, object_pairs_hook=OrderedDict)
+        if self.index.get('format') != 'redem-archive':
+            raise ValueError("not an archive index: %r" % filename)
+        self.fp = open(self.filename, 'rb')
+        size = os.fstat(self.fp.fileno()).st_size
+        if size != self.index['size']:
+            self.fp.close()
+            raise ValueError("archive index is out of date: %r" % filename)
+        self.mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.decompress = get_archive_codec(self.index['codec'])[1]
+        self.meta = self.index['meta']
+        self.blocks = self.index['blocks']
+        self.ids = {}
+        for n, block in enumerate(self.blocks):
+            for _id in block['ids']:
+                self.ids[(block['section'], _id)] = n
+        self.cache = OrderedDict()
+        self.blocks_read = 0
+
+    def close(self):
+        self.mmap.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_lines(self, n):
+        """
+        :returns: list of the (NDJSON) lines of block ``n``
+        """
+        lines = self.cache.get(n)
+        if lines is not None:
+            self.cache.move_to_end(n)
+            return lines
+        block = self.blocks[n]
+        data = self.decompress(
+            self.mmap[block['offset']:block['offset'] + block['length']])
+        self.blocks_read += 1
+        lines = data.decode('utf-8').splitlines()
+        self.cache[n] = lines
+        if len(self.cache) > ARCHIVE_CACHED_BLOCKS:
+            self.cache.popitem(last=False)
+        return lines
+
+    def read_block(self, n):
+        """
+        :returns: list of the items in block ``n``
+        """
+        section = self.blocks[n]['section']
+        return [json.loads(line, object_pairs_hook=record_pairs_hook)[section]
+                for line in self.read_lines(n)]
+
+    def get(self, section, _id):
+        """
+        :returns: the item with ``id`` ``_id`` (or None)
+        """
+        n = self.ids.get((section, _id))
+        if n is None:
+            return None
+        # only parse the lines which can contain the id (as dumps writes it)
+        needle = '"id": %s' % json.dumps(_id)
+        for line in self.read_lines(n):
+            if needle in line:
+                item = json.loads(
+                    line, object_pairs_hook=record_pairs_hook)[section]
+                if item['id'] == _id:
+                    return item
+
+    def iter_section(self, section, since=None, until=None):
+        """
+        :returns: iterator of the items of ``section`` (in archive order)
+            created in [``since``, ``until``)
+        """
+        for n, block in enumerate(self.blocks):
+            if block['section'] != section:
+                continue
+            low, high = block['created_utc']
+            if ((since is not None and high < since) or
+                    (until is not None and low >= until)):
+                continue
+            for item in self.read_block(n):
+                if in_time_range(item['created_utc'], since, until):
+                    yield item
+
+    def sections(self):
+        return list(OrderedDict.fromkeys(x['section'] for x in self.blocks))
+
+    def iter_records(self):
+        """
+        :returns: iterator of (section, item) tuples (``_meta`` first)
+        """
+        yield '_meta', self.meta
+        for n, block in enumerate(self.blocks):
+            for item in self.read_block(n):
+                yield block['section'], item
+            self.cache.pop(n, None)
+
+    def select(self, ids=None, since=None, until=None):
+        """
+        :returns: dict of ``_meta`` and the items of each section with
+            one of ``ids`` and created in [``since``, ``until``)
+        """
+        data = OrderedDict([('_meta', self.meta)])
+        for section in SECTIONS:
+            data[section] = []
+        for section in self.sections():
+            if ids is None:
+                items = self.iter_section(section, since, until)
+            else:
+                items = (
+                    x for x in (self.get(section, _id) for _id in ids)
+                    if x is not None and
+                    in_time_range(x['created_utc'], since, until))
+            data[section] = list(items)
+        return data
+
+
+def iter_archive(filename):
+    """
+    read an archive a block at a time (or, without an up-to-date index,
+    as one decompressed NDJSON stream)
+
+    :returns: iterator of (section, item) tuples
+    """
+    if os.path.exists(filename + ARCHIVE_INDEX_SUFFIX):
+        try:
+            archive = Archive(filename)
+        except ValueError as e:
+            log.warning("%s: reading the whole file" % e)
+        else:
+            with archive:
+                for record in archive.iter_records():
+                    yield record
+            return
+    with open(filename, 'rb') as fp:
+        data = get_archive_codec(archive_codec_name(filename))[1](fp.read())
+    for line in data.decode('utf-8').splitlines():
+        if line.strip():
+            record = json.loads(line, object_pairs_hook=record_pairs_hook)
+            for section, item in record.items():
+                yield section, item
+
+
+def select_items(data, ids=None, since=None, until=None):
+    """
+    :py:meth:`Archive.select` for loaded data
+    """
+    if ids is None and since is None and until is None:
+        return data
+    ids = None if ids is None else set(ids)
+    for section, items in data.items():
+        if section != '_meta':
+            data[section] = [
+                x for x in items
+                if (ids is None or x['id'] in ids) and
+                in_time_range(x['created_utc'], since, until)]
+    return data
+
+
+def is_newer_edit(item, existing):
+    """
+    the merge rule: the item with the more recent ``edited`` timestamp wins
+    """
+    edited = item.get('edited')
+    return bool(edited) and edited > (existing.get('edited') or 0)
+
+
+# tracked across backups by merges (see merge_revisions)
+REVISION_TEXT_KEYS = ('body', 'body_html', 'selftext', 'selftext_html')
+REVISION_KEYS = REVISION_TEXT_KEYS + ('score',)
+
+_tokenize_delta = re.compile(r'\s+|\S+').findall
+
+
+def text_delta(new, old):
+    """
+    :returns: ops which rebuild ``old`` from ``new`` (a word diff):
+        ``[start, end]`` copies ``new[start:end]``, a string is inserted
+        (see :py:func:`apply_delta`)
+    """
+    import difflib
+    a, b = _tokenize_delta(new), _tokenize_delta(old)
+    offsets = [0]
+    for token in a:
+        offsets.append(offsets[-1] + len(token))
+    ops = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([offsets[i1], offsets[i2]])
+        elif j2 > j1:
+            ops.append(u''.join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(new, ops):
+    return u''.join(
+        new[op[0]:op[1]] if isinstance(op, list) else op for op in ops)
+
+
+def revision_key(revision):
+    return (revision['edited'] or 0, revision['seen'] or '')
+
+
+def revision_fields(revision):
+    return tuple(revision.get(key) for key in REVISION_KEYS)
+
+
+def iter_revisions(item, seen=None):
+    """
+    :param seen: ``date_utc`` of the backup ``item`` is from (unless the
+        item has ``_seen``)
+    :returns: iterator of the revisions of an item, newest first: dicts
+        of ``edited``, ``seen`` and ``REVISION_KEYS`` (with full text)
+    """
+    revision = OrderedDict((
+        ('edited', item.get('edited')),
+        ('seen', item.get('_seen', seen))))
+    for key in REVISION_KEYS:
+        if key in item:
+            revision[key] = item[key]
+    yield revision
+    for delta in item.get('_revisions', ()):
+        older = OrderedDict(revision)
+        for key, value in delta.items():
+            if isinstance(value, list):
+                value = apply_delta(revision[key], value)
+            older[key] = value
+        yield older
+        revision = older
+
+
+def encode_revisions(revisions):
+    """
+    :param revisions: full revisions, newest first
+    :returns: ``_revisions``: each revision after the first, with the
+        ``REVISION_KEYS`` which differ from the next newer revision (text
+        as a :py:func:`text_delta` when that is shorter)
+    """
+    deltas = []
+    for newer, older in zip(revisions, revisions[1:]):
+        delta = OrderedDict((
+            ('edited', older['edited']), ('seen', older['seen'])))
+        for key in REVISION_KEYS:
+            value, newer_value = older.get(key), newer.get(key)
+            if value == newer_value:
+                continue
+            if isinstance(value, str) and isinstance(newer_value, str):
+                ops = text_delta(newer_value, value)
+                if len(json.dumps(ops)) < len(json.dumps(value)):
+                    value = ops
+            delta[key] = value
+        deltas.append(delta)
+    return deltas
+
+
+def merge_revisions(versions):
+    """
+    merge versions of one item into the newest (see
+    :py:func:`is_newer_edit`; between versions edited at the same time,
+    the one from the later backup), keeping the older text and scores as
+    a revision chain (``_revisions``, newest first, with the ``date_utc``
+    of the newest version's backup as ``_seen``)
+
+    The newest text is stored as is; each older revision is stored as a
+    delta against the next newer one (see :py:func:`encode_revisions`).
+
+    :param versions: list of (item, ``date_utc`` of its backup or None)
+    :returns: merged item
+    """
+    heads = [next(iter_revisions(item, seen)) for item, seen in versions]
+    newest = max(range(len(versions)),
+                 key=lambda n: (revision_key(heads[n]), -n))
+    item = versions[newest][0]
+    if (not any('_revisions' in x for x, _ in versions) and
+            len(set(revision_fields(x) for x in heads)) == 1):
+        return item
+    revisions = []
+    for n, (_item, seen) in enumerate(versions):
+        for k, revision in enumerate(iter_revisions(_item, seen)):
+            if not (n == newest and k == 0):
+                revisions.append(revision)
+    chain = []
+    for revision in sorted(revisions, key=revision_key):
+        if chain and revision_fields(chain[-1]) == revision_fields(revision):
+            continue
+        chain.append(revision)
+    if chain and revision_fields(chain[-1]) == revision_fields(heads[newest]):
+        chain.pop()
+    item = item.copy()
+    item.pop('_revisions', None)
+    item.pop('_seen', None)
+    if chain:
+        item['_seen'] = heads[newest]['seen']
+        item['_revisions'] = encode_revisions([heads[newest]] + chain[::-1])
+    return item
+
+
+def print_revisions(item, format='text', file=None):
+    """
+    print the revisions of an item (see :py:func:`iter_revisions`):
+    ``text`` as a diff per revision, ``json`` as a list of revisions
+    """
+    import difflib
+    revisions = list(iter_revisions(item))
+    if format == 'json':
+        print(json.dumps(revisions, indent=2), file=file)
+        return
+
+    def label(revision):
+        return u'%s (edited: %s, score: %s)' % (
+            revision['seen'],
+            format_date(revision['edited']) if revision['edited'] else '-',
+            revision.get('score'))
+    print(u'%s %s' % (item['id'], item.get('permalink', '')), file=file)
+    for newer, older in zip(revisions, revisions[1:]):
+        print(u'--- %s' % label(older), file=file)
+        print(u'+++ %s' % label(newer), file=file)
+        for key in ('body', 'selftext'):
+            if older.get(key) != newer.get(key):
+                for line in list(difflib.unified_diff(
+                        (older.get(key) or u'').splitlines(),
+                        (newer.get(key) or u'').splitlines(),
+                        lineterm=u''))[2:]:
+                    print(line, file=file)
+    if len(revisions) == 1:
+        print(u'(no revisions)', file=file)
+
+
+created_utc_key = itemgetter('created_utc')
+
+
+class MergeInput(object):
+    """
+    one input file of a k-way merge (see :py:func:`iter_merged`)
+
+    Each section is spooled to a temporary NDJSON file sorted by
+    ``created_utc`` (newest first). NDJSON inputs are copied a line at a
+    time and only re-sorted if they are out of order; JSON inputs are
+    loaded one at a time.
+
+    :param label: name recorded in ``_meta['merged_from']`` (default:
+        ``filename``; None: not recorded)
+    """
+    def __init__(self, filename, tmpdir, sections=SECTIONS, label=''):
+        self.filename = filename
+        self.label = filename if label == '' else label
+        self.meta = OrderedDict()
+        self.paths = OrderedDict()
+        prefix = os.path.join(tmpdir, '%d' % id(self))
+        files = {}
+        last = {}
+        unsorted = set()
+        try:
+            for section, item in iter_records(filename):
+                if section == '_meta':
+                    self.meta.update(item)
+                    continue
+                if section not in sections:
+                    continue
+                if section not in files:
+                    self.paths[section] = '%s.%s.ndjson' % (prefix, section)
+                    files[section] = codecs.open(
+                        self.paths[section], 'w', encoding='utf-8')
+                elif item['created_utc'] > last[section]:
+                    unsorted.add(section)
+                last[section] = item['created_utc']
+                files[section].write(dumps(item) + '\n')
+        finally:
+            for fp in files.values():
+                fp.close()
+        for section in unsorted:
+            log.info("%-14s: sorting %r" % (section, filename))
+            items = sorted(
+                self.iter_section(section), key=created_utc_key,
+                reverse=True)
+            with codecs.open(
+                    self.paths[section], 'w', encoding='utf-8') as fp:
+                for item in items:
+                    fp.write(dumps(item) + '\n')
+
+    def iter_section(self, section):
+        path = self.paths.get(section)
+        if path is None:
+            return
+        with codecs.open(path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                yield json.loads(line, object_pairs_hook=record_pairs_hook)
+
+    def iter_versions(self, section):
+        """
+        :returns: iterator of (item, ``date_utc`` of this backup)
+        """
+        seen = self.meta.get('date_utc')
+        for item in self.iter_section(section):
+            yield item, seen
+
+
+def iter_merged(inputs, section):
+    """
+    k-way merge of the (sorted) ``section`` of each input, newest first
+
+    Items with the same id have the same ``created_utc``, so duplicates
+    are merged (see :py:func:`merge_revisions`) within a window of the
+    items sharing one timestamp.
+
+    :param inputs: :py:class:`MergeInput` objects
+    :returns: iterator of items
+    """
+    streams = [_input.iter_versions(section) for _input in inputs]
+    window = OrderedDict()
+    window_utc = None
+    for version in heapq.merge(
+            *streams, key=lambda x: x[0]['created_utc'], reverse=True):
+        item = version[0]
+        if item['created_utc'] != window_utc:
+            for versions in window.values():
+                yield (versions[0][0] if len(versions) == 1
+                       else merge_revisions(versions))
+            window.clear()
+            window_utc = item['created_utc']
+        window.setdefault(item['id'], []).append(version)
+    for versions in window.values():
+        yield (versions[0][0] if len(versions) == 1
+               else merge_revisions(versions))
+
+
+def merge_meta(inputs, meta=None):
+    meta = OrderedDict(meta) if meta else OrderedDict()
+    merged_from = meta['merged_from'] = OrderedDict(
+        meta.get('merged_from', ()))
+    for _input in inputs:
+        log.info("%s: %s" % (_input.filename, _input.meta))
+        if _input.label is not None:
+            merged_from[_input.label] = _input.meta
+    return meta
+
+
+def merge_json_files(filenames, data=None, label=None):
+    """
+    merge json data files into one dict
+
+    The inputs are merged as in :py:func:`merge_files`, but the merged
+    sections are returned as lists (use :py:func:`merge_files` to write
+    them to a file without holding them in memory).
+
+    :param filenames: JSON or NDJSON backups
+    :param data: (optional) already loaded data to merge with
+    :param label: name to record ``data`` as in ``_meta['merged_from']``
+        (None: ``data`` is not recorded; its ``_meta`` is the base)
+    :returns: dict of merged comments and submissions
+    """
+    sections = SECTIONS
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputs = []
+        if data:
+            _data_filename = os.path.join(tmpdir, 'data.ndjson')
+            dump_ndjson(data, _data_filename)
+            inputs.append(MergeInput(_data_filename, tmpdir, label=label))
+        for filename in filenames:
+            log.info("loading: %r" % filename)
+            inputs.append(MergeInput(filename, tmpdir))
+        final_data = dict.fromkeys(sections, [])
         for subset in sections:
-            log.info("subtotal      : %d %s" % (len(all_data[subset]), subset))
-    final_data = dict.fromkeys(sections, [])
-    final_data['_meta'] = all_data['_meta']
-    for subset in sections:
-        final_data[subset] = sorted(
-            all_data[subset].itervalues(),
-            key=lambda x: x['created_utc'],
-            reverse=True,  # TODO
-        )
+            final_data[subset] = list(iter_merged(inputs, subset))
+            log.info("total         : %d %s" % (
+                len(final_data[subset]), subset))
+        final_data['_meta'] = merge_meta(
+            inputs, data.get('_meta') if data else None)
     return final_data
 
 
-def prepare_context_data(data):
-    # TODO: data = data.copy()
-    # TODO: data['prov'] = ...
-    html_keys = {'body_html': 0, 'selftext_html': 0}
-    link_keys = {'permalink': 0, 'link': 0}
-    date_keys = {'created': 0, 'created_utc': 0, 'edited': 0}
-    data['uris'] = process_urls(data)
-    for subset in ('comments', 'submissions'):
-        _objs = data[subset]
-        for _data in _objs:
-            for key in list(_data.keys()):
-                if key in html_keys:  # XXX TODO FIXME
-                    _orig = _data[key]
-                    if _orig:
-                        _data[key] = Markup(_orig)
-                        _data['charcount'] = len(_orig)
-                elif key in link_keys:
-                    _orig = _data[key]
-                    if _orig:
-                        # plain_link % (_orig, _orig)
-                        _data[key] = Markup(_orig)
-                elif key in date_keys:
-                    _orig = _data[key]
-                    if _orig:
-                        _dt = datetime.datetime.fromtimestamp(_orig)
-                        _data[key] = _dt.strftime('%Y-%m-%d-%H:%M:%S')
-    return data
+def merge_files(filenames, output_filename):
+    """
+    merge JSON, NDJSON or archive backups into ``output_filename`` (of any
+    of these formats, see :py:func:`dump`), writing items
+    as they are merged (peak memory does not depend on the number of
+    input files)
+
+    :returns: dict of section -> number of items written
+    """
+    sections = SECTIONS
+    output_filename = expand_path(output_filename)
+    counts = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputs = []
+        for filename in filenames:
+            log.info("loading: %r" % filename)
+            inputs.append(MergeInput(filename, tmpdir))
+        if is_archive(output_filename):
+            writer = ArchiveWriter(output_filename)
+            for subset in sections:
+                counts[subset] = 0
+                for item in iter_merged(inputs, subset):
+                    writer.write(subset, item)
+                    counts[subset] += 1
+                log.info("total         : %d %s" % (counts[subset], subset))
+            writer.write_meta(merge_meta(inputs))
+            writer.close()
+            return counts
+        ndjson = is_ndjson(output_filename)
+        tmp_filename = output_filename + '.tmp'
+        with codecs.open(tmp_filename, 'w', encoding='utf-8') as fp:
+            if not ndjson:
+                fp.write('{')
+            for subset in sections:
+                counts[subset] = 0
+                if not ndjson:
+                    fp.write('%s: [' % json.dumps(subset))
+                for item in iter_merged(inputs, subset):
+                    if ndjson:
+                        fp.write(dumps({subset: item}) + '\n')
+                    else:
+                        fp.write(', ' if counts[subset] else '')
+                        fp.write(dumps(item))
+                    counts[subset] += 1
+                if not ndjson:
+                    fp.write('], ')
+                log.info("total         : %d %s" % (counts[subset], subset))
+            meta = merge_meta(inputs)
+            if ndjson:
+                fp.write(json.dumps({'_meta': meta}) + '\n')
+            else:
+                fp.write('"_meta": %s}' % json.dumps(meta))
+        os.replace(tmp_filename, output_filename)
+    return counts
+
+
+HTML_KEYS = ('body_html', 'selftext_html')
+LINK_KEYS = ('permalink', 'link')
+DATE_KEYS = ('created', 'created_utc', 'edited')
+DATE_FORMAT = '%Y-%m-%d-%H:%M:%S'
+
+
+@functools.lru_cache(maxsize=2**16)
+def format_timestamp(seconds):
+    """
+    :param seconds: whole seconds since the epoch (local time)
+    """
+    return datetime.datetime.fromtimestamp(seconds).strftime(DATE_FORMAT)
+
 
+def format_date(value):
+    """
+    format a timestamp with ``DATE_FORMAT`` (formatted dates are
+    returned as they are)
+    """
+    if isinstance(value, str):
+        return value
+    return format_timestamp(int(value))
 
-def redem_summary_context(data, **kwargs):
+
+def prepare_items(items):
+    """
+    wrap HTML and links in ``Markup``, format dates and add ``charcount``,
+    a key (column) at a time
+
+    :returns: list of prepared copies of ``items`` (which are not modified)
+    """
+    from jinja2 import Markup
+    prepared = [item.copy() for item in items]
+    for key in HTML_KEYS:
+        for item in prepared:
+            value = item.get(key)
+            if value:
+                item[key] = Markup(value)
+                item['charcount'] = len(value)
+    for key in LINK_KEYS:
+        for item in prepared:
+            value = item.get(key)
+            if value:
+                item[key] = Markup(value)
+    for key in DATE_KEYS:
+        for item in prepared:
+            value = item.get(key)
+            if value:
+                item[key] = format_date(value)
+    return prepared
+
+
+def prepare_context_data(data, processes=None, uri_index=None, uris=None):
+    """
+    :param uris: (uri, count) list already returned by
+        :py:func:`process_urls` for ``data``
+    :returns: the prepared sections of ``data`` (see
+        :py:func:`prepare_items`) and its ``uris`` (``data`` is not
+        modified)
+    """
+    if uris is None:
+        uris = process_urls(data, processes=processes, uri_index=uri_index)
+    context_data = OrderedDict()
+    context_data['_meta'] = data.get('_meta', {})
+    for section in SECTIONS:
+        context_data[section] = prepare_items(data.get(section, []))
+    context_data['uris'] = uris
+    return context_data
+
+
+def template_context(data, **kwargs):
+    """
+    :returns: the template context shared by every page (without ``data``)
+    """
+    from jinja2 import Markup
     context = {}
     context['username'] = data.get('_meta', {}).get('username')
-    context['data'] = prepare_context_data(data)
     context.update(kwargs)
     context['title'] = context.get(
         'title',
@@ -515,11 +2696,32 @@ def redem_summary_context(data, **kwargs):
     return context
 
 
-def get_template_env():
+def redem_summary_context(data, processes=None, uri_index=None, uris=None,
+                          **kwargs):
+    context = template_context(data, **kwargs)
+    context['data'] = prepare_context_data(
+        data, processes=processes, uri_index=uri_index, uris=uris)
+    return context
+
+
+# compiled templates are cached across runs
+# (``None``: a per-user directory in the system temp directory)
+TEMPLATE_CACHE_DIR = None
+STREAM_BUFFER_SIZE = 64
+
+
+@functools.lru_cache(maxsize=None)
+def get_template_env(cache_dir=TEMPLATE_CACHE_DIR):
+    """
+    :returns: the (per-process) template ``Environment``, with a
+        bytecode cache in ``cache_dir``
+    """
+    from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader
     env = Environment(
         #loader=FileSystemLoader(os.path.dirname(__file__)),
         loader=PackageLoader('redem', 'templates'),
         autoescape=True,
+        bytecode_cache=FileSystemBytecodeCache(cache_dir),
         )
     return env
 
@@ -536,14 +2738,271 @@ def write_html(filename, content):
         fp.write(content)
 
 
+def stream_template(template_name, context, filename):
+    """
+    render a template in buffered chunks to ``filename`` (``-``: stdout)
+    without building the whole page in memory
+    """
+    template = get_template_env().get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    if filename == '-':
+        stream.dump(sys.stdout)
+        sys.stdout.flush()
+    else:
+        # (codecs writers join the chunks in writelines)
+        with io.open(filename, 'w', encoding='utf-8') as fp:
+            stream.dump(fp)
+    return filename
+
+
+def write_redem_summary(data, filename, **kwargs):
+    """
+    stream :py:func:`redem_summary` to ``filename`` (``-``: stdout)
+    """
+    context = redem_summary_context(data, **kwargs)
+    return stream_template('redem_summary.jinja2', context, filename)
+
+
+SHARD_INDEX = 'index.html'
+SHARD_TEMPLATES = (
+    'base.jinja2', '_comment_rows.jinja2', '_comment_table.jinja2',
+    '_comment_cards.jinja2', '_submission_rows.jinja2',
+    '_submission_table.jinja2', '_submission_cards.jinja2',
+    '_uri_table.jinja2', 'redem_shard.jinja2', 'redem_index.jinja2')
+MANIFEST_FILENAME = '.redem_manifest.json'
+
+
+def shard_data(data, shard_by='month'):
+    """
+    split the comments and submissions of ``data`` into pages
+
+    Pages of ``shard_by`` items are numbered from the oldest item, so that
+    new items only change the newest page.
+
+    :param shard_by: ``month`` or a number of items per page
+    :returns: OrderedDict of shard name -> dict of section -> items,
+        newest first
+    """
+    shards = OrderedDict()
+    if shard_by == 'month':
+        for section in SECTIONS:
+            for item in data[section]:
+                name = datetime.datetime.utcfromtimestamp(
+                    item['created_utc']).strftime('%Y-%m')
+                shards.setdefault(
+                    name, dict((x, []) for x in SECTIONS))[section].append(
+                        item)
+        return OrderedDict(sorted(shards.items(), reverse=True))
+    size = int(shard_by)
+    items = heapq.merge(
+        *[zip(itertools.repeat(section), sorted(
+            data[section], key=created_utc_key))
+          for section in SECTIONS],
+        key=lambda x: x[1]['created_utc'])
+    for n, chunk in enumerate(iter_chunks(items, size)):
+        shard = shards['page-%04d' % (n + 1)] = dict(
+            (x, []) for x in SECTIONS)
+        for section, item in reversed(chunk):
+            shard[section].append(item)
+    return OrderedDict(reversed(shards.items()))
+
+
+def content_digest(*objs):
+    """
+    :returns: hex digest of the JSON serialization of ``objs``
+    """
+    digest = hashlib.sha1()
+    for obj in objs:
+        digest.update(json.dumps(
+            obj, sort_keys=True,
+            default=lambda x: x.to_dict() if isinstance(x, Record) else str(x)
+        ).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def templates_digest(env, names=SHARD_TEMPLATES):
+    """
+    :returns: hex digest of the sources of the templates ``names``
+    """
+    return content_digest(
+        [env.loader.get_source(env, name)[0] for name in names])
+
+
+class RenderManifest(OrderedDict):
+    """
+    content digests of the pages in an output directory, keyed by
+    filename, with the index table rows of each shard page
+    (see :py:func:`redem_shards`)
+
+    ::
+
+        {"redem-2014-01.html": {"digest": "0beec7b5...",
+                                "rows": {"comments": "<tr>...",
+                                         "submissions": ""}}}
+
+    """
+    def __init__(self, filename=None):
+        super(RenderManifest, self).__init__()
+        self.filename = filename
+
+    def load(self, filename=None):
+        filename = filename or self.filename
+        if filename and os.path.exists(filename):
+            with codecs.open(filename, 'r', encoding='utf-8') as fp:
+                self.update(json.load(fp, object_pairs_hook=OrderedDict))
+        return self
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        if filename is None:
+            return
+        with codecs.open(filename, 'w', encoding='utf-8') as fp:
+            json.dump(self, fp)
+
+    def is_current(self, filename, digest, output_dir):
+        """
+        whether ``filename`` was rendered from input with ``digest``
+        """
+        entry = self.get(filename)
+        return bool(
+            entry and entry['digest'] == digest
+            and os.path.exists(os.path.join(output_dir, filename)))
+
+
+def render_to_file(args):
+    """
+    render a template to a file (in a worker process)
+
+    :param args: (template name, context, filename)
+    """
+    return stream_template(*args)
+
+
+def redem_shards(data, output_dir, shard_by='month', processes=None,
+                 uri_index=None, uris=None, links=None, force=False,
+                 **kwargs):
+    """
+    write one page per shard (see :py:func:`shard_data`) and an index
+    page with the summary tables, rendering the pages in a process pool
+
+    Pages whose items, neighbours and templates are unchanged since the
+    last run (see :py:class:`RenderManifest`) are not prepared or
+    rendered again; the index is assembled from the table rows cached
+    for each shard.
+
+    :param output_dir: directory to write ``SHARD_INDEX`` and shards to
+    :param uris: (uri, count) list already returned by
+        :py:func:`process_urls` for ``data``
+    :param links: dict of uri -> ``redem.linkcheck.LinkResult`` for the
+        index URL table (see :py:func:`redem.linkcheck.check_links`)
+    :param force: render every page
+    :returns: list of filenames written
+    """
+    from jinja2 import Markup
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    env = get_template_env()
+    manifest = RenderManifest(os.path.join(output_dir, MANIFEST_FILENAME))
+    if not force:
+        manifest.load()
+    context = template_context(data, **kwargs)
+    context['index_filename'] = SHARD_INDEX
+    base_digest = content_digest(templates_digest(env), context)
+
+    shards = shard_data(data, shard_by)
+    shard_list = []
+    for name, shard in shards.items():
+        shard_list.append(OrderedDict((
+            ('name', name),
+            ('filename', 'redem-%s.html' % name),
+            ('comments', len(shard['comments'])),
+            ('submissions', len(shard['submissions'])))))
+
+    tasks = []
+    digests = OrderedDict()
+    comment_rows = env.get_template('_comment_rows.jinja2')
+    submission_rows = env.get_template('_submission_rows.jinja2')
+    for n, (name, shard) in enumerate(shards.items()):
+        filename = shard_list[n]['filename']
+        previous = shard_list[n - 1] if n else None
+        _next = shard_list[n + 1] if n + 1 < len(shard_list) else None
+        digest = digests[filename] = content_digest(
+            base_digest, previous, _next, shard)
+        if manifest.is_current(filename, digest, output_dir):
+            continue
+        shard = dict(
+            (section, prepare_items(shard[section])) for section in SECTIONS)
+        manifest[filename] = OrderedDict((
+            ('digest', digest),
+            ('rows', OrderedDict((
+                ('comments', comment_rows.render(
+                    comments=shard['comments'], href=lambda x: filename)),
+                ('submissions', submission_rows.render(
+                    submissions=shard['submissions'],
+                    href=lambda x: filename)))))))
+        tasks.append(('redem_shard.jinja2', dict(
+            context,
+            data=shard,
+            shard=shard_list[n],
+            previous=previous,
+            next=_next),
+            os.path.join(output_dir, filename)))
+    log.info("%-14s: %d of %d" % ('shards changed', len(tasks), len(shards)))
+
+    for filename in [x for x in manifest
+                     if x not in digests and x != SHARD_INDEX]:
+        del manifest[filename]
+        if os.path.exists(os.path.join(output_dir, filename)):
+            os.remove(os.path.join(output_dir, filename))
+
+    filenames = []
+    if tasks:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes) as pool:
+            filenames = list(pool.map(render_to_file, tasks))
+
+    if uris is None:
+        uris = process_urls(data, processes=processes, uri_index=uri_index)
+    # (latencies and check times alone do not change the index)
+    link_status = links and [
+        (link.status, link.final_url, link.error)
+        for link in (links.get(uri) for uri, _ in uris) if link]
+    digest = content_digest(
+        base_digest, list(digests.values()), uris, link_status)
+    if not manifest.is_current(SHARD_INDEX, digest, output_dir):
+        rows = dict(
+            (section, Markup(u''.join(
+                manifest[x['filename']]['rows'][section]
+                for x in shard_list)))
+            for section in SECTIONS)
+        filenames.insert(0, render_to_file((
+            'redem_index.jinja2',
+            dict(context, shards=shard_list, index_rows=rows,
+                 data={'uris': uris}, links=links),
+            os.path.join(output_dir, SHARD_INDEX))))
+        manifest[SHARD_INDEX] = {'digest': digest}
+    manifest.save()
+    log.info("wrote %d pages to %r" % (len(filenames), output_dir))
+    return filenames
+
+
 class Test_redem(unittest.TestCase):
     def test_redem_summary(self):
-        DATADIR = os.path.join(os.path.dirname(__file__), '..', 'data')
-        jsondata_filename = os.path.join(DATADIR, 'data.json')
+        import shutil
+        import tempfile
+        from redem.bench import make_archive
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        jsondata_filename = os.path.join(tmpdir, 'data.json')
+        dump(make_archive(100), jsondata_filename)
         data = load(filename=jsondata_filename)
         self.assertTrue(data)
         output = redem_summary(data)
         assert '<title>' in output
+        self.assertEqual(output.count('id="comment/'), 100)
+        self.assertEqual(output.count('id="submission/'), 10)
+        self.assertIn('href="http://en.m.wikipedia.org/path/1"', output)
 
     def test_iter_uris_regex(self):
         text = (
@@ -574,6 +3033,478 @@ class Test_redem(unittest.TestCase):
         uris = list(iter_uris_bs4(text))
         self.assertEqual(len(uris), 2)
 
+    def test_uri_extractors(self):
+        texts = (
+            '<a href="http://example.org">example</a>'
+            '<a href="example.org">example<>',
+            '<div class="md"><p><a href="http://example.org/?a=1&amp;b=2">'
+            'x</a> <a name="anchor">y</a><br/><a href="/r/Python">z</a>'
+            '</p></div>',
+            '')
+        for text in texts:
+            expected = list(iter_uris_bs4(text))
+            self.assertEqual(list(iter_uris_htmlparser(text)), expected)
+        self.assertEqual(
+            extract_uris_batch(texts, extractor='htmlparser', processes=2),
+            [list(iter_uris_bs4(text)) for text in texts])
+
+    def test_canonicalize_uri(self):
+        uris = (
+            'http://docs.rtfd.org/en/latest/', 'http://user.github.com/x',
+            'http://gist.github.com/1', 'HTTP://example.org/',
+            '/r/Python', '/u/example', 'example.org', 'mailto:a@b.c',
+            'http://pip.readthedocs.org/', None)
+        for uri in uris:
+            self.assertEqual(
+                canonicalize_uri(uri), canonicalize_uri_uncached(uri))
+        self.assertEqual(
+            list(canonicalize_uris(uris + uris).values()),
+            [canonicalize_uri_uncached(uri) for uri in uris])
+
+    def test_uri_index(self):
+        import shutil
+        import tempfile
+        comment = {'id': 'c1', 'edited': False, 'permalink': '/r/a/c1',
+                   'body_html': '<a href="http://example.org">x</a>'}
+        submission = {'id': 's1', 'url': 'http://example.org',
+                      'permalink': '/r/a/s1', 'selftext_html': None}
+        data = {'comments': [comment], 'submissions': [submission]}
+        uri_index = URIIndex()
+        self.assertEqual(process_urls(data, uri_index=uri_index), [
+            ('http://example.org', 2),
+            ('http://www.reddit.com/r/a/c1', 1),
+            ('http://www.reddit.com/r/a/s1', 1)])
+        self.assertEqual(
+            uri_index.sources('http://example.org'),
+            [URIRef('http://example.org', 'comments', 'c1'),
+             URIRef('http://example.org', 'submissions', 's1')])
+        self.assertEqual(
+            uri_index.domains(),
+            [('example.org', 2, 1), ('www.reddit.com', 2, 2)])
+        self.assertEqual(uri_index.update(data), 0)
+        data['comments'] = [dict(comment, edited=1, body_html='')]
+        self.assertEqual(uri_index.update(data), 1)
+        self.assertEqual(len(uri_index.sources('http://example.org')), 1)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'uri_index.json')
+        uri_index.save(filename)
+        self.assertEqual(URIIndex.load(filename).counts(), uri_index.counts())
+
+    def test_comment_permalink(self):
+        Subreddit = collections.namedtuple('Subreddit', ('display_name',))
+        Comment = collections.namedtuple(
+            'Comment', ('id', 'link_id', 'subreddit', 'subreddit_id'))
+        comment = Comment('c1', 't3_s1', Subreddit('Python'), 't5_2qh0y')
+        global METADATA
+        metadata, METADATA = METADATA, MetadataCache()
+        self.addCleanup(globals().__setitem__, 'METADATA', metadata)
+        self.assertEqual(
+            comment_permalink(comment),
+            'http://www.reddit.com/r/Python/comments/s1/_/c1')
+        # cached submission permalinks do not change the comment permalink
+        METADATA.store(
+            't3_s1',
+            permalink='http://www.reddit.com/r/Python/comments/s1/title/')
+        self.assertEqual(
+            comment_permalink(comment),
+            'http://www.reddit.com/r/Python/comments/s1/_/c1')
+        self.assertEqual(hydrate(None, [comment]), 0)
+        self.assertEqual(
+            [len(c) for c in iter_chunks(range(250), 100)], [100, 100, 50])
+
+    def test_metadata_cache(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'data', 'subreddit_cache.json')
+        cache = MetadataCache(filename, maxsize=2)
+        cache.store('t5_a', display_name='a')
+        cache.store('t5_b', display_name='b')
+        cache.lookup('t5_a', 'display_name')
+        cache.store('t5_c', display_name='c')
+        self.assertTrue(cache.save())
+        self.assertEqual(os.listdir(os.path.dirname(filename)),
+                         ['subreddit_cache.json'])
+        cache = MetadataCache(filename).load()
+        self.assertEqual(list(cache), ['t5_a', 't5_c'])
+        # an unwritable or corrupt cache is only a warning
+        self.assertFalse(cache.save(os.path.join(filename, 'x.json')))
+        with open(filename, 'w') as fp:
+            fp.write('{"t5_a": ')
+        self.assertEqual(list(MetadataCache(filename).load()), [])
+        self.assertEqual(cache.missing(['t5_a', 't5_b'], 'display_name'),
+                         ['t5_b'])
+        cache.ttl = -1
+        self.assertEqual(cache.lookup('t5_a', 'display_name'), None)
+
+    def test_incremental(self):
+        Thing = collections.namedtuple('Thing', ('id', 'created_utc'))
+        listing = [Thing('c3', 30), Thing('c2', 20), Thing('c1', 10)]
+        self.assertEqual(
+            [x.id for x in iter_listing(iter(listing), since=20)],
+            ['c3', 'c2'])
+        archive = {
+            'comments': [
+                {'id': 'c2', 'created_utc': 20, 'edited': False, 'score': 1},
+                {'id': 'c1', 'created_utc': 10, 'edited': False}],
+            'submissions': []}
+        self.assertEqual(
+            get_incremental_since(archive, refresh_days=1),
+            {'comments': 20 - 86400, 'submissions': None})
+        delta = {
+            'comments': [
+                {'id': 'c3', 'created_utc': 30, 'edited': False},
+                {'id': 'c2', 'created_utc': 20, 'edited': False, 'score': 2}],
+            'submissions': []}
+        data = update_data(archive, delta)
+        self.assertEqual([x['id'] for x in data['comments']],
+                         ['c3', 'c2', 'c1'])
+        self.assertEqual(data['comments'][1]['score'], 2)
+
+    def test_fetch_listings(self):
+        limiter = RateLimiter(rate=1000, burst=1)
+        limiter.acquire()
+        self.assertTrue(limiter.acquire() > 0)
+
+        def to_dicts(reddit, things):
+            for thing in things:
+                limiter.acquire()
+                yield {'id': thing}
+        listings = OrderedDict([
+            ('comments', (iter(['c1', 'c2']), to_dicts)),
+            ('submissions', (iter(['s1']), to_dicts))])
+        data = fetch_listings(None, listings)
+        self.assertEqual(list(data), ['comments', 'submissions'])
+        self.assertEqual(data['comments'], [{'id': 'c1'}, {'id': 'c2'}])
+
+    def test_raw_comment_to_dict(self):
+        data = RawThing(
+            link_id='t3_s9', link_title='title', id='c9', author='a',
+            body='body', body_html='&lt;p&gt;body&lt;/p&gt;',
+            created=1.0, created_utc=2.0, edited=False, score=1, ups=1,
+            downs=0, subreddit='Python', subreddit_id='t5_2qh0y')
+        self.assertEqual(data.subreddit, 'Python')
+        # (entities are decoded by request_json)
+        comment = raw_comment_to_dict(decode_html_entities(data))
+        self.assertEqual(
+            list(comment),
+            list(COMMENT_ATTRS) + [
+                'type', 'author_name', 'subreddit', 'permalink'])
+        self.assertEqual(comment['body_html'], '<p>body</p>')
+        self.assertEqual(
+            comment['permalink'],
+            'http://www.reddit.com/r/Python/comments/s9/_/c9')
+
+    def test_ndjson(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'data.ndjson')
+        writer = NDJSONWriter(filename)
+        writer.write('comments', {'id': 'c2', 'created_utc': 2})
+        writer.write('submissions', {'id': 's1', 'created_utc': 1})
+        writer.commit()
+        writer.write('comments', {'id': 'c1', 'created_utc': 1})
+        # (a crash: the checkpoint is kept)
+        writer.fp.close()
+        writer = NDJSONWriter(filename, resume=True)
+        self.assertEqual(writer.get_after('comments'), 't1_c2')
+        # listings which reached the limit are not fetched again
+        fetch_user(None, 'example', limit=1, engine='raw', writer=writer)
+        self.assertTrue(writer.is_done('comments'))
+        self.assertTrue(writer.is_done('submissions'))
+        writer.write('comments', {'id': 'c1', 'created_utc': 1})
+        writer.done('comments')
+        writer.write_meta({'username': 'example'})
+        writer.close()
+        self.assertFalse(os.path.exists(writer.checkpoint_filename))
+        data = load(filename=filename)
+        self.assertEqual([x['id'] for x in data['comments']], ['c2', 'c1'])
+        self.assertEqual(data['_meta'], {'username': 'example'})
+        data = merge_json_files([filename])
+        self.assertEqual([x['id'] for x in data['comments']], ['c2', 'c1'])
+
+    def test_record(self):
+        import pickle
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'data.json')
+        items = [OrderedDict((
+            ('id', 'c%d' % n), ('created_utc', n), ('edited', False),
+            ('subreddit', 'Python'), ('body', 'body %d' % n)))
+            for n in range(2)]
+        dump({'_meta': {'username': 'example'}, 'comments': items,
+              'submissions': []}, filename)
+        data = load(filename=filename)
+        records = data['comments']
+        self.assertIsInstance(records[0], Record)
+        self.assertNotIsInstance(data['_meta'], Record)
+        self.assertEqual(records, items)
+        self.assertEqual(list(records[0]), list(items[0]))
+        self.assertIs(records[0]._shape, records[1]._shape)
+        self.assertIs(records[0]['subreddit'], records[1]['subreddit'])
+
+        record = records[0].copy()
+        record['charcount'] = 6
+        del record['edited']
+        self.assertEqual(
+            list(record), ['id', 'created_utc', 'subreddit', 'body',
+                           'charcount'])
+        self.assertNotIn('charcount', records[0])
+        self.assertEqual(record.get('edited', 1), 1)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+        self.assertEqual(json.loads(dumps(record)), dict(record))
+        self.assertEqual(Record(items[1], edited=2)['edited'], 2)
+
+    def test_archive(self):
+        import gzip
+        import shutil
+        import tempfile
+        from redem import bench
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        data = bench.make_archive(250)
+        filename = os.path.join(tmpdir, 'data.ndjson.gz')
+        dump_archive(data, filename, block_size=100)
+        self.assertTrue(is_archive(filename))
+        self.assertEqual(load(filename=filename), data)
+
+        with Archive(filename) as archive:
+            self.assertEqual(len(archive.blocks), 3 + 1)
+            comment = data['comments'][150]
+            self.assertEqual(archive.get('comments', comment['id']), comment)
+            self.assertIsNone(archive.get('submissions', comment['id']))
+            self.assertEqual(archive.blocks_read, 1)
+            since = data['comments'][120]['created_utc']
+            until = data['comments'][80]['created_utc']
+            self.assertEqual(
+                list(archive.iter_section('comments', since, until)),
+                data['comments'][81:121])
+            self.assertEqual(archive.blocks_read, 2)
+
+        selected = load(filename=filename, ids=[comment['id'], 's1'])
+        self.assertEqual(selected['comments'], [comment])
+        self.assertEqual(selected['submissions'], [data['submissions'][1]])
+        self.assertEqual(
+            load(filename=filename, since=since, until=until)['comments'],
+            data['comments'][81:121])
+
+        # the blocks are one gzip stream of NDJSON lines
+        ndjson = os.path.join(tmpdir, 'data.ndjson')
+        with gzip.open(filename, 'rb') as fp, open(ndjson, 'wb') as out:
+            out.write(fp.read())
+        self.assertEqual(load_ndjson(ndjson), data)
+        os.remove(filename + ARCHIVE_INDEX_SUFFIX)
+        self.assertEqual(load(filename=filename), data)
+
+        merged = os.path.join(tmpdir, 'merged.ndjson.gz')
+        snapshots = bench.make_snapshots(100)
+        for n, snapshot in enumerate(snapshots):
+            dump(snapshot, os.path.join(tmpdir, '%d.ndjson.gz' % n))
+        filenames = [os.path.join(tmpdir, '%d.ndjson.gz' % n)
+                     for n in range(len(snapshots))]
+        expected = merge_json_files(filenames)
+        merge_files(filenames, merged)
+        self.assertEqual(load(filename=merged)['comments'],
+                         expected['comments'])
+
+    def test_revisions(self):
+        import shutil
+        import tempfile
+        from redem import bench
+        new = u'see http://example.org/ for the new text'
+        old = u'see http://example.org for the old text, first'
+        self.assertEqual(apply_delta(new, text_delta(new, old)), old)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshots = bench.make_snapshots(20)
+        [x for x in snapshots[1]['comments'] if x['id'] == 'c28'][0][
+            'score'] = 99
+        filenames = []
+        for n, snapshot in enumerate(snapshots):
+            filenames.append(os.path.join(tmpdir, '%d.json' % n))
+            dump(snapshot, filenames[-1])
+        data = merge_json_files(filenames)
+        comments = dict((x['id'], x) for x in data['comments'])
+        self.assertEqual(
+            sorted(x for x in comments if '_revisions' in comments[x]),
+            ['c14', 'c21', 'c28'])
+        self.assertEqual(comments['c21']['body'][:20], 'comment 21 (edit 1)\n')
+        revisions = list(iter_revisions(comments['c21']))
+        self.assertEqual(
+            [(x['seen'], x['body'][:12]) for x in revisions],
+            [('2013-09-25T05:20:00', 'comment 21 ('),
+             ('2013-09-24T05:20:00', 'comment 21\n\n')])
+        self.assertIsInstance(comments['c21']['_revisions'][0]['body'], list)
+        self.assertEqual(
+            [x['score'] for x in iter_revisions(comments['c28'])], [99, 2])
+        self.assertNotIn('_revisions', comments['c20'])
+
+        # merging the merged archive with a newer backup extends the chains
+        merged = os.path.join(tmpdir, 'merged.ndjson.gz')
+        dump(data, merged)
+        newer = bench.make_archive(10, start=20, edit=3)
+        dump(newer, os.path.join(tmpdir, '3.json'))
+        data = merge_json_files([merged, os.path.join(tmpdir, '3.json')])
+        comment = [x for x in data['comments'] if x['id'] == 'c28'][0]
+        self.assertEqual(
+            [(x['seen'], x['score'], x['body'][:12])
+             for x in iter_revisions(comment)],
+            [('2013-09-27T05:20:00', 2, 'comment 28 ('),
+             ('2013-09-25T05:20:00', 99, 'comment 28 ('),
+             ('2013-09-24T05:20:00', 2, 'comment 28')])
+        update_data(data, bench.make_archive(1, start=28, edit=4))
+        comment = [x for x in data['comments'] if x['id'] == 'c28'][0]
+        self.assertEqual(len(list(iter_revisions(comment))), 4)
+
+        output = io.StringIO()
+        print_revisions(comment, file=output)
+        self.assertIn(u'-comment 28 (edit 3)\n+comment 28 (edit 4)',
+                      output.getvalue())
+
+    def test_lazy_imports(self):
+        import subprocess
+        code = (
+            'import sys; import redem.redem; '
+            'print(" ".join(sorted(x for x in (%r) if x in sys.modules)))' % (
+                ('praw', 'bs4', 'rfc3987', 'urlobject', 'jinja2'),))
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.join(os.path.dirname(__file__), '..'),
+            universal_newlines=True)
+        self.assertEqual(output.strip(), '')
+
+    def test_merge_files(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        old = {'_meta': {'date_utc': '1'}, 'submissions': [], 'comments': [
+            {'id': 'c3', 'created_utc': 3, 'edited': False, 'body': 'a'},
+            {'id': 'c1', 'created_utc': 1, 'edited': False}]}
+        new = {'_meta': {'date_utc': '2'}, 'submissions': [], 'comments': [
+            {'id': 'c1', 'created_utc': 1, 'edited': False},
+            {'id': 'c2', 'created_utc': 2, 'edited': False},
+            {'id': 'c3', 'created_utc': 3, 'edited': 4, 'body': 'b'}]}
+        filenames = [os.path.join(tmpdir, 'old.json'),
+                     os.path.join(tmpdir, 'new.ndjson')]
+        dump(old, filenames[0])
+        dump(new, filenames[1])
+        output_filename = os.path.join(tmpdir, 'merged.json')
+        counts = merge_files(filenames, output_filename)
+        self.assertEqual(counts, {'comments': 3, 'submissions': 0})
+        data = load(filename=output_filename)
+        self.assertEqual(
+            [(x['id'], x.get('body')) for x in data['comments']],
+            [('c3', 'b'), ('c2', None), ('c1', None)])
+        self.assertEqual(list(data['_meta']['merged_from']), filenames)
+        self.assertEqual(merge_json_files(filenames), data)
+        # in-memory data is recorded by label (not by a temporary path)
+        merged = merge_json_files(filenames[1:], data=old)
+        self.assertEqual(list(merged['_meta']['merged_from']), filenames[1:])
+        self.assertEqual(merged['comments'], data['comments'])
+        merged = merge_json_files(filenames[1:], data=old, label='old')
+        self.assertEqual(list(merged['_meta']['merged_from']),
+                         ['old'] + filenames[1:])
+        self.assertEqual(old['_meta'], {'date_utc': '1'})
+
+    def test_write_redem_summary(self):
+        import copy
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'index.html')
+        data = {'_meta': {'username': 'example'}, 'submissions': [],
+                'comments': [{
+                    'id': 'c1', 'created_utc': 1, 'edited': False,
+                    'link_title': 'title', 'subreddit': 'Python',
+                    'body_html': '<p>body</p>',
+                    'permalink': 'http://example.org/c1'}]}
+        original = copy.deepcopy(data)
+
+        self.assertIs(get_template_env(), get_template_env())
+        write_redem_summary(data, filename)
+        self.assertEqual(data, original)
+        with codecs.open(filename, encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), redem_summary(data))
+
+    def test_prepare_context_data(self):
+        from jinja2 import Markup
+        data = {'_meta': {}, 'submissions': [], 'comments': [
+            Record(id='c1', created_utc=1.5, edited=False,
+                   body_html='<p>body</p>', permalink='http://example.org/')]}
+        context_data = prepare_context_data(data, uris=[])
+        comment = context_data['comments'][0]
+        self.assertEqual(comment['created_utc'], format_timestamp(1))
+        self.assertEqual(comment['charcount'], 11)
+        self.assertIsInstance(comment['body_html'], Markup)
+        self.assertEqual(data['comments'][0]['created_utc'], 1.5)
+        self.assertNotIn('charcount', data['comments'][0])
+        self.assertNotIn('uris', data)
+        self.assertEqual(prepare_items([comment]), [comment])
+
+    def test_redem_shards(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        jan, feb = 1388534400, 1391212800  # 2014-01-01, 2014-02-01
+
+        def make_data(edited=False):
+            return {'_meta': {'username': 'example'}, 'submissions': [
+                {'id': 's1', 'created_utc': jan, 'edited': False,
+                 'title': 'title', 'url': 'http://example.org/',
+                 'subreddit': 'Python', 'permalink': 'http://example.org/s1'}],
+                'comments': [
+                {'id': 'c%d' % n, 'created_utc': created + n,
+                 'edited': edited if created == feb else False,
+                 'link_title': 'title', 'subreddit': 'Python',
+                 'body': 'body', 'body_html': '<p>body</p>',
+                 'permalink': 'http://example.org/c%d' % n}
+                for n, created in enumerate((feb, jan, jan))]}
+
+        data = make_data()
+        shards = shard_data(data)
+        self.assertEqual(list(shards), ['2014-02', '2014-01'])
+        self.assertEqual(
+            [x['id'] for x in shards['2014-01']['comments']], ['c1', 'c2'])
+        shards = shard_data(data, 3)
+        self.assertEqual(list(shards), ['page-0002', 'page-0001'])
+        self.assertEqual(
+            [x['id'] for x in shards['page-0001']['comments']], ['c2', 'c1'])
+        self.assertEqual(
+            [x['id'] for x in shards['page-0001']['submissions']], ['s1'])
+        self.assertEqual(
+            [x['id'] for x in shards['page-0002']['comments']], ['c0'])
+
+        filenames = redem_shards(data, tmpdir, processes=1)
+        self.assertEqual(
+            [os.path.basename(x) for x in filenames],
+            [SHARD_INDEX, 'redem-2014-02.html', 'redem-2014-01.html'])
+        with codecs.open(filenames[0], encoding='utf-8') as fp:
+            index = fp.read()
+        self.assertIn('redem-2014-01.html#comment/c2', index)
+        with codecs.open(filenames[2], encoding='utf-8') as fp:
+            shard = fp.read()
+        self.assertIn('id="comment/c2"', shard)
+        self.assertIn('href="redem-2014-02.html"', shard)
+        self.assertNotIn('id="comment/c0"', shard)
+
+        self.assertEqual(redem_shards(make_data(), tmpdir, processes=1), [])
+        filenames = redem_shards(make_data(edited=feb), tmpdir, processes=1)
+        self.assertEqual(
+            [os.path.basename(x) for x in filenames],
+            [SHARD_INDEX, 'redem-2014-02.html'])
+        with codecs.open(filenames[0], encoding='utf-8') as fp:
+            self.assertEqual(fp.read(), index)
+
 
 def main(*args):
     import optparse
@@ -581,7 +3512,12 @@ def main(*args):
     import sys
 
     prs = optparse.OptionParser(
-        usage="%prog -u <username>  [--backup] [--merge] [--html]")
+        usage=("%prog -u <username>  [--store sqlite:<path>]"
+               " [--backup [--incremental]] [--merge] [--html] [--export]"
+               "\n       %prog -j <merged.json> --revisions <id>"
+               "\n       %prog -u <username>,<username>,... | --users <file>"
+               " --backup [-j <{username}.json>]"
+               "\n       %prog search [-h] <query>"))
 
     prs.add_option(
         '-u', '--username',
@@ -605,6 +3541,64 @@ def main(*args):
         action='store',
         default=None)
 
+    prs.add_option(
+        '-i', '--incremental',
+        dest='incremental',
+        action='store_true')
+    prs.add_option(
+        '--refresh-days',
+        dest='refresh_days',
+        type='float',
+        action='store',
+        default=0)
+
+    prs.add_option(
+        '--resume',
+        dest='resume',
+        action='store_true')
+    prs.add_option(
+        '--liked',
+        dest='liked',
+        action='store_true')
+    prs.add_option(
+        '--engine',
+        dest='engine',
+        type='choice',
+        choices=('praw', 'raw'),
+        action='store',
+        default='praw')
+    prs.add_option(
+        '--users',
+        dest='users_filename',
+        action='store',
+        default=None)
+    prs.add_option(
+        '-w', '--workers',
+        dest='workers',
+        type='int',
+        action='store',
+        default=BATCH_WORKERS)
+    prs.add_option(
+        '--api-url',
+        dest='api_url',
+        action='store',
+        default=None)
+
+    prs.add_option(
+        '-s', '--store',
+        dest='store',
+        action='store',
+        default=None)
+    prs.add_option(
+        '--export',
+        dest='export',
+        action='store_true')
+    prs.add_option(
+        '--search-index',
+        dest='search_index',
+        action='store',
+        default=None)
+
     prs.add_option(
         '-m', '--merge',
         dest='merge_json',
@@ -613,12 +3607,33 @@ def main(*args):
         '-r', '--html',
         dest='html_report',
         action='store_true')
+    prs.add_option(
+        '--revisions',
+        dest='revisions',
+        action='store',
+        default=None)
+    prs.add_option(
+        '--revisions-format',
+        dest='revisions_format',
+        type='choice',
+        choices=('text', 'json'),
+        action='store',
+        default='text')
 
     prs.add_option(
         '-o', '--html-output',
         dest='html_output_filename',
         action='store',
         default='redditlog.html',)
+    prs.add_option(
+        '--shard',
+        dest='shard_by',
+        action='store',
+        default=None)
+    prs.add_option(
+        '--rebuild',
+        dest='rebuild',
+        action='store_true')
     prs.add_option(
         '--media-url',
         dest='media_url',
@@ -626,11 +3641,46 @@ def main(*args):
         action='store',
         )
 
+    prs.add_option(
+        '--uri-extractor',
+        dest='uri_extractor',
+        type='choice',
+        choices=list(URI_EXTRACTORS),
+        action='store',
+        default=URI_EXTRACTOR)
+    prs.add_option(
+        '-P', '--processes',
+        dest='processes',
+        type='int',
+        action='store',
+        default=None)
+
+    prs.add_option(
+        '--uri-index',
+        dest='uri_index',
+        action='store',
+        default=None)
+
     prs.add_option(
         '-C', '--no-cache',
         dest='no_cache',
         default=False,
         action='store_true')
+    prs.add_option(
+        '--cache-size',
+        dest='cache_size',
+        type='int',
+        action='store',
+        default=256)
+    prs.add_option(
+        '--check-links',
+        dest='check_links',
+        action='store_true')
+    prs.add_option(
+        '--link-cache',
+        dest='link_cache',
+        action='store',
+        default=os.path.join(DATADIR, 'links.sqlite'))
 
     prs.add_option(
         '-v', '--verbose',
@@ -646,6 +3696,9 @@ def main(*args):
         action='store_true', )
 
     args = args and list(args) or sys.argv[1:]
+    if args[:1] == ['search']:
+        from redem import search
+        sys.exit(search.main(*args[1:]))
     (opts, args) = prs.parse_args(args)
 
     if not opts.quiet:
@@ -666,48 +3719,191 @@ def main(*args):
         if not opts.merge_json:
             if len(args):
                 username = args[0]
-    if username is None:
+    usernames = []
+    if opts.users_filename:
+        usernames = read_usernames(opts.users_filename)
+    if username is not None and ',' in username:
+        usernames.extend(x for x in username.split(',') if x)
+    elif username is not None and opts.users_filename:
+        usernames.append(username)
+    if username is None and not usernames:
         print(
             "ERROR: Must specify a username with either"
             " -u/--username or by setting REDDIT_USERNAME",
             file=sys.stderr)
 
-    if not any((opts.backup, opts.html_report, opts.merge_json)):
+    if not any((opts.backup, opts.html_report, opts.merge_json,
+                opts.export, opts.revisions)):
         prs.print_help()
         sys.exit(1)
 
-    if opts.merge_json:
-        filenames = args
-        data = merge_json_files(filenames)
-        dump(data, opts.json_filename)
-        sys.exit(0)
-
-    if not opts.no_cache:
-        import requests_cache
-        requests_cache.install_cache(
-            os.path.join(DATADIR, 'cache'),
-            backend='sqlite',
-            expire_after=60 * 60,
-            fast_save=True)
-
-    data = None
-    if opts.backup:
-        data = redem(username, opts.backup, limit=opts.limit)
-        dump(data, filename=opts.json_filename)
-
-    if data is None and opts.json_filename:
-        data = load(filename=opts.json_filename)
-
-    if opts.html_report:
-        output_html = redem_summary(
-            data,
-            media_url=opts.media_url,
-            username=username)
-        if opts.html_output_filename.strip() == '-':
-            sys.stdout.write(opts.output_html)
-        else:
-            write_html(opts.html_output_filename, output_html)
+    store = None
+    search_index = None
+    try:
+        if opts.store:
+            from redem.store import open_store
+            store = open_store(opts.store)
+        if opts.search_index:
+            from redem.search import SearchIndex
+            search_index = SearchIndex(opts.search_index)
+
+        if opts.revisions:
+            if store is not None:
+                items = [store.get_item(section, opts.revisions)
+                         for section in store.sections]
+            else:
+                selected = load(filename=opts.json_filename,
+                                ids=[opts.revisions])
+                items = [x for section in SECTIONS
+                         for x in selected.get(section, [])]
+            items = [x for x in items if x is not None]
+            if not items:
+                print("ERROR: %r not found" % opts.revisions, file=sys.stderr)
+                sys.exit(1)
+            print_revisions(items[0], format=opts.revisions_format)
+            sys.exit(0)
+
+        if opts.merge_json:
+            filenames = args
+            if store is not None:
+                store.merge_files(filenames)
+            else:
+                merge_files(filenames, opts.json_filename)
+            if search_index is not None:
+                search_index.update_files(filenames)
+            sys.exit(0)
+
+        cache = None
+        if not opts.no_cache and (opts.backup or usernames):
+            from redem.httpcache import HTTPCache
+            cache = HTTPCache(max_bytes=opts.cache_size * 1024 * 1024)
+
+        if usernames:
+            if not opts.backup:
+                prs.error("several usernames are only supported with --backup")
+            if opts.liked:
+                prs.error("--liked needs each user's login (not batched)")
+            if store is not None:
+                prs.error("--store holds one user's archive (not batched)")
+            output_filename = opts.json_filename
+            if '{username}' not in output_filename:
+                output_filename = BATCH_OUTPUT
+            log.info("batch: %d users -> %s" % (
+                len(usernames), output_filename))
+            results = redem_batch(
+                usernames,
+                output_filename,
+                limit=opts.limit,
+                incremental=opts.incremental,
+                refresh_days=opts.refresh_days,
+                resume=opts.resume,
+                engine='raw' if opts.api_url else opts.engine,
+                api_url=opts.api_url,
+                max_workers=opts.workers,
+                cache=cache)
+            if cache is not None:
+                cache.report()
+                cache.close()
+            filenames = [
+                x for x in results.values() if not isinstance(x, Exception)]
+            if search_index is not None:
+                search_index.update_files(filenames)
+            sys.exit(0 if len(filenames) == len(results) else 1)
+
+        data = None
+        if opts.backup:
+            archive = None
+            since = None
+            if opts.incremental and store is not None:
+                since = store.get_incremental_since(opts.refresh_days)
+            elif opts.incremental and os.path.exists(opts.json_filename):
+                archive = load(filename=opts.json_filename)
+                since = get_incremental_since(archive, opts.refresh_days)
+            writer = None
+            if (store is None and archive is None and
+                    is_ndjson(opts.json_filename)):
+                writer = NDJSONWriter(opts.json_filename, resume=opts.resume)
+            data = redem(username, opts.backup, limit=opts.limit, since=since,
+                         liked=opts.liked,
+                         engine='raw' if opts.api_url else opts.engine,
+                         writer=writer, api_url=opts.api_url, cache=cache)
+            if cache is not None:
+                cache.report()
+                cache.close()
+            if search_index is not None:
+                if writer is not None:
+                    search_index.update_files([opts.json_filename])
+                else:
+                    search_index.update_data(data)
+            if writer is not None:
+                data = None
+            elif store is not None:
+                store.update(data)
+                data = None
+            elif archive is not None:
+                data = update_data(archive, data)
+                dump(data, filename=opts.json_filename)
+            else:
+                dump(data, filename=opts.json_filename)
+
+        if store is not None:
+            if opts.export or opts.html_report:
+                data = store.export()
+            if opts.export:
+                dump(data, filename=opts.json_filename)
+        elif data is None and opts.json_filename:
+            data = load(filename=opts.json_filename)
+
+        if opts.html_report:
+            set_uri_extractor(opts.uri_extractor)
+            uri_index = None
+            if opts.uri_index:
+                uri_index = URIIndex.load(opts.uri_index)
+            uris = links = None
+            if opts.check_links:
+                from redem import linkcheck
+                uris = process_urls(
+                    data, processes=opts.processes, uri_index=uri_index)
+                link_cache = linkcheck.LinkCache(opts.link_cache)
+                links = linkcheck.check_links(
+                    [uri for uri, _ in uris], cache=link_cache)
+                link_cache.close()
+            html_output = opts.html_output_filename.strip()
+            if opts.shard_by or os.path.isdir(html_output) or (
+                    html_output.endswith(os.sep)):
+                redem_shards(
+                    data,
+                    html_output,
+                    shard_by=opts.shard_by or 'month',
+                    processes=opts.processes,
+                    force=opts.rebuild,
+                    uri_index=uri_index,
+                    uris=uris,
+                    links=links,
+                    media_url=opts.media_url,
+                    username=username)
+            else:
+                write_redem_summary(
+                    data,
+                    html_output,
+                    processes=opts.processes,
+                    uri_index=uri_index,
+                    uris=uris,
+                    links=links,
+                    media_url=opts.media_url,
+                    username=username)
+            if uri_index is not None:
+                uri_index.save(opts.uri_index)
+    finally:
+        if store is not None:
+            store.close()
+        if search_index is not None:
+            search_index.close()
 
 
 if __name__ == "__main__":
-    main()
+    # run redem.redem's main: run as ``python -m redem.redem``, this
+    # module is ``__main__``, a second copy of the one redem.store and
+    # the other modules import (with its own Record class and METADATA)
+    from redem import redem as redem_module
+    redem_module.main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+"""
+redem.search - full-text search over comments and submissions
+
+::
+
+    redem search --add data/merged_json.json
+    redem search python argparse
+    redem search --section comments 'subreddit:python AND optparse'
+    redem search --export-index ../redditlog/data/search_index.json
+
+The index is an SQLite FTS5 table over ``title`` (``link_title`` or
+``title``), ``body`` (``body`` or ``selftext``), ``subreddit`` and the
+URIs extracted from each item. Items are (re)indexed only when they are
+new or their ``edited`` timestamp changed.
+"""
+import codecs
+import collections
+import datetime
+import json
+import logging
+import os.path
+import re
+import sqlite3
+import unittest
+from collections import OrderedDict
+
+from redem import redem
+
+log = logging.getLogger('redem.search')
+
+SEARCH_INDEX_FILE = os.path.join(redem.DATADIR, 'search.sqlite')
+
+# (version 0 indexes keyed docs by id alone; they are rebuilt)
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    rowid INTEGER PRIMARY KEY,
+    section TEXT,
+    id TEXT,
+    created_utc REAL,
+    edited REAL,
+    subreddit TEXT,
+    title TEXT,
+    permalink TEXT,
+    UNIQUE (section, id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(
+    title, body, subreddit, uris,
+    tokenize = 'unicode61'
+);
+"""
+
+SEARCH = """
+SELECT docs.section, docs.id, docs.created_utc, docs.subreddit,
+       docs.title, docs.permalink,
+       snippet(fts, 1, '[', ']', '...', 16), bm25(fts)
+FROM fts JOIN docs ON docs.rowid = fts.rowid
+WHERE fts MATCH ? {where}
+ORDER BY bm25(fts)
+LIMIT ?
+"""
+
+UPDATE_CHUNKSIZE = 1000  # items per transaction (see update_files)
+
+SearchHit = collections.namedtuple(
+    'SearchHit',
+    ('section', 'id', 'created_utc', 'subreddit', 'title', 'permalink',
+     'snippet', 'score'))
+
+
+def item_uris(section, item):
+    if section == 'comments':
+        uris = redem.iter_comment_uris(item)
+    else:
+        uris = redem.iter_submission_uris(item)
+    return u' '.join(uri for uri in uris if uri)
+
+
+def item_document(section, item):
+    """
+    :returns: (title, body, subreddit, uris) to index for an item
+    """
+    return (
+        item.get('link_title') or item.get('title') or u'',
+        item.get('body') or item.get('selftext') or u'',
+        item.get('subreddit') or u'',
+        item_uris(section, item))
+
+
+def quote_query(query):
+    """
+    quote each term of a query (for input which is not FTS5 syntax)
+    """
+    return u' '.join(
+        u'"%s"' % term.replace('"', '""') for term in query.split())
+
+
+class SearchIndex(object):
+    def __init__(self, filename=SEARCH_INDEX_FILE):
+        if filename != ':memory:':
+            filename = redem.expand_path(filename)
+        self.filename = filename
+        self.conn = sqlite3.connect(self.filename)
+        (version,) = self.conn.execute('PRAGMA user_version').fetchone()
+        if version < SCHEMA_VERSION:
+            if self.conn.execute(
+                    "SELECT name FROM sqlite_master WHERE name = 'docs'"
+                    ).fetchone():
+                log.warning("rebuilding %r (old schema)" % self.filename)
+            self.conn.executescript(
+                'DROP TABLE IF EXISTS docs; DROP TABLE IF EXISTS fts;')
+            self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, section, items):
+        """
+        index new items and re-index edited items
+
+        :returns: number of items (re)indexed
+        """
+        count = 0
+        with self.conn:
+            for item in items:
+                edited = item.get('edited') or None
+                row = self.conn.execute(
+                    'SELECT rowid, edited FROM docs'
+                    ' WHERE section = ? AND id = ?',
+                    (section, item['id'])).fetchone()
+                if row is not None:
+                    if row[1] == edited:
+                        continue
+                    self.conn.execute(
+                        'DELETE FROM fts WHERE rowid = ?', (row[0],))
+                    self.conn.execute(
+                        'DELETE FROM docs WHERE rowid = ?', (row[0],))
+                title, body, subreddit, uris = item_document(section, item)
+                cursor = self.conn.execute(
+                    'INSERT INTO docs (section, id, created_utc, edited,'
+                    ' subreddit, title, permalink)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (section, item['id'], item.get('created_utc'), edited,
+                     subreddit, title, item.get('permalink')))
+                self.conn.execute(
+                    'INSERT INTO fts (rowid, title, body, subreddit, uris)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (cursor.lastrowid, title, body, subreddit, uris))
+                count += 1
+        return count
+
+    def update_data(self, data):
+        """
+        index the sections of a backup or merged archive
+
+        :returns: dict of section -> number of items (re)indexed
+        """
+        counts = OrderedDict()
+        for section in redem.SECTIONS:
+            counts[section] = self.update(section, data.get(section, []))
+            log.info("%-14s: %d indexed" % (section, counts[section]))
+        return counts
+
+    def update_files(self, filenames):
+        """
+        index JSON or NDJSON backups (see :py:func:`redem.iter_records`),
+        ``UPDATE_CHUNKSIZE`` items per transaction
+        """
+        counts = OrderedDict((section, 0) for section in redem.SECTIONS)
+        for filename in filenames:
+            log.info("indexing: %r" % filename)
+            sections = OrderedDict(
+                (section, []) for section in redem.SECTIONS)
+            for section, item in redem.iter_records(filename):
+                if section in sections:
+                    sections[section].append(item)
+                    if len(sections[section]) >= UPDATE_CHUNKSIZE:
+                        counts[section] += self.update(
+                            section, sections[section])
+                        sections[section] = []
+            for section, items in sections.items():
+                counts[section] += self.update(section, items)
+        return counts
+
+    def search(self, query, limit=20, section=None):
+        """
+        :returns: list of :py:class:`SearchHit`, best match first
+        """
+        where, params = '', []
+        if section:
+            where, params = 'AND docs.section = ?', [section]
+        sql = SEARCH.format(where=where)
+        try:
+            rows = self.conn.execute(sql, [query] + params + [limit])
+            return [SearchHit(*row) for row in rows]
+        except sqlite3.OperationalError as e:
+            log.debug("%s: retrying %r as terms" % (e, query))
+            rows = self.conn.execute(
+                sql, [quote_query(query)] + params + [limit])
+            return [SearchHit(*row) for row in rows]
+
+    def export_index(self, min_length=2):
+        """
+        build a compact inverted index for client-side search::
+
+            {"docs": [[section, id, title, permalink], ...],
+             "terms": {term: [doc, ...]}}
+
+        """
+        tokenize = re.compile(r'\w{%d,}' % min_length, re.UNICODE).findall
+        docs = []
+        terms = {}
+        cursor = self.conn.execute(
+            'SELECT docs.section, docs.id, docs.title, docs.permalink,'
+            ' fts.title, fts.body, fts.subreddit'
+            ' FROM docs JOIN fts ON docs.rowid = fts.rowid'
+            ' ORDER BY docs.created_utc DESC')
+        for n, row in enumerate(cursor):
+            docs.append(list(row[:4]))
+            for term in set(tokenize(u' '.join(row[4:]).lower())):
+                terms.setdefault(term, []).append(n)
+        return {'docs': docs, 'terms': terms}
+
+
+def print_hits(hits, file=None):
+    for hit in hits:
+        created = ''
+        if hit.created_utc:
+            created = datetime.datetime.utcfromtimestamp(
+                hit.created_utc).strftime('%Y-%m-%d')
+        print(u'%-10s %-20s %s' % (created, hit.subreddit, hit.title),
+              file=file)
+        print(u'    %s' % hit.snippet.replace('\n', ' '), file=file)
+        print(u'    %s' % hit.permalink, file=file)
+
+
+def main(*args):
+    import optparse
+    import sys
+
+    prs = optparse.OptionParser(
+        usage=("%prog search [-i <index>] [-n <limit>] <query>\n"
+               "       %prog search --add <file.json> [...]\n"
+               "       %prog search --export-index <index.json>"))
+    prs.add_option(
+        '-i', '--index',
+        dest='index_filename',
+        action='store',
+        default=SEARCH_INDEX_FILE)
+    prs.add_option(
+        '-a', '--add',
+        dest='add',
+        action='store_true')
+    prs.add_option(
+        '-n', '--limit',
+        dest='limit',
+        type='int',
+        action='store',
+        default=20)
+    prs.add_option(
+        '--section',
+        dest='section',
+        type='choice',
+        choices=redem.SECTIONS,
+        action='store')
+    prs.add_option(
+        '--export-index',
+        dest='export_filename',
+        action='store')
+    prs.add_option(
+        '-v', '--verbose',
+        dest='verbose',
+        action='store_true', )
+
+    args = args and list(args) or sys.argv[1:]
+    (opts, args) = prs.parse_args(args)
+
+    logging.basicConfig()
+    if opts.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    index = SearchIndex(opts.index_filename)
+    if opts.add:
+        index.update_files(args)
+    elif opts.export_filename:
+        with codecs.open(opts.export_filename, 'w', encoding='utf-8') as fp:
+            json.dump(index.export_index(), fp, separators=(',', ':'))
+    elif args:
+        print_hits(index.search(
+            u' '.join(args), limit=opts.limit, section=opts.section))
+    else:
+        prs.print_help()
+        return 1
+    index.close()
+    return 0
+
+
+class Test_search(unittest.TestCase):
+    def test_search_index(self):
+        index = SearchIndex(':memory:')
+        comment = {
+            'id': 'c1', 'created_utc': 1, 'edited': False,
+            'link_title': 'Command line interfaces', 'subreddit': 'Python',
+            'body': 'argparse is in the standard library',
+            'body_html': '<a href="http://docs.python.org/3/library/'
+                         'argparse.html">argparse</a>',
+            'permalink': 'http://www.reddit.com/r/Python/comments/s1/_/c1'}
+        data = {'comments': [comment], 'submissions': []}
+        self.assertEqual(index.update_data(data)['comments'], 1)
+        self.assertEqual(index.update_data(data)['comments'], 0)
+        hits = index.search('argparse')
+        self.assertEqual([x.id for x in hits], ['c1'])
+        self.assertIn('[argparse]', hits[0].snippet)
+        self.assertEqual(len(index.search('docs.python.org')), 1)
+        self.assertEqual(index.search('optparse'), [])
+        comment = dict(comment, edited=2, body='optparse is deprecated')
+        self.assertEqual(index.update('comments', [comment]), 1)
+        self.assertEqual([x.id for x in index.search('optparse')], ['c1'])
+        exported = index.export_index()
+        self.assertEqual(exported['terms']['optparse'], [0])
+        # comments and submissions have separate ids
+        submission = {'id': 'c1', 'created_utc': 2, 'edited': False,
+                      'title': 'optparse', 'subreddit': 'Python'}
+        self.assertEqual(index.update('submissions', [submission]), 1)
+        self.assertEqual(
+            sorted(x.section for x in index.search('optparse')),
+            ['comments', 'submissions'])
+
+    def test_update_files(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'data.ndjson')
+        redem.dump({'_meta': {}, 'submissions': [], 'comments': [
+            {'id': 'c%d' % n, 'created_utc': n, 'edited': False,
+             'body': 'comment %d' % n, 'body_html': '<p>comment</p>',
+             'permalink': '/r/Python/c%d' % n}
+            for n in range(25)]}, filename)
+        index = SearchIndex(':memory:')
+        self.addCleanup(index.close)
+        statements = []
+        index.conn.set_trace_callback(statements.append)
+        self.assertEqual(
+            index.update_files([filename]), {'comments': 25, 'submissions': 0})
+        self.assertEqual(statements.count('COMMIT'), 1)
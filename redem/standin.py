@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+"""
+redem.standin - local stand-in for the reddit API, for offline backups
+and benchmarks
+
+::
+
+    python -m redem.standin -p 8080 --synthetic 5000 --latency 0.05
+    python -m redem.standin -p 8080 --record data/fixtures.json \\
+        --upstream https://www.reddit.com
+    python -m redem.standin -p 8080 --replay data/fixtures.json
+    redem -u example --api-url http://127.0.0.1:8080 --backup data.json
+
+Serves paginated ``/user/<name>/{comments,submitted,liked}.json``,
+``/api/info.json`` and ``/r/<name>/about.json`` with a per-request
+``latency``, ``ETag`` validators (``304`` for ``If-None-Match``) and
+reddit's ``X-Ratelimit-*`` headers (``429`` past the limit).
+Responses come from a recording (``--replay``), an upstream API
+(``--upstream``) or synthetic fixtures (``--synthetic``), in that order;
+``--record`` saves every response served to a fixtures file.
+"""
+import codecs
+import hashlib
+import json
+import logging
+import os.path
+import threading
+import time
+import unittest
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from redem import redem
+
+log = logging.getLogger('redem.standin')
+
+LISTING_LIMIT = 100  # max things per listing page (as reddit)
+DEFAULT_LIMIT = 25
+
+
+def listing_json(children, after=None):
+    return OrderedDict((
+        ('kind', 'Listing'),
+        ('data', OrderedDict((
+            ('modhash', ''),
+            ('children', children),
+            ('after', after),
+            ('before', None)))),
+    ))
+
+
+class Fixtures(object):
+    """
+    user listings (newest first) and the things served by ``/api/info``
+    and ``/r/<name>/about``, keyed by fullname
+    """
+    def __init__(self):
+        self.listings = {}
+        self.positions = {}
+        self.things = {}
+
+    def add(self, kind, data):
+        thing = OrderedDict((('kind', kind), ('data', data)))
+        self.things[data['name']] = thing
+        return thing
+
+    def add_listing(self, username, listing, things):
+        """
+        :param listing: ``comments``, ``submitted`` or ``liked``
+        :param things: ``{"kind": ..., "data": ...}`` dicts, newest first
+        """
+        key = (username.lower(), listing)
+        self.listings[key] = things
+        self.positions[key] = dict(
+            (thing['data']['name'], n) for n, thing in enumerate(things))
+
+    def add_synthetic(self, username='example', comments=1000,
+                      submissions=100):
+        """
+        :py:func:`redem.bench.make_comment_data` comments (on submissions
+        ``s0``...) and :py:func:`redem.bench.make_submission_data`
+        submissions (things with the same ids are shared between users)
+        """
+        from redem import bench
+        self.add_listing(username, 'comments', [
+            self.add('t1', bench.make_comment_data(i, username))
+            for i in range(comments)])
+        self.add_listing(username, 'submitted', [
+            self.add('t3', bench.make_submission_data(i, username))
+            for i in range(submissions)])
+        for i in range(submissions, (comments + 9) // 10):
+            if 't3_s%d' % i not in self.things:
+                self.add('t3', bench.make_submission_data(i, 'someone_else'))
+        self.add_listing(username, 'liked', [])
+        for name in bench.SUBREDDITS:
+            self.add('t5', OrderedDict((
+                ('display_name', name),
+                ('url', u'/r/%s/' % name),
+                ('id', name.lower()),
+                ('name', 't5_' + name.lower()))))
+        return self
+
+    @classmethod
+    def synthetic(cls, username='example', comments=1000, submissions=100):
+        """
+        :returns: :py:class:`Fixtures` for one user
+            (see :py:meth:`add_synthetic`)
+        """
+        return cls().add_synthetic(username, comments, submissions)
+
+    def listing(self, username, listing, limit=DEFAULT_LIMIT, after=None):
+        """
+        :returns: a listing page, or None for unknown users
+        """
+        key = (username.lower(), listing)
+        things = self.listings.get(key)
+        if things is None:
+            return None
+        start = 0
+        if after:
+            start = self.positions[key].get(after, len(things) - 1) + 1
+        limit = min(limit, LISTING_LIMIT)
+        page = things[start:start + limit]
+        after = None
+        if page and start + limit < len(things):
+            after = page[-1]['data']['name']
+        return listing_json(page, after=after)
+
+    def info(self, fullnames):
+        return listing_json(
+            [self.things[x] for x in fullnames if x in self.things])
+
+    def about(self, subreddit):
+        for thing in self.things.values():
+            if (thing['kind'] == 't5' and
+                    thing['data']['display_name'].lower() ==
+                    subreddit.lower()):
+                return thing
+
+
+def route(fixtures, path, params):
+    """
+    :returns: response for a request path and query parameters (or None)
+    """
+    parts = path.strip('/')
+    if parts.endswith('.json'):
+        parts = parts[:-5]
+    parts = parts.split('/')
+    if len(parts) == 3 and parts[0] == 'user':
+        return fixtures.listing(
+            parts[1], parts[2],
+            limit=int(params.get('limit', DEFAULT_LIMIT)),
+            after=params.get('after'))
+    if parts == ['api', 'info']:
+        return fixtures.info(
+            [x for x in params.get('id', '').split(',') if x])
+    if len(parts) == 3 and parts[0] == 'r' and parts[2] == 'about':
+        return fixtures.about(parts[1])
+
+
+def request_key(path, params):
+    """
+    :returns: recording key (path and sorted query parameters)
+    """
+    query = urlencode(sorted(params.items()))
+    return path + ('?' + query if query else '')
+
+
+class Recording(OrderedDict):
+    """
+    responses by :py:func:`request_key`::
+
+        {"/user/example/comments.json?limit=100": {"kind": "Listing", ...}}
+
+    """
+    def load(self, filename):
+        if os.path.exists(filename):
+            with codecs.open(filename, 'r', encoding='utf-8') as fp:
+                self.update(json.load(fp, object_pairs_hook=OrderedDict))
+        return self
+
+    def save(self, filename):
+        with codecs.open(filename, 'w', encoding='utf-8') as fp:
+            json.dump(self, fp, indent=1)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes (avoid delayed ACK stalls)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        status, headers, body = self.server.respond(url.path, params)
+        body = json.dumps(body).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+            self.server.count_not_modified()
+        # (counted before responding, so that clients never see stale stats)
+        self.server.count(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class StandinServer(ThreadingHTTPServer):
+    """
+    :param fixtures: :py:class:`Fixtures` to serve
+    :param recording: :py:class:`Recording` to replay (and to add every
+        response served to)
+    :param upstream: base URL to fetch responses missing from
+        ``recording`` from (e.g. https://www.reddit.com)
+    :param latency: seconds to wait before each response
+    :param ratelimit: requests allowed per ``window`` seconds
+        (None: unlimited, without ``X-Ratelimit-*`` headers)
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), fixtures=None,
+                 recording=None, upstream=None, latency=0,
+                 ratelimit=None, window=600):
+        ThreadingHTTPServer.__init__(self, address, StandinHandler)
+        self.fixtures = fixtures
+        self.recording = recording
+        self.upstream = upstream
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.window = window
+        self.window_start = time.time()
+        self.used = 0
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def start(self):
+        """
+        serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def ratelimit_headers(self):
+        """
+        :returns: (throttled, ``X-Ratelimit-*`` headers) for a request
+        """
+        if self.ratelimit is None:
+            return False, []
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.window:
+                self.window_start, self.used = now, 0
+            self.used += 1
+            used = self.used
+            reset = self.window - (now - self.window_start)
+        return used > self.ratelimit, [
+            ('X-Ratelimit-Used', str(used)),
+            ('X-Ratelimit-Remaining', '%.1f' % max(self.ratelimit - used, 0)),
+            ('X-Ratelimit-Reset', str(int(reset + 0.999)))]
+
+    def fetch_upstream(self, path, params):
+        import requests
+        response = requests.get(
+            self.upstream.rstrip('/') + path, params=params,
+            headers={'User-Agent': redem.__USER_AGENT__}, timeout=30)
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    def respond(self, path, params):
+        """
+        :returns: (status, headers, body)
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        throttled, headers = self.ratelimit_headers()
+        if throttled:
+            with self.lock:
+                self.stats['throttled'] += 1
+            return 429, headers, {'message': 'Too Many Requests',
+                                  'error': 429}
+        key = request_key(path, params)
+        body = None
+        if self.recording is not None:
+            body = self.recording.get(key)
+        if body is None and self.upstream:
+            body = self.fetch_upstream(path, params)
+        if body is None and self.fixtures is not None:
+            body = route(self.fixtures, path, params)
+        if body is None:
+            return 404, headers, {'message': 'Not Found', 'error': 404}
+        if self.recording is not None:
+            with self.lock:
+                self.recording[key] = body
+        with self.lock:
+            self.stats['things'] += len(
+                body.get('data', {}).get('children', ()))
+        return 200, headers, body
+
+    def count_not_modified(self):
+        with self.lock:
+            self.stats['not_modified'] += 1
+
+    def count(self, body):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(body)
+
+
+def main(*args):
+    import optparse
+    import sys
+
+    prs = optparse.OptionParser(
+        usage=("%prog [-p <port>] --synthetic <comments>"
+               " [--latency <seconds>] [--ratelimit <n>]\n"
+               "       %prog [-p <port>] --replay <fixtures.json>\n"
+               "       %prog [-p <port>] --record <fixtures.json>"
+               " [--upstream <url> | --synthetic <comments>]"))
+    prs.add_option(
+        '-p', '--port',
+        dest='port',
+        type='int',
+        action='store',
+        default=8080)
+    prs.add_option(
+        '-u', '--username',
+        dest='username',
+        action='store',
+        default='example')
+    prs.add_option(
+        '--synthetic',
+        dest='synthetic',
+        type='int',
+        action='store',
+        default=None)
+    prs.add_option(
+        '--replay',
+        dest='replay_filename',
+        action='store')
+    prs.add_option(
+        '--record',
+        dest='record_filename',
+        action='store')
+    prs.add_option(
+        '--upstream',
+        dest='upstream',
+        action='store')
+    prs.add_option(
+        '--latency',
+        dest='latency',
+        type='float',
+        action='store',
+        default=0)
+    prs.add_option(
+        '--ratelimit',
+        dest='ratelimit',
+        type='int',
+        action='store',
+        default=None)
+    prs.add_option(
+        '--window',
+        dest='window',
+        type='float',
+        action='store',
+        default=600)
+    prs.add_option(
+        '-v', '--verbose',
+        dest='verbose',
+        action='store_true')
+
+    args = args and list(args) or sys.argv[1:]
+    (opts, args) = prs.parse_args(args)
+    logging.basicConfig()
+    logging.getLogger().setLevel(
+        logging.DEBUG if opts.verbose else logging.INFO)
+
+    fixtures = None
+    if opts.synthetic is not None:
+        fixtures = Fixtures.synthetic(
+            opts.username, comments=opts.synthetic,
+            submissions=opts.synthetic // 10)
+    recording = None
+    if opts.replay_filename:
+        recording = Recording().load(opts.replay_filename)
+    elif opts.record_filename:
+        recording = Recording().load(opts.record_filename)
+    if fixtures is None and recording is None and not opts.upstream:
+        prs.error("one of --synthetic, --replay or --upstream is required")
+
+    server = StandinServer(
+        ('127.0.0.1', opts.port), fixtures=fixtures, recording=recording,
+        upstream=opts.upstream, latency=opts.latency,
+        ratelimit=opts.ratelimit, window=opts.window)
+    log.info("serving: %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if opts.record_filename:
+            recording.save(opts.record_filename)
+            log.info("recorded: %d responses" % len(recording))
+        for key, count in sorted(server.stats.items()):
+            log.info("%-14s: %d" % (key, count))
+    return 0
+
+
+class Test_standin(unittest.TestCase):
+    def setUp(self):
+        self.metadata = redem.METADATA
+        redem.METADATA = redem.MetadataCache()
+
+    def tearDown(self):
+        redem.METADATA = self.metadata
+
+    def backup(self, server):
+        redem.METADATA = redem.MetadataCache()
+        try:
+            return redem.redem('example', engine='raw', rate=None,
+                               api_url=server.url)
+        finally:
+            server.stop()
+
+    def test_listing(self):
+        fixtures = Fixtures.synthetic(comments=30, submissions=3)
+        page = route(fixtures, '/user/Example/comments.json', {'limit': '25'})
+        self.assertEqual(len(page['data']['children']), 25)
+        self.assertEqual(page['data']['after'], 't1_c24')
+        page = route(fixtures, '/user/example/comments',
+                     {'limit': '25', 'after': 't1_c24'})
+        self.assertEqual(
+            [x['data']['id'] for x in page['data']['children']],
+            ['c25', 'c26', 'c27', 'c28', 'c29'])
+        self.assertIsNone(page['data']['after'])
+        info = route(fixtures, '/api/info.json', {'id': 't3_s2,t5_python'})
+        self.assertEqual(
+            [x['kind'] for x in info['data']['children']], ['t3', 't5'])
+        self.assertEqual(
+            route(fixtures, '/r/python/about.json', {})['data']['url'],
+            '/r/Python/')
+        self.assertIsNone(route(fixtures, '/user/nobody/comments', {}))
+
+    def test_backup(self):
+        fixtures = Fixtures.synthetic(comments=250, submissions=30)
+        recording = Recording()
+        server = StandinServer(fixtures=fixtures, recording=recording)
+        data = self.backup(server.start())
+        self.assertEqual(len(data['comments']), 250)
+        self.assertEqual(len(data['submissions']), 30)
+        self.assertEqual(
+            data['comments'][15]['permalink'],
+            'http://www.reddit.com/r/Python/comments/s1/_/c15')
+        self.assertEqual(data['comments'][0]['body_html'][:16],
+                         '<div class="md">')
+        # 3 + 1 listing pages (subreddit names are in the listings)
+        self.assertEqual(server.stats['requests'], 4)
+        self.assertEqual(data['_meta']['requests']['total'], 4)
+        self.assertEqual(len(recording), 4)
+
+        replay = StandinServer(recording=recording)
+        replayed = self.backup(replay.start())
+        self.assertEqual(replayed['comments'], data['comments'])
+        self.assertEqual(replayed['submissions'], data['submissions'])
+        self.assertEqual(replay.stats['bytes'], server.stats['bytes'])
+
+    def test_batch(self):
+        import shutil
+        import tempfile
+        fixtures = Fixtures.synthetic('alice', comments=120, submissions=5)
+        fixtures.add_synthetic('bob', comments=30, submissions=2)
+        server = StandinServer(fixtures=fixtures).start()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        output = os.path.join(tmpdir, '{username}.ndjson')
+        try:
+            results = redem.redem_batch(
+                ['alice', 'bob', 'nobody'], output, rate=None,
+                engine='raw', api_url=server.url, max_workers=3)
+        finally:
+            server.stop()
+        self.assertEqual(list(results), ['alice', 'bob', 'nobody'])
+        self.assertIsInstance(results['nobody'], Exception)
+        alice = redem.load(filename=results['alice'])
+        self.assertEqual(len(alice['comments']), 120)
+        self.assertEqual(alice['_meta']['username'], 'alice')
+        bob = redem.load(filename=results['bob'])
+        self.assertEqual(len(bob['submissions']), 2)
+        # listings: 3 (alice) + 2 (bob) + 2 (nobody)
+        self.assertEqual(server.stats['requests'], 7)
+        self.assertRaises(ValueError, redem.redem_batch, ['alice'], 'x.json')
+
+    def test_html_entities(self):
+        import re
+        from html.entities import name2codepoint
+        from types import SimpleNamespace
+        fixtures = Fixtures.synthetic(comments=3, submissions=1)
+        comment = fixtures.things['t1_c0']['data']
+        comment['body'] = u'a &lt; b &amp;&amp; b &gt; c &amp;lt;'
+        comment['body_html'] = (
+            u'&lt;div class="md"&gt;&lt;p&gt;a &amp;lt; b &amp;amp;&amp;amp;'
+            u' b &amp;gt; c &amp;amp;lt;&lt;/p&gt;&lt;/div&gt;')
+        fixtures.things['t3_s0']['data']['title'] = u'Q&amp;A &lt;3'
+
+        class PrawSession(redem.APIClient):
+            """
+            praw decodes the entities in the response text, before
+            building objects (``config.decode_html_entities``)
+            """
+            def request_json(self, url, params=None, as_objects=False):
+                text = self.http.get(url, params=params).text
+                return json.loads(re.sub(
+                    '&([^;]+);',
+                    lambda m: chr(name2codepoint[m.group(1)]), text))
+
+        def praw_object(data):
+            thing = SimpleNamespace(**data)
+            thing.author = SimpleNamespace(name=data['author'])
+            thing.subreddit = SimpleNamespace(display_name=data['subreddit'])
+            if 'title' in data:
+                thing.permalink = redem.REDDIT_URL + data['permalink']
+            return thing
+
+        server = StandinServer(fixtures=fixtures).start()
+        items = {}
+        try:
+            raw = redem.APIClient(server.url)
+            session = PrawSession(server.url)
+            for section, to_dict, raw_to_dict in (
+                    ('comments', redem.comment_to_dict,
+                     redem.raw_comment_to_dict),
+                    ('submissions', redem.submission_to_dict,
+                     redem.raw_submission_to_dict)):
+                praw_items = [
+                    to_dict(praw_object(dict(x))) for x in
+                    redem.iter_raw_listing(session, 'example', section)]
+                raw_items = [
+                    raw_to_dict(x) for x in
+                    redem.iter_raw_listing(raw, 'example', section)]
+                # the raw engine over a praw session (decoded once)
+                praw_raw_items = [
+                    raw_to_dict(x) for x in
+                    redem.iter_raw_listing(session, 'example', section)]
+                self.assertEqual(json.dumps(raw_items),
+                                 json.dumps(praw_items))
+                self.assertEqual(raw_items, praw_raw_items)
+                items[section] = raw_items
+        finally:
+            server.stop()
+        comment = items['comments'][0]
+        self.assertEqual(comment['body'], u'a < b && b > c &lt;')
+        self.assertEqual(
+            comment['body_html'],
+            u'<div class="md"><p>a &lt; b &amp;&amp; b &gt; c &amp;lt;'
+            u'</p></div>')
+        self.assertEqual(items['submissions'][0]['title'], u'Q&A <3')
+
+    def test_ratelimit(self):
+        import requests
+        server = StandinServer(
+            fixtures=Fixtures.synthetic(comments=10, submissions=1),
+            ratelimit=2, window=0.5).start()
+        try:
+            session = requests.Session()
+            limiter = redem.RateLimiter(rate=None).install(session)
+            start = time.time()
+            for _ in range(5):
+                response = session.get(
+                    server.url + '/user/example/comments.json')
+                self.assertEqual(response.status_code, 200)
+            self.assertGreater(time.time() - start, 0.5)
+            self.assertEqual(server.stats['throttled'], 0)
+            self.assertGreater(limiter.resume_at, 0)
+        finally:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
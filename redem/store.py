@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+"""
+redem.store - SQLite archive of comments and submissions
+
+::
+
+    redem --store sqlite:data/redem.sqlite --backup --incremental
+    redem --store sqlite:data/redem.sqlite --merge data/*data*.json
+    redem --store sqlite:data/redem.sqlite --html -o index.html
+    redem --store sqlite:data/redem.sqlite --export -j merged_json.json
+
+Items are stored as JSON (``data``) keyed by ``id``, with the columns
+needed for ordering, lookups and the merge rule alongside. Versions of
+an item from different backups are merged as by ``--merge``: the newest
+is kept and older text and scores become its revision chain (see
+:py:func:`redem.merge_revisions`); ``seen`` is the ``date_utc`` of the
+backup the stored version is from.
+"""
+import codecs
+import json
+import logging
+import os.path
+import sqlite3
+import unittest
+from collections import OrderedDict
+
+from redem import redem
+
+log = logging.getLogger('redem.store')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id TEXT PRIMARY KEY,
+    created_utc REAL,
+    edited REAL,
+    score INTEGER,
+    subreddit TEXT,
+    link_id TEXT,
+    data TEXT,
+    seen TEXT
+);
+CREATE INDEX IF NOT EXISTS {table}_created_utc ON {table} (created_utc);
+CREATE INDEX IF NOT EXISTS {table}_subreddit ON {table} (subreddit);
+CREATE INDEX IF NOT EXISTS {table}_link_id ON {table} (link_id);
+"""
+
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# new items and merged versions of stored items (see SQLiteStore.upsert)
+UPSERT = """
+INSERT OR REPLACE INTO {table}
+    (id, created_utc, edited, score, subreddit, link_id, data, seen)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+LOOKUP_CHUNKSIZE = 500  # ids per SELECT (below SQLite's variable limit)
+
+
+def item_row(item, seen=None):
+    edited = item.get('edited')
+    return (
+        item['id'],
+        item['created_utc'],
+        float(edited) if edited else None,
+        item.get('score'),
+        item.get('subreddit'),
+        item.get('link_id'),
+        redem.dumps(item),
+        seen)
+
+
+def read_ndjson_meta(filename):
+    """
+    :returns: the ``_meta`` of an NDJSON backup (written last by
+        :py:class:`redem.NDJSONWriter`) without parsing its items
+    """
+    meta = OrderedDict()
+    with codecs.open(redem.expand_path(filename), 'r',
+                     encoding='utf-8') as fp:
+        for line in fp:
+            if line.startswith('{"_meta"'):
+                meta.update(json.loads(line)['_meta'])
+    return meta
+
+
+class SQLiteStore(object):
+    """
+    SQLite archive with one table per section (``comments``,
+    ``submissions``) and a ``meta`` table for ``_meta``
+    """
+    def __init__(self, filename, sections=redem.SECTIONS):
+        self.filename = redem.expand_path(filename)
+        self.sections = sections
+        self.conn = sqlite3.connect(self.filename)
+        for section in sections:
+            self.conn.executescript(SCHEMA.format(table=section))
+            columns = [row[1] for row in self.conn.execute(
+                'PRAGMA table_info(%s)' % section)]
+            if 'seen' not in columns:
+                self.conn.execute(
+                    'ALTER TABLE %s ADD COLUMN seen TEXT' % section)
+        self.conn.executescript(META_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_versions(self, section, ids):
+        """
+        :returns: dict of id -> (stored item, ``seen``)
+        """
+        ids = list(ids)
+        versions = {}
+        for n in range(0, len(ids), LOOKUP_CHUNKSIZE):
+            chunk = ids[n:n + LOOKUP_CHUNKSIZE]
+            for _id, data, seen in self.conn.execute(
+                    'SELECT id, data, seen FROM %s WHERE id IN (%s)' % (
+                        section, ', '.join('?' * len(chunk))), chunk):
+                versions[_id] = (json.loads(
+                    data, object_pairs_hook=redem.record_pairs_hook), seen)
+        return versions
+
+    def upsert(self, section, items, seen=None):
+        """
+        insert new items and merge the others with the stored version
+        (see :py:func:`redem.merge_revisions`)
+
+        :param seen: ``date_utc`` of the backup ``items`` are from
+        :returns: number of rows inserted or changed
+        """
+        items = list(items)
+        stored = self.get_versions(section, (x['id'] for x in items))
+        rows = []
+        for item in items:
+            version = stored.get(item['id'])
+            item_seen = seen
+            if version is not None:
+                item = redem.merge_revisions([(item, seen), version])
+                if item == version[0]:
+                    continue
+                item_seen = item.get('_seen', seen or version[1])
+            stored[item['id']] = (item, item_seen)
+            rows.append(item_row(item, item_seen))
+        with self.conn:
+            self.conn.executemany(UPSERT.format(table=section), rows)
+        return len(rows)
+
+    def get_meta(self):
+        meta = OrderedDict()
+        for key, value in self.conn.execute(
+                'SELECT key, value FROM meta ORDER BY rowid'):
+            meta[key] = json.loads(value, object_pairs_hook=OrderedDict)
+        return meta
+
+    def update_meta(self, meta):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ((key, json.dumps(value)) for key, value in meta.items()))
+
+    def update(self, data):
+        """
+        upsert every section of a backup (as returned by
+        :py:func:`redem.redem`) and its ``_meta``
+
+        :returns: dict of section -> number of rows changed
+        """
+        changes = OrderedDict()
+        seen = data.get('_meta', {}).get('date_utc')
+        for section in self.sections:
+            changes[section] = self.upsert(
+                section, data.get(section, []), seen)
+            log.info("%-14s: %d changed" % (section, changes[section]))
+        self.update_meta(data.get('_meta', {}))
+        return changes
+
+    def merge_files(self, filenames):
+        """
+        upsert JSON or NDJSON backups
+
+        :returns: dict of section -> number of rows changed
+        """
+        changes = OrderedDict((section, 0) for section in self.sections)
+        merged_from = self.get_meta().get('merged_from', OrderedDict())
+        for filename in filenames:
+            log.info("loading: %r" % filename)
+            # (_meta comes first in JSON backups and archives)
+            meta = OrderedDict()
+            if redem.is_ndjson(filename):
+                meta = read_ndjson_meta(filename)
+            sections = OrderedDict(
+                (section, []) for section in self.sections)
+            for section, item in redem.iter_records(filename):
+                if section == '_meta':
+                    meta.update(item)
+                elif section in sections:
+                    sections[section].append(item)
+                    if len(sections[section]) >= 1000:
+                        changes[section] += self.upsert(
+                            section, sections[section],
+                            meta.get('date_utc'))
+                        sections[section] = []
+            for section, items in sections.items():
+                changes[section] += self.upsert(
+                    section, items, meta.get('date_utc'))
+            merged_from[filename] = meta
+        self.update_meta({'merged_from': merged_from})
+        for section in self.sections:
+            log.info("%-14s: %d changed" % (section, changes[section]))
+        return changes
+
+    def count(self, section):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM %s' % section).fetchone()[0]
+
+    def iter_section(self, section):
+        """
+        :returns: iterator of items, newest first
+        """
+        cursor = self.conn.execute(
+            'SELECT data FROM %s ORDER BY created_utc DESC' % section)
+        for (data,) in cursor:
+            yield json.loads(data, object_pairs_hook=redem.record_pairs_hook)
+
+    def get_item(self, section, _id):
+        row = self.conn.execute(
+            'SELECT data FROM %s WHERE id = ?' % section, (_id,)).fetchone()
+        if row:
+            return json.loads(
+                row[0], object_pairs_hook=redem.record_pairs_hook)
+
+    def get_incremental_since(self, refresh_days=0):
+        """
+        :py:func:`redem.get_incremental_since` for the stored sections
+        """
+        since = {}
+        for section in self.sections:
+            (newest,) = self.conn.execute(
+                'SELECT MAX(created_utc) FROM %s' % section).fetchone()
+            since[section] = (
+                None if newest is None
+                else newest - refresh_days * 60 * 60 * 24)
+        return since
+
+    def export(self):
+        """
+        :returns: dict in the JSON layout written by :py:func:`redem.dump`
+        """
+        data = dict.fromkeys(self.sections, [])
+        for section in self.sections:
+            data[section] = list(self.iter_section(section))
+        data['_meta'] = self.get_meta()
+        return data
+
+
+STORES = {
+    'sqlite': SQLiteStore,
+}
+
+
+def open_store(uri):
+    """
+    :param uri: ``<backend>:<path>`` (e.g. ``sqlite:data/redem.sqlite``)
+    """
+    backend, _, path = uri.partition(':')
+    if backend not in STORES or not path:
+        raise ValueError("unsupported store: %r (expected one of %s)" % (
+            uri, ', '.join('%s:<path>' % x for x in STORES)))
+    return STORES[backend](path)
+
+
+class Test_store(unittest.TestCase):
+    def test_sqlite_store(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        store = open_store('sqlite:' + os.path.join(tmpdir, 'redem.sqlite'))
+        self.addCleanup(store.close)
+        data = {'_meta': {'username': 'example'}, 'submissions': [],
+                'comments': [
+                    {'id': 'c1', 'created_utc': 1, 'edited': False,
+                     'subreddit': 'Python', 'link_id': 't3_s1'},
+                    {'id': 'c2', 'created_utc': 2, 'edited': False,
+                     'subreddit': 'Python', 'link_id': 't3_s1'}]}
+        self.assertEqual(store.update(data)['comments'], 2)
+        self.assertEqual(store.update(data)['comments'], 0)
+        edited = dict(data['comments'][0], edited=3, body='edited')
+        self.assertEqual(store.upsert('comments', [edited]), 1)
+        self.assertEqual(store.get_item('comments', 'c1')['body'], 'edited')
+        # edits and score changes are kept as revisions (as by --merge)
+        scored = dict(edited, score=5)
+        self.assertEqual(store.upsert('comments', [scored], '2013-10-01'), 1)
+        # (seen again later: no new revision)
+        store.upsert('comments', [scored], '2013-10-02')
+        item = store.get_item('comments', 'c1')
+        self.assertEqual(
+            [(x.get('body'), x.get('score'))
+             for x in redem.iter_revisions(item)],
+            [('edited', 5), ('edited', None), (None, None)])
+        self.assertEqual(store.get_incremental_since(),
+                         {'comments': 2, 'submissions': None})
+        exported = store.export()
+        self.assertEqual([x['id'] for x in exported['comments']],
+                         ['c2', 'c1'])
+        self.assertEqual(exported['_meta'], {'username': 'example'})
+        self.assertRaises(ValueError, open_store, 'redem.sqlite')
+
+    def test_merge_files(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filenames = []
+        for n, (body, edited) in enumerate(
+                (('first', False), ('second', 10), ('third', 20))):
+            filenames.append(os.path.join(tmpdir, '%d.ndjson' % n))
+            redem.dump({
+                '_meta': {'date_utc': '2013-10-0%d' % (n + 1)},
+                'submissions': [], 'comments': [
+                    {'id': 'c1', 'created_utc': 1, 'edited': edited,
+                     'body': body, 'score': n}]}, filenames[-1])
+        with SQLiteStore(os.path.join(tmpdir, 'redem.sqlite')) as store:
+            # (merged out of order)
+            store.merge_files([filenames[1], filenames[2], filenames[0]])
+            item = store.get_item('comments', 'c1')
+        expected = redem.merge_json_files(filenames)['comments'][0]
+        self.assertEqual(item, expected)
+        self.assertEqual(
+            [x['body'] for x in redem.iter_revisions(item)],
+            ['third', 'second', 'first'])
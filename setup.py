@@ -10,7 +10,7 @@ INSTALL_REQUIRES=[
     'BeautifulSoup4',
     'URLObject',
     'Jinja2',
-    'requests_cache',
+    'requests',
 ]
 
 setup(